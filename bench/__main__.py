@@ -0,0 +1,99 @@
+from argparse import ArgumentParser
+from collections import OrderedDict
+from logging import basicConfig, getLogger
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from gmail.metrics import metrics
+from gmail.scheduler import configure_scheduler
+
+from .corpus import Corpus
+from .results import compare, get_default_output, save_results
+from .scenarios import Environment, EMAIL, SCENARIOS
+
+logger = getLogger('bench')
+
+# the fake service has no quota. Do not let the scheduler throttle it.
+UNLIMITED_QUOTA = 10 ** 9
+
+
+def get_args():
+    parser = ArgumentParser(prog='python -m bench', description='LifeMotif Diem benchmarks, against a fake Gmail.')
+
+    parser.add_argument('-s', '--scenario', nargs='+', choices=list(SCENARIOS.keys()),
+                        help='Scenarios to run. All scenarios if omitted.')
+
+    parser.add_argument('-n', '--messages', default=10000, type=int,
+                        help='Number of messages in the synthetic mailbox. Half of them are replies.')
+
+    parser.add_argument('-a', '--archive-messages', default=1000, type=int,
+                        help='Number of replies archived for fetch_and_archive, export, query and fix_missing.')
+
+    parser.add_argument('--attachment-ratio', default=0.2, type=float, help='Ratio of replies with attachments.')
+
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the synthetic mailbox.')
+
+    parser.add_argument('--latency', default=0.0, type=float, help='Milliseconds each fake API request takes.')
+
+    parser.add_argument('-j', '--workers', default=1, type=int, help='Download workers.')
+
+    parser.add_argument('--connections', default=100, type=int,
+                        help='Connections of the asyncio engine, in the fetch_and_archive_http scenario.')
+
+    parser.add_argument('-b', '--batch-size', default=1, type=int, help='Messages in a batch request.')
+
+    parser.add_argument('--date-source', default='metadata', choices=['metadata', 'raw', 'internal-date'])
+
+    parser.add_argument('--archive-format', default='loose', choices=['loose', 'pack'])
+
+    parser.add_argument('--archive-codec', default='gzip', choices=['gzip', 'zlib', 'lzma'])
+
+    parser.add_argument('--repeat', default=20, type=int, help='Repeats of each query string in the query scenario.')
+
+    parser.add_argument('-w', '--workdir', help='Working directory. A temporary one, removed afterwards, if omitted.')
+
+    parser.add_argument('-o', '--output', default=get_default_output('results.json'), help='Result JSON file path. Default: %(default)s')
+
+    parser.add_argument('-c', '--compare', help='Result JSON file of a previous run to compare with.')
+
+    parser.add_argument('-l', '--log-level', default='WARNING',
+                        choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG', ], help='Log level')
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+
+    basicConfig(level=args.log_level, format='%(levelname)-8s %(name)s: %(message)s')
+
+    configure_scheduler(EMAIL, UNLIMITED_QUOTA, max_concurrency=max(1, args.workers))
+
+    workdir = args.workdir or mkdtemp(prefix='diem-bench-')
+    corpus = Corpus(args.messages, seed=args.seed, attachment_ratio=args.attachment_ratio)
+    env = Environment(workdir, corpus, args)
+
+    results = OrderedDict()
+
+    try:
+        for name in args.scenario or SCENARIOS.keys():
+            logger.info('Running %s.' % name)
+            metrics.clear()
+            results[name] = SCENARIOS[name](env)
+            results[name]['metrics'] = metrics.get_summary()
+            print('%-20s %10.3f sec  %10d items  %12s items/sec' % (
+                name, results[name]['seconds'], results[name]['items'], results[name]['items_per_second']
+            ))
+    finally:
+        env.close()
+        if not args.workdir:
+            rmtree(workdir, ignore_errors=True)
+
+    save_results(args.output, vars(args), results)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+from datetime import date, datetime, timedelta
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime
+from pytz import timezone
+
+import random
+
+# mids of the corpus look like Gmail's: 16 hex digits, increasing with time.
+BASE_MID = 0x1530000000000000
+MID_STEP = 0x100000
+
+FIRST_DIARY_DATE = date(2010, 1, 1)
+
+ALARM_SENDER = 'LifeMotif <lifemotif@gmail.com>'
+USER = 'User <user@gmail.com>'
+
+WORDS = [
+    '오늘은', '날씨가', '맑았다', '회사에서', '점심으로', '김치찌개를', '먹었다', '저녁에는', '산책을', '했다',
+    '책을', '읽었다', '친구를', '만났다', 'sunny', 'walk', 'coffee', 'friends', 'meeting', 'tired',
+]
+
+
+class Corpus(object):
+    """
+    Synthetic diary mailbox. Every diary is a thread of an alarm mail and its reply, one diary a day.
+
+    Messages are generated from their index on demand, the same bytes every time for the same seed,
+    so a corpus of a million messages costs no memory until its messages are read.
+
+    :param size: number of messages. Half of them are alarm mails, and the other half replies.
+    :param seed:
+    :param attachment_ratio: ratio of replies with photo attachments.
+    :param attachment_size: tuple of (min, max) bytes of an attachment.
+    :param max_attachments: a reply with attachments has 1 to max_attachments of them.
+    """
+
+    def __init__(self, size, seed=0, attachment_ratio=0.2, attachment_size=(8 * 1024, 64 * 1024), max_attachments=3):
+        self.threads = max(1, size // 2)
+        self.seed = seed
+        self.attachment_ratio = attachment_ratio
+        self.attachment_size = attachment_size
+        self.max_attachments = max_attachments
+        self.timezone = timezone('Asia/Seoul')
+
+    def __len__(self):
+        return self.threads * 2
+
+    @staticmethod
+    def get_mid(index):
+        return BASE_MID + index * MID_STEP
+
+    @staticmethod
+    def get_index(mid):
+        """
+        :return: index of mid, or None if mid is not a message of a corpus.
+        """
+        index, remainder = divmod(mid - BASE_MID, MID_STEP)
+        if mid < BASE_MID or remainder:
+            return None
+        return index
+
+    def has_message(self, mid):
+        index = self.get_index(mid)
+        return index is not None and index < len(self)
+
+    def get_tid(self, mid):
+        return self.get_mid(self.get_index(mid) // 2 * 2)
+
+    def is_alarm(self, mid):
+        return self.get_index(mid) % 2 == 0
+
+    def iter_structure(self):
+        """
+        :return: generator of tuples: (mid, tid), from the newest message, as Gmail lists them.
+        """
+        for index in range(len(self) - 1, -1, -1):
+            mid = self.get_mid(index)
+            yield mid, self.get_mid(index // 2 * 2)
+
+    def get_structure(self, threads=None):
+        """
+        :param threads: number of the oldest threads to include. All threads if None.
+        :return: list of tuples: (mid, tid)
+        """
+        count = len(self) if threads is None else min(len(self), threads * 2)
+        return [(self.get_mid(index), self.get_mid(index // 2 * 2)) for index in range(count - 1, -1, -1)]
+
+    def get_diary_date(self, mid):
+        return FIRST_DIARY_DATE + timedelta(days=self.get_index(mid) // 2)
+
+    def get_date_indices(self, structure):
+        """
+        :return: dict of tid --> diary date, as gmail.fetch.extract_diary_dates() returns.
+        """
+        return {tid: self.get_diary_date(tid) for mid, tid in structure if mid == tid}
+
+    def get_datetime(self, mid):
+        """
+        Alarm mails are sent at 19:00, and replies are written in the same night.
+        """
+        index = self.get_index(mid)
+        diary_date = FIRST_DIARY_DATE + timedelta(days=index // 2)
+        if index % 2 == 0:
+            naive = datetime.combine(diary_date, datetime.min.time()) + timedelta(hours=19)
+        else:
+            naive = datetime.combine(diary_date, datetime.min.time()) + timedelta(hours=21, minutes=index % 120)
+        return self.timezone.localize(naive)
+
+    def get_message(self, mid):
+        """
+        :return: raw MIME message bytes, with CRLF line breaks as Gmail returns them.
+        """
+        if self.is_alarm(mid):
+            message = self.make_alarm(mid)
+        else:
+            message = self.make_reply(mid)
+
+        return message.as_bytes().replace(b'\n', b'\r\n')
+
+    def make_alarm(self, mid):
+        diary_date = self.get_diary_date(mid)
+
+        message = MIMEText('%s 오늘의 일기를 작성해 주세요.' % diary_date.isoformat(), 'plain', 'utf-8')
+        self.set_headers(message, mid, ALARM_SENDER, USER, '[LifeMotif] 오늘의 일기를 작성해 주세요')
+
+        return message
+
+    def make_reply(self, mid):
+        r = random.Random(self.seed * 1000003 + mid)
+        tid = self.get_tid(mid)
+
+        text = ' '.join(r.choice(WORDS) for _ in range(r.randint(30, 300)))
+
+        # boundaries are random unless they are given.
+        body = MIMEMultipart('alternative', boundary='=====alternative-%x=====' % mid)
+        body.attach(MIMEText(text, 'plain', 'utf-8'))
+        body.attach(MIMEText(
+            '<div dir="ltr"><div class="gmail_default">%s</div><div class="gmail_extra"><br>'
+            '<div class="gmail_quote"><blockquote class="gmail_quote">오늘의 일기를 작성해 주세요.</blockquote>'
+            '</div></div></div>' % text.replace(' ', ' <br>', r.randint(0, 5)),
+            'html', 'utf-8'
+        ))
+
+        if r.random() < self.attachment_ratio:
+            message = MIMEMultipart('mixed', boundary='=====mixed-%x=====' % mid)
+            message.attach(body)
+
+            for k in range(r.randint(1, self.max_attachments)):
+                size = r.randint(*self.attachment_size)
+                image = MIMEImage(r.getrandbits(size * 8).to_bytes(size, 'little'), 'jpeg')
+                image.add_header('Content-Disposition', 'attachment', filename='IMG_%04d.jpg' % (mid % 10000 + k))
+                image.add_header('X-Attachment-Id', 'f_%x%d' % (mid & 0xffffff, k))
+                message.attach(image)
+        else:
+            message = body
+
+        self.set_headers(message, mid, USER, ALARM_SENDER, 'Re: [LifeMotif] 오늘의 일기를 작성해 주세요')
+        message['In-Reply-To'] = '<alarm-%x@lifemotif>' % tid
+        message['References'] = '<alarm-%x@lifemotif>' % tid
+
+        return message
+
+    def set_headers(self, message, mid, sender, recipient, subject):
+        message['Delivered-To'] = 'user@gmail.com'
+        message['Received'] = 'by 10.%d.%d.%d with SMTP id %xcsp; %s' % (
+            mid % 251, mid % 241, mid % 239, mid, format_datetime(self.get_datetime(mid))
+        )
+        message['Date'] = format_datetime(self.get_datetime(mid))
+        message['Message-ID'] = '<%s-%x@lifemotif>' % ('alarm' if self.is_alarm(mid) else 'reply', mid)
+        message['Subject'] = subject
+        message['From'] = sender
+        message['To'] = recipient
@@ -0,0 +1,203 @@
+from base64 import urlsafe_b64encode
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+from time import sleep
+
+from googleapiclient.errors import HttpError
+
+LABEL_ID = 'Label_1'
+
+# Gmail lists 100 messages a page by default.
+PAGE_SIZE = 100
+
+
+class FakeResponse(dict):
+    """
+    Stand-in of httplib2.Response, for HttpError.
+    """
+
+    def __init__(self, status):
+        super(FakeResponse, self).__init__(status=str(status))
+        self.status = status
+        self.reason = 'Not Found' if status == 404 else 'Error'
+
+
+class FakeRequest(object):
+    def __init__(self, service, method, function):
+        self.service = service
+        self.method = method
+        self.function = function
+
+    def execute(self, http=None, num_retries=0):
+        self.service.count(self.method)
+        self.service.wait()
+        return self.function()
+
+
+class FakeBatchRequest(object):
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.service.count('batch')
+        self.service.wait()
+
+        for request_id, request in self.requests:
+            self.service.count(request.method)
+            try:
+                response = request.function()
+            except HttpError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
+class FakeGmailService(object):
+    """
+    Local stand-in of the Gmail API service object built by googleapiclient, serving a bench.corpus.Corpus.
+
+    users.messages.list, users.messages.get, users.getProfile, users.history.list, users.labels.list,
+    and batch requests are implemented, as far as gmail.fetch uses them.
+    Every message of the corpus has LABEL_ID. history.list never has new records.
+
+    :param corpus: bench.corpus.Corpus
+    :param latency: seconds each HTTP request takes. A batch request is one HTTP request.
+    :param page_size: messages per list page.
+    """
+
+    def __init__(self, corpus, latency=0.0, page_size=PAGE_SIZE):
+        self.corpus = corpus
+        self.latency = latency
+        self.page_size = page_size
+        self.history_id = 1000
+        self.calls = Counter()
+        self.bytes = 0
+        self.lock = Lock()
+
+    def count(self, method):
+        with self.lock:
+            self.calls[method] += 1
+
+    def wait(self):
+        if self.latency:
+            sleep(self.latency)
+
+    def users(self):
+        return _Users(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchRequest(self, callback)
+
+    def list_messages(self, page_token):
+        start = int(page_token or 0)
+        end = min(start + self.page_size, len(self.corpus))
+
+        messages = []
+        for index in range(len(self.corpus) - 1 - start, len(self.corpus) - 1 - end, -1):
+            mid = self.corpus.get_mid(index)
+            messages.append({'id': '%x' % mid, 'threadId': '%x' % self.corpus.get_tid(mid)})
+
+        response = {'messages': messages, 'resultSizeEstimate': len(self.corpus)}
+        if end < len(self.corpus):
+            response['nextPageToken'] = str(end)
+
+        return response
+
+    def get_message(self, message_id, message_format):
+        mid = int(message_id, 16)
+
+        if not self.corpus.has_message(mid):
+            raise HttpError(FakeResponse(404), b'{"error": {"code": 404, "message": "Not Found"}}')
+
+        response = {
+            'id': message_id,
+            'threadId': '%x' % self.corpus.get_tid(mid),
+            'labelIds': [LABEL_ID],
+            'historyId': str(self.history_id),
+            'internalDate': str(int(self.corpus.get_datetime(mid).timestamp() * 1000)),
+        }
+
+        if message_format == 'raw':
+            raw = urlsafe_b64encode(self.corpus.get_message(mid)).decode('ascii')
+            response['raw'] = raw
+            response['sizeEstimate'] = len(raw) * 3 // 4
+            with self.lock:
+                self.bytes += len(raw)
+
+        elif message_format == 'metadata':
+            date = self.corpus.get_datetime(mid).strftime('%a, %d %b %Y %H:%M:%S %z')
+            response['payload'] = {'headers': [{'name': 'Date', 'value': date}]}
+
+        return response
+
+
+class _Users(object):
+    def __init__(self, service):
+        self.service = service
+
+    def messages(self):
+        return _Messages(self.service)
+
+    def history(self):
+        return _History(self.service)
+
+    def labels(self):
+        return _Labels(self.service)
+
+    def getProfile(self, userId):
+        return FakeRequest(self.service, 'getProfile', lambda: {
+            'emailAddress': userId,
+            'messagesTotal': len(self.service.corpus),
+            'historyId': str(self.service.history_id),
+        })
+
+
+class _Messages(object):
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, labelIds=None, includeSpamTrash=False, pageToken='', maxResults=None):
+        return FakeRequest(self.service, 'messages.list', lambda: self.service.list_messages(pageToken))
+
+    def get(self, userId, id, format='full', metadataHeaders=None):
+        return FakeRequest(self.service, 'messages.get', lambda: self.service.get_message(id, format))
+
+
+class _History(object):
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, startHistoryId, labelId=None, historyTypes=None, pageToken=''):
+        return FakeRequest(self.service, 'history.list', lambda: {'historyId': str(self.service.history_id)})
+
+
+class _Labels(object):
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId):
+        return FakeRequest(self.service, 'labels.list', lambda: {
+            'labels': [{'id': LABEL_ID, 'name': 'diary', 'type': 'user'}]
+        })
+
+
+@contextmanager
+def installed(service):
+    """
+    Make diem.diem build service, instead of a real Gmail service, while in the context.
+    """
+    from diem import diem
+
+    get_service = diem.get_service
+    diem.get_service = lambda storage: service
+
+    try:
+        yield service
+    finally:
+        diem.get_service = get_service
@@ -0,0 +1,194 @@
+"""
+Local stand-in of the Gmail REST API, over HTTP/1.1 on a loopback port, for engines which make real HTTP requests,
+like gmail.aio. It serves the messages of a bench.fakegmail.FakeGmailService.
+"""
+from asyncio import IncompleteReadError, new_event_loop, run_coroutine_threadsafe, sleep, start_server
+from json import dumps
+from threading import Thread
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import re
+import zlib
+
+from googleapiclient.errors import HttpError
+
+# users.messages.list, users.messages.get, users.getProfile and users.labels.list, as paths under the root URL.
+routes = [
+    (re.compile(r'^/gmail/v1/users/([^/]+)/messages$'), 'messages.list'),
+    (re.compile(r'^/gmail/v1/users/([^/]+)/messages/([0-9a-f]+)$'), 'messages.get'),
+    (re.compile(r'^/gmail/v1/users/([^/]+)/profile$'), 'getProfile'),
+    (re.compile(r'^/gmail/v1/users/([^/]+)/labels$'), 'labels.list'),
+]
+
+# responses as large as this or larger are gzip encoded, for clients which accept it.
+GZIP_MIN_SIZE = 1024
+
+
+class FakeGmailServer(object):
+    """
+    HTTP/1.1 server with keep-alive, running its event loop in a thread of its own,
+    so that blocking clients in the calling thread can use it as well.
+
+    :param service: bench.fakegmail.FakeGmailService
+    :param access_token: the bearer token every request must have. Any request is served if None.
+    :param latency: seconds each request takes, without blocking the other ones.
+
+    faults is a dict of message id --> list of faults, which requests of the message get, one each and in order,
+    before the message itself. A fault is a tuple of (status, dict of extra headers) for an error response,
+    or bytes, written as they are as the whole response, after which the connection is closed.
+    """
+
+    def __init__(self, service, access_token=None, latency=0.0):
+        self.service = service
+        self.access_token = access_token
+        self.latency = latency
+        self.connections = 0
+        # requests being answered, and the most of them at once.
+        self.active = 0
+        self.peak_active = 0
+        self.faults = {}
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self.writers = set()
+
+    def start(self):
+        """
+        :return: root URL of the server.
+        """
+        self.loop = new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name='fake-gmail', daemon=True)
+        self.thread.start()
+
+        self.server = run_coroutine_threadsafe(
+            start_server(self.handle_connection, '127.0.0.1', 0), self.loop
+        ).result()
+
+        return 'http://127.0.0.1:%d/' % self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        async def _close():
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+
+        run_coroutine_threadsafe(_close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        self.writers.add(writer)
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, separator, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                self.active += 1
+                self.peak_active = max(self.peak_active, self.active)
+
+                try:
+                    if self.latency:
+                        await sleep(self.latency)
+                finally:
+                    self.active -= 1
+
+                fault = self.get_fault(target)
+
+                if isinstance(fault, bytes):
+                    writer.write(fault)
+                    await writer.drain()
+                    break
+
+                if fault:
+                    status, fault_headers = fault
+                    body = b'{"error": {"code": %d, "message": "Injected fault"}}' % status
+                else:
+                    status, body = self.respond(method, target, headers)
+                    fault_headers = {}
+
+                extra = ''.join('%s: %s\r\n' % header for header in fault_headers.items())
+
+                if len(body) >= GZIP_MIN_SIZE and 'gzip' in headers.get('accept-encoding', ''):
+                    body = zlib.compress(body, 1, 16 + zlib.MAX_WBITS)
+                    extra += 'Content-Encoding: gzip\r\n'
+
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json; charset=UTF-8\r\n'
+                              'Content-Length: %d\r\n%s\r\n' % (status, 'OK' if status == 200 else 'Error', len(body),
+                                                                extra)).encode('latin-1'))
+                writer.write(body)
+                await writer.drain()
+
+        except (ConnectionError, IncompleteReadError, ValueError):
+            pass
+
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def get_fault(self, target):
+        """
+        :return: the next fault of the message target gets, or None.
+        """
+        matched = routes[1][0].match(urlsplit(target).path)
+        faults = self.faults.get(int(matched.group(2), 16)) if matched else None
+
+        return faults.pop(0) if faults else None
+
+    def respond(self, method, target, headers):
+        """
+        :return: tuple of (status, JSON body bytes)
+        """
+        if self.access_token and headers.get('authorization') != 'Bearer %s' % self.access_token:
+            return 401, b'{"error": {"code": 401, "message": "Invalid Credentials"}}'
+
+        url = urlsplit(target)
+        query = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+
+        for expr, name in routes:
+            matched = expr.match(url.path)
+            if matched:
+                break
+        else:
+            return 404, b'{"error": {"code": 404, "message": "Not Found"}}'
+
+        email = unquote(matched.group(1))
+        service = self.service
+        users = service.users()
+
+        try:
+            if name == 'messages.list':
+                service.count(name)
+                response = service.list_messages(query.get('pageToken', ''))
+            elif name == 'messages.get':
+                service.count(name)
+                response = service.get_message(matched.group(2), query.get('format', 'full'))
+            elif name == 'getProfile':
+                response = users.getProfile(userId=email).execute()
+            else:
+                response = users.labels().list(userId=email).execute()
+
+        except HttpError as e:
+            return e.resp.status, e.content
+
+        return 200, dumps(response).encode('utf-8')
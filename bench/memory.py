@@ -0,0 +1,134 @@
+"""
+Memory benchmark of archiving a large message: the peak of Python memory allocated while one message is
+fetched from the fake Gmail, decoded, compressed, stored and indexed, with and without streaming.
+
+    python -m bench.memory -m 64 -o memory.json [-c previous-memory.json]
+
+The JSON body of the response is prepared before measuring, as if it were already downloaded, and it is parsed
+while measuring, as googleapiclient parses it. So the peak includes the parsed response, whose raw is one base64 copy
+of the message, but not the HTTP body the response is parsed from.
+"""
+from argparse import ArgumentParser
+from base64 import urlsafe_b64decode
+from collections import OrderedDict
+from json import dumps, loads
+from os import makedirs
+from os.path import join as path_join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+import tracemalloc
+
+from diem.indexer import index_message
+from gmail import fetch as gmail_fetch
+from gmail.archive import get_archive
+from gmail.scheduler import configure_scheduler
+
+from .corpus import Corpus
+from .fakegmail import FakeGmailService
+from .results import compare, get_default_output, save_results
+from .scenarios import EMAIL
+
+
+class PreparedGmailService(FakeGmailService):
+    """
+    Fake Gmail, which serves the JSON body of a message built beforehand. Building a message takes several times
+    its size, which would be measured otherwise. The body is parsed on every request.
+    """
+
+    def __init__(self, corpus, mid):
+        super(PreparedGmailService, self).__init__(corpus)
+        self.body = dumps(super(PreparedGmailService, self).get_message('%x' % mid, 'raw'))
+
+    def get_message(self, message_id, message_format):
+        return loads(self.body)
+
+
+def measure(service, mid, archive_path, archive_format, archive_codec, stream_min_size):
+    """
+    :return: tuple of (peak bytes, seconds, manifest of the archived message)
+    """
+    indices = []
+
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    begin = perf_counter()
+
+    gmail_fetch.fetch_and_archive(
+        service, EMAIL, archive_path, [mid],
+        archive_format=archive_format,
+        archive_codec=archive_codec,
+        on_archived=lambda m, mime, compressed_size: indices.append(index_message(m, mime, compressed_size)),
+        stream_min_size=stream_min_size
+    )
+
+    seconds = perf_counter() - begin
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+
+    return peak, seconds, indices[0]['manifest']
+
+
+def main():
+    parser = ArgumentParser(prog='python -m bench.memory', description='Memory benchmark of archiving a large message.')
+    parser.add_argument('-m', '--megabytes', default=32, type=int, help='Size of the photo attached to the message.')
+    parser.add_argument('--archive-format', default='loose', choices=['loose', 'pack'])
+    parser.add_argument('--archive-codec', default='gzip', choices=['gzip', 'zlib', 'lzma'])
+    parser.add_argument('-o', '--output', default=get_default_output('memory.json'), help='Result JSON file path. Default: %(default)s')
+    parser.add_argument('-c', '--compare', help='Result JSON file of a previous run to compare with.')
+    args = parser.parse_args()
+
+    configure_scheduler(EMAIL, 10 ** 9)
+
+    size = args.megabytes * 1024 * 1024
+    corpus = Corpus(2, attachment_ratio=1.0, attachment_size=(size, size), max_attachments=1)
+    mid = corpus.get_mid(1)
+    service = PreparedGmailService(corpus, mid)
+    raw = loads(service.body)['raw']
+    raw_size = len(raw)
+    original = urlsafe_b64decode(raw)
+    del raw
+
+    workdir = mkdtemp(prefix='diem-memory-')
+    results = OrderedDict()
+
+    tracemalloc.start()
+
+    try:
+        for name, stream_min_size in (('whole', None), ('streaming', gmail_fetch.STREAM_MIN_SIZE)):
+            archive_path = path_join(workdir, name)
+            makedirs(archive_path)
+
+            peak, seconds, manifest = measure(service, mid, archive_path, args.archive_format, args.archive_codec,
+                                              stream_min_size)
+
+            if get_archive(mid, archive_path) != original:
+                raise Exception('The archived message of %s differs from the original.' % name)
+
+            result = OrderedDict()
+            result['seconds'] = round(seconds, 6)
+            result['message_bytes'] = manifest[1]
+            result['raw_bytes'] = raw_size
+            result['compressed_bytes'] = manifest[2]
+            result['peak_bytes'] = peak
+            result['peak_over_message'] = round(peak / manifest[1], 3)
+            results[name] = result
+
+            print('%-10s %8.3f sec  peak %10.1f MB  (%6.3f x the message)' % (
+                name, seconds, peak / 1024 / 1024, result['peak_over_message']
+            ))
+    finally:
+        tracemalloc.stop()
+        rmtree(workdir, ignore_errors=True)
+
+    print('Peaks include the parsed response, whose raw is one base64 copy of the message: %.1f MB.'
+          % (raw_size / 1024 / 1024))
+
+    save_results(args.output, vars(args), results)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from datetime import datetime
+from json import dump, load
+from os import makedirs
+from os.path import dirname, join as path_join
+from platform import platform, python_version
+
+from diem import DIEM_VERSION
+
+# results are written here by default. It is ignored by git.
+RESULTS_DIR = 'bench-results'
+
+
+def get_default_output(name):
+    return path_join(RESULTS_DIR, name)
+
+
+def save_results(path, parameters, results):
+    """
+    :param parameters: dict of the bench parameters.
+    :param results: dict of name --> result dict. Every result has 'seconds'.
+    """
+    output = OrderedDict()
+    output['version'] = DIEM_VERSION
+    output['timestamp'] = datetime.now().isoformat()
+    output['python'] = python_version()
+    output['platform'] = platform()
+    output['parameters'] = parameters
+    output['results'] = results
+
+    if dirname(path):
+        makedirs(dirname(path), exist_ok=True)
+
+    with open(path, 'w') as f:
+        dump(output, f, indent=2)
+
+    print('Results saved to %s.' % path)
+
+
+def compare(results, previous_file):
+    """
+    Print seconds of results side by side with those of a previous result file.
+    """
+    with open(previous_file, 'r') as f:
+        previous = load(f)['results']
+
+    print('\n%-20s %12s %12s %8s' % ('NAME', 'BEFORE (s)', 'AFTER (s)', 'RATIO'))
+
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        before = previous[name]['seconds']
+        after = result['seconds']
+        print('%-20s %12.3f %12.3f %7.2fx' % (name, before, after, before / after if after else 0))
@@ -0,0 +1,420 @@
+from collections import OrderedDict
+from logging import getLogger
+from os import makedirs
+from os.path import join as path_join
+from shutil import rmtree
+from pytz import utc
+from time import perf_counter
+
+from diem import diem
+from diem import db as diem_db
+from gmail import fetch as gmail_fetch
+
+from .fakegmail import FakeGmailService, LABEL_ID, installed
+
+logger = getLogger(__name__)
+
+EMAIL = 'bench@example.com'
+
+QUERY_STRINGS = ['latest', '2011', '2011-03', '2011-03-15', '2011-01-01..2011-12-31', '03-15', 'all']
+
+
+class Environment(object):
+    """
+    Working directory of a bench run: a database indexing the whole corpus, and an archive of the oldest replies.
+    They are prepared once, at the first scenario which needs them.
+
+    :param workdir:
+    :param corpus: bench.corpus.Corpus
+    :param options: parsed arguments of bench. See bench.__main__.
+    """
+
+    def __init__(self, workdir, corpus, options):
+        self.workdir = workdir
+        self.corpus = corpus
+        self.options = options
+        self.conn = None
+
+    def get_path(self, *names):
+        return path_join(self.workdir, *names)
+
+    def new_service(self):
+        return FakeGmailService(self.corpus, latency=self.options.latency / 1000.0)
+
+    def get_sample_structure(self):
+        """
+        :return: (mid, tid) of threads whose replies are archived.
+        """
+        return self.corpus.get_structure(self.options.archive_messages)
+
+    def get_sample_mids(self):
+        return [mid for mid, tid in self.get_sample_structure() if mid != tid]
+
+    def get_database(self):
+        if self.conn:
+            return self.conn
+
+        logger.info('Preparing the database of %d message(s).' % len(self.corpus))
+
+        self.conn = diem_db.open_db(self.get_path('diem.db'))
+        diem_db.create_tables(self.conn)
+
+        # index the corpus a page of threads at a time, not to hold a million tuples at once.
+        page = []
+        with self.conn.transaction():
+            for item in self.corpus.iter_structure():
+                page.append(item)
+                if len(page) >= 10000:
+                    self.save_structure(self.conn, page)
+                    page = []
+            self.save_structure(self.conn, page)
+
+        logger.info('Archiving %d reply(s).' % len(self.get_sample_mids()))
+        makedirs(self.get_path('archives'), exist_ok=True)
+
+        with installed(self.new_service()):
+            with self.conn.transaction():
+                diem.fetch(None, EMAIL, self.get_path('archives'), self.get_sample_mids(),
+                           workers=self.options.workers, batch_size=self.options.batch_size,
+                           archive_format=self.options.archive_format, conn=self.conn,
+                           archive_codec=self.options.archive_codec)
+
+        return self.conn
+
+    def save_structure(self, conn, structure):
+        diem_db.update_id_index(conn, structure, commit=False)
+        diem_db.update_date_index(conn, self.corpus.get_date_indices(structure), commit=False)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+def make_result(seconds, items, **extra):
+    result = OrderedDict()
+    result['seconds'] = round(seconds, 6)
+    result['items'] = items
+    result['items_per_second'] = round(items / seconds, 2) if seconds else None
+    result.update(extra)
+    return result
+
+
+def get_latency_stats(latencies):
+    """
+    :param latencies: list of seconds.
+    :return: dict of milliseconds.
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    return OrderedDict([
+        ('mean_ms', round(sum(latencies) / count * 1000, 3)),
+        ('p50_ms', round(latencies[count // 2] * 1000, 3)),
+        ('p95_ms', round(latencies[min(count - 1, count * 95 // 100)] * 1000, 3)),
+        ('max_ms', round(latencies[-1] * 1000, 3)),
+    ])
+
+
+def bench_fetch_structure(env):
+    service = env.new_service()
+
+    begin = perf_counter()
+    structure = gmail_fetch.fetch_structure(service, EMAIL, LABEL_ID, 0)
+    seconds = perf_counter() - begin
+
+    return make_result(seconds, len(structure), pages=service.calls['messages.list'])
+
+
+def bench_extract_diary_dates(env):
+    service = env.new_service()
+    structure = env.corpus.get_structure()
+
+    begin = perf_counter()
+    dates = gmail_fetch.extract_diary_dates(service, EMAIL, structure, env.options.batch_size, env.options.date_source)
+    seconds = perf_counter() - begin
+
+    return make_result(seconds, len(dates), requests=sum(service.calls.values()))
+
+
+def bench_fetch_and_archive(env):
+    service = env.new_service()
+    mid_list = env.get_sample_mids()
+    archive_path = env.get_path('fetch-and-archive')
+
+    rmtree(archive_path, ignore_errors=True)
+    makedirs(archive_path)
+
+    begin = perf_counter()
+    count, error = gmail_fetch.fetch_and_archive(
+        service=service,
+        email=EMAIL,
+        archive_path=archive_path,
+        mid_list=mid_list,
+        workers=env.options.workers,
+        service_builder=lambda: service,
+        batch_size=env.options.batch_size,
+        archive_format=env.options.archive_format,
+        archive_codec=env.options.archive_codec
+    )
+    seconds = perf_counter() - begin
+
+    return make_result(
+        seconds, count,
+        errors=error,
+        downloaded_bytes=service.bytes,
+        megabytes_per_second=round(service.bytes / seconds / 1024 / 1024, 2) if seconds else None
+    )
+
+
+def bench_fetch_and_archive_http(env):
+    """
+    Archive the sample replies from a local stand-in of the Gmail REST API, over real HTTP, twice:
+    with the blocking engine on --workers threads, and with the asyncio engine on --connections connections.
+    Requests take --latency milliseconds, without blocking each other. seconds and items are of the asyncio engine.
+    """
+    from datetime import datetime, timedelta
+    from httplib2 import Http
+    from oauth2client.client import OAuth2Credentials
+    from oauth2client.file import Storage
+    from gmail.aio import AsyncFetcher, StorageToken
+    from gmail.api import build_service
+
+    from .fakeserver import FakeGmailServer
+
+    mid_list = env.get_sample_mids()
+    storage = env.get_path('storage.json')
+    access_token = 'bench-access-token'
+    result = OrderedDict()
+
+    # the asyncio engine takes its token from a storage file, as it does in use. This one never expires in a bench.
+    makedirs(env.workdir, exist_ok=True)
+    Storage(storage).put(OAuth2Credentials(
+        access_token, 'bench-client', 'bench-secret', 'bench-refresh-token', datetime.utcnow() + timedelta(days=1),
+        'https://oauth2.googleapis.com/token', 'bench'
+    ))
+
+    server = FakeGmailServer(FakeGmailService(env.corpus), access_token, latency=env.options.latency / 1000.0)
+    root_url = server.start()
+
+    def _builder():
+        return build_service(_BearerHttp(Http(), access_token), root_url)
+
+    try:
+        for engine in ('threads', 'asyncio'):
+            archive_path = env.get_path('fetch-and-archive-%s' % engine)
+            rmtree(archive_path, ignore_errors=True)
+            makedirs(archive_path)
+            connections = server.connections
+
+            begin = perf_counter()
+            if engine == 'threads':
+                count, error = gmail_fetch.fetch_and_archive(
+                    _builder(), EMAIL, archive_path, mid_list, env.options.workers, _builder,
+                    archive_format=env.options.archive_format, archive_codec=env.options.archive_codec
+                )
+            else:
+                with AsyncFetcher(EMAIL, StorageToken(storage), root_url=root_url,
+                                  max_connections=env.options.connections) as fetcher:
+                    count, error = gmail_fetch.fetch_and_archive(
+                        None, EMAIL, archive_path, mid_list, archive_format=env.options.archive_format,
+                        archive_codec=env.options.archive_codec, mails=fetcher.iter_mails(mid_list)
+                    )
+            seconds = perf_counter() - begin
+
+            result[engine] = make_result(seconds, count, errors=error, connections=server.connections - connections)
+    finally:
+        server.stop()
+
+    return make_result(seconds, count, workers=env.options.workers, max_connections=env.options.connections,
+                       **result)
+
+
+class _BearerHttp(object):
+    """
+    httplib2.Http which sends a fixed bearer token, for the blocking engine against the stand-in server.
+    """
+
+    def __init__(self, http, access_token):
+        self.http = http
+        self.access_token = access_token
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        headers = dict(headers or {}, authorization='Bearer %s' % self.access_token)
+        return self.http.request(uri, method, body, headers, **kwargs)
+
+
+def bench_export(env):
+    conn = env.get_database()
+    archive_path = env.get_path('archives')
+    latencies = []
+
+    begin = perf_counter()
+    for mid in env.get_sample_mids():
+        started = perf_counter()
+        diem.export(conn, mid, archive_path, utc)
+        latencies.append(perf_counter() - started)
+    seconds = perf_counter() - begin
+
+    return make_result(seconds, len(latencies), **get_latency_stats(latencies))
+
+
+def bench_query(env):
+    conn = env.get_database()
+    result = OrderedDict()
+    total = 0.0
+    count = 0
+
+    for query_string in QUERY_STRINGS:
+        latencies = []
+        rows = 0
+
+        for i in range(env.options.repeat):
+            started = perf_counter()
+            rows = len(diem.query(conn, query_string, limit=100).fetchall())
+            latencies.append(perf_counter() - started)
+
+        stats = get_latency_stats(latencies)
+        stats['rows'] = rows
+        result[query_string] = stats
+
+        total += sum(latencies)
+        count += len(latencies)
+
+    return make_result(total, count, queries=result)
+
+
+def bench_fix_missing(env):
+    """
+    Index the sample threads in a database of its own, archive every other reply of them,
+    and measure how fast fix_missing archives the rest.
+    """
+    workdir = env.get_path('fix-missing')
+    rmtree(workdir, ignore_errors=True)
+    makedirs(workdir)
+
+    archive_path = path_join(workdir, 'archives')
+    makedirs(archive_path)
+
+    conn = diem_db.open_db(path_join(workdir, 'diem.db'))
+    diem_db.create_tables(conn)
+
+    structure = env.get_sample_structure()
+    mid_list = env.get_sample_mids()
+
+    with conn.transaction():
+        env.save_structure(conn, structure)
+
+    service = env.new_service()
+
+    with installed(service):
+        with conn.transaction():
+            diem.fetch(None, EMAIL, archive_path, mid_list[::2], workers=env.options.workers,
+                       batch_size=env.options.batch_size, archive_format=env.options.archive_format, conn=conn,
+                       archive_codec=env.options.archive_codec)
+
+        missing = len(diem_db.get_missing_mids(conn))
+
+        begin = perf_counter()
+        with conn.transaction():
+            diem.fix_missing(conn, None, EMAIL, archive_path, workers=env.options.workers,
+                             batch_size=env.options.batch_size, archive_format=env.options.archive_format,
+                             archive_codec=env.options.archive_codec)
+        seconds = perf_counter() - begin
+
+    remaining = len(diem_db.get_missing_mids(conn))
+    conn.close()
+
+    return make_result(seconds, missing - remaining, remaining=remaining)
+
+
+def bench_extract_attachments(env):
+    """
+    Extract every attachment of the archived replies, in one call, as extracting a year of photos would.
+    """
+    conn = env.get_database()
+    dest_dir = env.get_path('extracted')
+    rmtree(dest_dir, ignore_errors=True)
+
+    begin = perf_counter()
+    count, failed = diem.extract_attachments(env.get_sample_mids(), env.get_path('archives'), 'all', dest_dir, conn)
+    seconds = perf_counter() - begin
+
+    return make_result(seconds, count, messages=len(env.get_sample_mids()), failed=len(failed))
+
+
+def bench_serve(env):
+    """
+    Export the archived replies through the HTTP API, over keep-alive connections, twice:
+    once with cold caches, and once again with warm ones. seconds and items are of the warm pass.
+    """
+    from asyncio import gather, open_connection, run
+    from diem.server import DiemServer
+
+    conn = env.get_database()
+    mid_list = env.get_sample_mids()
+    clients = max(1, env.options.workers) * 4
+    result = OrderedDict()
+
+    async def _client(port, mids, latencies):
+        reader, writer = await open_connection('127.0.0.1', port)
+        for mid in mids:
+            started = perf_counter()
+            writer.write(b'GET /export/%d HTTP/1.1\r\nHost: bench\r\n\r\n' % mid)
+            headers = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+            length = int(headers.lower().split('content-length:')[1].split('\r\n')[0])
+            await reader.readexactly(length)
+            latencies.append(perf_counter() - started)
+        writer.close()
+
+    async def _main():
+        server = DiemServer(conn, env.get_path('archives'), utc, workers=max(1, env.options.workers))
+        host, port = await server.start('127.0.0.1', 0)
+
+        try:
+            for name in ('cold', 'warm'):
+                latencies = []
+                begin = perf_counter()
+                await gather(*[_client(port, mid_list[i::clients], latencies) for i in range(clients)])
+                seconds = perf_counter() - begin
+
+                result[name] = get_latency_stats(latencies)
+                result[name]['requests_per_second'] = round(len(latencies) / seconds, 2)
+        finally:
+            await server.close()
+
+        return seconds
+
+    seconds = run(_main())
+
+    return make_result(seconds, len(mid_list), clients=clients, **result)
+
+
+def bench_build_service(env):
+    """
+    Build services from the bundled discovery document, over a stand-in HTTP which serves one list page.
+    """
+    from googleapiclient.http import HttpMockSequence
+    from gmail.api import build_service
+
+    begin = perf_counter()
+    for i in range(env.options.repeat):
+        http = HttpMockSequence([({'status': '200'}, '{"messages": [{"id": "2", "threadId": "1"}]}')])
+        gmail_fetch.list_messages_page(build_service(http), EMAIL, LABEL_ID)
+    seconds = perf_counter() - begin
+
+    return make_result(seconds, env.options.repeat)
+
+
+SCENARIOS = OrderedDict([
+    ('build_service', bench_build_service),
+    ('fetch_structure', bench_fetch_structure),
+    ('extract_diary_dates', bench_extract_diary_dates),
+    ('fetch_and_archive', bench_fetch_and_archive),
+    ('fetch_and_archive_http', bench_fetch_and_archive_http),
+    ('export', bench_export),
+    ('query', bench_query),
+    ('fix_missing', bench_fix_missing),
+    ('extract_attachments', bench_extract_attachments),
+    ('serve', bench_serve),
+])
@@ -0,0 +1,153 @@
+"""
+Startup benchmark of the CLI: how long each subcommand takes to run as a new process, and what it imports.
+
+    python -m bench.startup -o startup.json [-c previous-startup.json]
+
+Local subcommands run against a small fixture database and archive. fetch-incrementally has no credentials,
+so it measures the time until the first API call would be made.
+"""
+from argparse import ArgumentParser
+from collections import OrderedDict
+from json import dump
+from os.path import abspath, dirname, join as path_join
+from shutil import rmtree
+from statistics import median
+from subprocess import run, DEVNULL, PIPE
+from tempfile import mkdtemp
+from time import perf_counter
+from types import SimpleNamespace
+
+import sys
+
+from gmail.scheduler import configure_scheduler
+
+from .corpus import Corpus
+from .results import compare, get_default_output, save_results
+from .scenarios import Environment, EMAIL
+
+RUN_PY = path_join(dirname(dirname(abspath(__file__))), 'run.py')
+
+# modules which only subcommands talking to Gmail should load.
+HEAVY_MODULES = ('googleapiclient', 'oauth2client', 'httplib2', 'pyTree', 'pytz')
+
+
+def get_subcommands(profile, mid):
+    mid = '%d' % mid
+
+    return OrderedDict([
+        ('create-profile', ['create-profile']),
+        ('query', ['query', '-p', profile, '-s', '2010-01']),
+        ('search', ['search', '-p', profile, '-s', 'coffee']),
+        ('export', ['export', '-p', profile, '-m', mid]),
+        ('view-diary', ['view-diary', '-p', profile, '-m', mid]),
+        ('message-structure', ['message-structure', '-p', profile, '-m', mid]),
+        ('fetch-incrementally', ['fetch-incrementally', '-p', profile]),
+    ])
+
+
+def prepare_fixture(workdir):
+    """
+    :return: tuple of (profile path, mid of an archived reply)
+    """
+    options = SimpleNamespace(latency=0.0, archive_messages=20, workers=1, batch_size=1, archive_format='loose',
+                              archive_codec='gzip')
+    env = Environment(workdir, Corpus(40), options)
+
+    configure_scheduler(EMAIL, 10 ** 9)
+    env.get_database()
+    env.close()
+
+    profile = path_join(workdir, 'profile.json')
+    with open(profile, 'w') as f:
+        dump({
+            'credential': path_join(workdir, 'credential.json'),
+            'database': env.get_path('diem.db'),
+            'storage': path_join(workdir, 'storage.json'),
+            'email': EMAIL,
+            'label-id': 'Label_1',
+            'archive-path': env.get_path('archives'),
+            'archive-format': 'loose',
+            'timezone': 'Asia/Seoul',
+        }, f)
+
+    return profile, env.get_sample_mids()[0]
+
+
+def measure(command, repeat):
+    """
+    :return: list of seconds, and the exit code of the last run.
+    """
+    seconds = []
+    code = None
+
+    for i in range(repeat):
+        begin = perf_counter()
+        code = run(command, stdout=DEVNULL, stderr=DEVNULL).returncode
+        seconds.append(perf_counter() - begin)
+
+    return seconds, code
+
+
+def get_imported_modules(command):
+    """
+    :return: names of modules the command imports, from the -X importtime report.
+    """
+    stderr = run([command[0], '-X', 'importtime'] + command[1:], stdout=DEVNULL, stderr=PIPE).stderr
+    modules = []
+
+    for line in stderr.decode('utf-8', 'replace').splitlines():
+        if line.startswith('import time:') and '|' in line:
+            name = line.rsplit('|', 1)[1].strip()
+            if name != 'package':
+                modules.append(name)
+
+    return modules
+
+
+def main():
+    parser = ArgumentParser(prog='python -m bench.startup', description='CLI startup benchmark, per subcommand.')
+    parser.add_argument('-r', '--repeat', default=10, type=int, help='Runs of each subcommand.')
+    parser.add_argument('-o', '--output', default=get_default_output('startup.json'), help='Result JSON file path. Default: %(default)s')
+    parser.add_argument('-c', '--compare', help='Result JSON file of a previous run to compare with.')
+    args = parser.parse_args()
+
+    workdir = mkdtemp(prefix='diem-startup-')
+    results = OrderedDict()
+
+    try:
+        profile, mid = prepare_fixture(workdir)
+        log_file = path_join(workdir, 'diem.log')
+
+        seconds, code = measure([sys.executable, '-c', 'pass'], args.repeat)
+        interpreter = min(seconds)
+        results['interpreter'] = OrderedDict([('seconds', round(interpreter, 6))])
+
+        for name, arguments in get_subcommands(profile, mid).items():
+            command = [sys.executable, RUN_PY, '-f', log_file, '-l', 'ERROR'] + arguments
+            seconds, code = measure(command, args.repeat)
+            modules = get_imported_modules(command)
+
+            result = OrderedDict()
+            result['seconds'] = round(min(seconds), 6)
+            result['median_seconds'] = round(median(seconds), 6)
+            result['over_interpreter_seconds'] = round(min(seconds) - interpreter, 6)
+            result['modules'] = len(modules)
+            result['heavy_modules'] = sorted(set(m.split('.')[0] for m in modules if m.startswith(HEAVY_MODULES)))
+            result['exit_code'] = code
+            results[name] = result
+
+            print('%-20s %8.1f ms  (+%6.1f ms over the interpreter)  %4d modules  %s' % (
+                name, result['seconds'] * 1000, result['over_interpreter_seconds'] * 1000, result['modules'],
+                ', '.join(result['heavy_modules'])
+            ))
+    finally:
+        rmtree(workdir, ignore_errors=True)
+
+    save_results(args.output, vars(args), results)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,7 @@ def get_args():
     # expand ~ as home directory
     filter_arg_values(
         args=args,
-        attributes=['log_file', 'dest_dir'],
+        attributes=['log_file', 'dest_dir', 'output', 'metrics_file'],
         decision_func=lambda v: len(v) > 1 and v[0] == '~',
         filter_func=expanduser
     )
@@ -28,11 +28,11 @@ def get_args():
         filter_func=lambda v: int(v, 16)
     )
 
-    # convert numerical date into int type
+    # convert numerical date into int type. 4 digits are a year, not a mid.
     filter_arg_values(
         args=args,
         attributes=['query_string', 'mid'],
-        decision_func=lambda v: v.isdigit(),
+        decision_func=lambda v: v.isdigit() and len(v) != 4,
         filter_func=lambda v: int(v)
     )
 
@@ -70,6 +70,9 @@ def build_parser():
     # query
     add_query_parser(subparsers)
 
+    # search
+    add_search_parser(subparsers)
+
     # fetch
     add_fetch_parser(subparsers)
 
@@ -79,9 +82,27 @@ def build_parser():
     # fix-missing
     add_fix_missing_parser(subparsers)
 
+    # reconcile
+    add_reconcile_parser(subparsers)
+
+    # reindex
+    add_reindex_parser(subparsers)
+
+    # migrate-archive
+    add_migrate_archive_parser(subparsers)
+
+    # compact-archive
+    add_compact_archive_parser(subparsers)
+
+    # recompress
+    add_recompress_parser(subparsers)
+
     # export
     add_export_parser(subparsers)
 
+    # bulk-export
+    add_bulk_export_parser(subparsers)
+
     # message-structure
     add_message_structure_parser(subparsers)
 
@@ -91,6 +112,12 @@ def build_parser():
     # extract-attachment
     add_extract_attachment_parser(subparsers)
 
+    # serve
+    add_serve_parser(subparsers)
+
+    # sync-all
+    add_sync_all_parser(subparsers)
+
     return parser
 
 
@@ -102,7 +129,7 @@ def filter_arg_values(args, attributes, decision_func, filter_func):
                 if decision_func(val):
                     setattr(args, attr, filter_func(val))
             elif type(val) == list:
-                r = [filter_func(x) if decision_func(x) else x for x in val]
+                r = [filter_func(x) if type(x) == str and decision_func(x) else x for x in val]
                 setattr(args, attr, r)
 
 
@@ -152,14 +179,22 @@ def add_update_database_parser(subparsers):
     p = add_subparser(subparsers, 'update-database', aliases=['ud'], help=message, description=message)
 
     add_profile_path_argument(p, required=True)
+    add_batch_size_argument(p)
+    add_date_source_argument(p)
+    add_sync_mode_argument(p)
 
 
 def add_rebuild_database_parser(subparsers):
-    message = 'Rebuild database. The same as \'drop-tables\' and \'update-database\'.'
+    message = 'Rebuild database. The same as \'drop-tables\' and \'update-database\', ' \
+              'but current tables are replaced only when the rebuild is completed.'
     p = add_subparser(subparsers, 'rebuild-database', aliases=['rd'], help=message, description=message)
 
     add_profile_path_argument(p, required=True)
     add_force_argument(p)
+    add_batch_size_argument(p)
+    add_date_source_argument(p)
+    p.add_argument('--resume', action='store_true', default=False,
+                   help='Continue an interrupted rebuild from its last checkpoint.')
 
 
 def add_query_parser(subparsers):
@@ -168,6 +203,19 @@ def add_query_parser(subparsers):
 
     add_profile_path_argument(p, required=True)
     add_query_string_argument(p, required=True)
+    p.add_argument('-l', '--limit', type=int, default=None, help='Maximum number of results.')
+    p.add_argument('--offset', type=int, default=0, help='Number of results to skip.')
+
+
+def add_search_parser(subparsers):
+    message = 'Full-text search of reply mails.'
+    p = add_subparser(subparsers, 'search', aliases=['s'], help=message, description=message)
+
+    add_profile_path_argument(p, required=True)
+    p.add_argument('-s', '--string', dest='search_string', required=True,
+                   help='FTS5 query. e.g. \'sunny walk\', \'"sunny walk"\', \'sun*\', \'sunny OR rainy\'')
+    p.add_argument('-l', '--limit', type=int, default=20, help='Maximum number of results.')
+    p.add_argument('--offset', type=int, default=0, help='Number of results to skip.')
 
 
 def add_fetch_parser(subparsers):
@@ -176,6 +224,9 @@ def add_fetch_parser(subparsers):
 
     add_profile_path_argument(p, required=True)
     add_mid_argument(p, required=True, nargs='+')
+    add_workers_argument(p)
+    add_batch_size_argument(p)
+    add_engine_argument(p)
 
 
 def add_fetch_incrementally_parser(subparsers):
@@ -183,6 +234,13 @@ def add_fetch_incrementally_parser(subparsers):
     p = add_subparser(subparsers, 'fetch-incrementally', aliases=['fi'], help=message, description=message)
 
     add_profile_path_argument(p, required=True)
+    add_workers_argument(p)
+    add_batch_size_argument(p)
+    add_engine_argument(p)
+    add_date_source_argument(p)
+    add_sync_mode_argument(p)
+    p.add_argument('--queue-size', type=int, default=4,
+                   help='Number of listing pages buffered between pipeline stages.')
 
 
 def add_fix_missing_parser(subparsers):
@@ -190,6 +248,51 @@ def add_fix_missing_parser(subparsers):
     p = add_subparser(subparsers, 'fix-missing', aliases=['fm'], help=message, description=message)
 
     add_profile_path_argument(p, required=True)
+    add_workers_argument(p)
+    add_batch_size_argument(p)
+    add_engine_argument(p)
+
+
+def add_reconcile_parser(subparsers):
+    message = 'Rebuild the archive manifest and MIME layout index from the archive path.'
+    p = add_subparser(subparsers, 'reconcile', aliases=['rc'], help=message, description=message)
+
+    add_profile_path_argument(p, required=True)
+
+
+def add_reindex_parser(subparsers):
+    message = 'Rebuild the full-text index from the archive.'
+    p = add_subparser(subparsers, 'reindex', aliases=['ri'], help=message, description=message)
+
+    add_profile_path_argument(p, required=True)
+
+
+def add_migrate_archive_parser(subparsers):
+    message = 'Move loose archive files into the pack archive.'
+    p = add_subparser(subparsers, 'migrate-archive', aliases=['ma'], help=message, description=message)
+
+    add_profile_path_argument(p, required=True)
+    p.add_argument('--remove-loose', action='store_true', default=False,
+                   help='Remove loose archive files after they are packed.')
+
+
+def add_compact_archive_parser(subparsers):
+    message = 'Compact the pack archive. Old copies of re-fetched messages are removed.'
+    p = add_subparser(subparsers, 'compact-archive', aliases=['ca'], help=message, description=message)
+
+    add_profile_path_argument(p, required=True)
+
+
+def add_recompress_parser(subparsers):
+    message = 'Encode the archive again with another codec.'
+    p = add_subparser(subparsers, 'recompress', aliases=['rz'], help=message, description=message)
+
+    add_profile_path_argument(p, required=True)
+    p.add_argument('-z', '--codec', default=None, choices=['gzip', 'zlib', 'lzma'],
+                   help='Archive codec. Defaults to the archive codec of the profile.')
+    p.add_argument('--train', action='store_true',
+                   help='Train a new zlib preset dictionary from a sample of the archive first. '
+                        'One is trained anyway if the archive has none.')
 
 
 def add_export_parser(subparsers):
@@ -201,6 +304,19 @@ def add_export_parser(subparsers):
     p.add_argument('--list-converters', action='store_true')
 
 
+def add_bulk_export_parser(subparsers):
+    message = 'Export reply mails as JSON Lines, in order of diary date.'
+    p = add_subparser(subparsers, 'bulk-export', aliases=['be'], help=message, description=message)
+
+    add_profile_path_argument(p, required=True)
+    add_mid_argument(p, nargs='+', default=None)
+    p.add_argument('-d', '--date-range', default=None,
+                   help='Export replies in the date range, like \'2015-01-01..2015-03-31\'. '
+                        'Either bound may be omitted. Ignored if --mid is given. All replies are exported by default.')
+    p.add_argument('-o', '--output', default='-', help='Output file path. \'-\' for the standard output.')
+    p.add_argument('-j', '--processes', type=int, default=1, help='Number of worker processes.')
+
+
 def add_message_structure_parser(subparsers):
     message = 'Analyze and visualize message structure'
     p = add_subparser(subparsers, 'message-structure', aliases=['ms'], help=message, description=message)
@@ -223,7 +339,11 @@ def add_extract_attachment_parser(subparsers):
     p = add_subparser(subparsers, 'extract-attachments', aliases=['ea'], help=message, description=message)
 
     add_profile_path_argument(p, required=True)
-    add_mid_argument(p, required=True)
+    add_mid_argument(p, nargs='+', default=None)
+    p.add_argument('--date-range', default=None,
+                   help='Extract from replies in the date range, like \'2015-01-01..2015-12-31\'. '
+                        'Either bound may be omitted. Ignored if --mid is given. '
+                        'With more than one message, files of each message go to a sub-directory named after its mid.')
 
     group = p.add_mutually_exclusive_group()
     group.add_argument('-i', '--attachment-id', nargs='+', help='Extract an individual attachment file')
@@ -232,6 +352,45 @@ def add_extract_attachment_parser(subparsers):
     p.add_argument('-d', '--dest-dir', default='.',
                    help='A directory where extracted files being stored. Notice that files will be overwritten!')
 
+    p.add_argument('--link', action='store_true',
+                   help='Hard link attachments split out into the attachment store, instead of copying them. '
+                        'Linked files are read-only.')
+
+
+def add_serve_parser(subparsers):
+    message = 'Serve diaries over a read-only HTTP API, for a web front end.'
+    p = add_subparser(subparsers, 'serve', help=message, description=message)
+
+    add_profile_path_argument(p, required=True)
+    p.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    p.add_argument('--port', default=8080, type=int, help='Port to listen on.')
+    p.add_argument('--cache-size', default=128, type=int,
+                   help='Megabytes of decompressed messages and converted diaries kept in memory.')
+    p.add_argument('-j', '--workers', default=4, type=int,
+                   help='Worker threads which decompress, parse and convert messages.')
+
+
+def add_sync_all_parser(subparsers):
+    message = 'Fetch incrementally for several profiles at once, and print a summary of them.'
+    p = add_subparser(subparsers, 'sync-all', aliases=['sa'], help=message, description=message)
+
+    p.add_argument('-p', '--profiles', nargs='+', required=True,
+                   help='Profile file paths, or directories of profile files. Every *.json file in a directory is '
+                        'a profile.')
+    p.add_argument('-j', '--jobs', type=int, default=4, help='Number of profiles synced concurrently.')
+    add_workers_argument(p)
+    p.add_argument('-m', '--max-requests', type=int, default=32,
+                   help='Number of requests in flight across all profiles at most, listing, date and archive requests '
+                        'alike. Each profile synced concurrently gets an equal share of them as workers, '
+                        'up to --workers.')
+    add_batch_size_argument(p)
+    add_engine_argument(p)
+    add_date_source_argument(p)
+    add_sync_mode_argument(p)
+    p.add_argument('--queue-size', type=int, default=4,
+                   help='Number of listing pages buffered between pipeline stages.')
+
+
 # end of subparsers ##############################################################################################
 
 
@@ -246,11 +405,54 @@ def add_query_string_argument(parser, **kwargs):
     parser.add_argument('-s', '--string', dest='query_string',
                         help='Query string. '
                              'It can be an integer, a hexadecimal, or a date string in yyyy-mm-dd format. '
+                             'yyyy-mm and yyyy query a month and a year, '
+                             'yyyy-mm-dd..yyyy-mm-dd queries a date range whose either bound may be omitted, '
+                             'mm-dd queries the day across years, and \'today\' queries today across years. '
                              'Otherwise input \'latest\' string to get the latest, '
                              'or input \'all\' to dump all entries.',
                         **kwargs)
 
 
+def add_workers_argument(parser, **kwargs):
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of concurrent download workers. Each worker opens its own HTTP connection.',
+                        **kwargs)
+
+
+def add_engine_argument(parser, **kwargs):
+    parser.add_argument('--engine', default='threads', choices=['threads', 'asyncio'],
+                        help='Download engine. threads: a worker thread per download. '
+                             'asyncio: all downloads on one thread, with --workers keep-alive connections, '
+                             'so it may be in the hundreds.',
+                        **kwargs)
+
+
+def add_batch_size_argument(parser, **kwargs):
+    parser.add_argument('-b', '--batch-size', type=int, default=1,
+                        help='Number of messages fetched in a single batch request, up to 100. '
+                             '1 disables batch requests.',
+                        **kwargs)
+
+
+def add_date_source_argument(parser, **kwargs):
+    parser.add_argument('--date-source', default='raw', choices=['raw', 'metadata', 'internal-date'],
+                        help='Where to read diary dates of alarm mails. '
+                             '\'raw\' downloads the whole message and reads its first \'Date:\' line, '
+                             '\'metadata\' requests the parsed \'Date\' header only, which is much faster, '
+                             'though a few messages, like ones with a folded \'Date\' header, may get another date '
+                             'than with \'raw\', '
+                             'and \'internal-date\' uses the time Gmail received the message.',
+                        **kwargs)
+
+
+def add_sync_mode_argument(parser, **kwargs):
+    parser.add_argument('--sync-mode', default='history', choices=['history', 'list'],
+                        help='\'history\' fetches only messages added since the last sync using Gmail history, '
+                             'and falls back to \'list\' if the last history is not available. '
+                             '\'list\' lists the message box until the latest message in the database.',
+                        **kwargs)
+
+
 def add_mid_argument(parser, **kwargs):
     parser.add_argument('-m', '--mid', help='Specify a email message id (mid) value.', **kwargs)
 
@@ -263,6 +465,10 @@ def add_common_arguments(parser):
     parser.add_argument('-l', '--log-level', default='INFO',
                         choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG', ], help='Log level')
 
+    parser.add_argument('--metrics-file',
+                        help='Write metrics of the run to this file, in the Prometheus text format, '
+                             'for the textfile collector of node-exporter. The file name should end with \'.prom\'.')
+
 
 def add_profile_arguments(parser):
     parser.add_argument('-c', '--credential', default='./credential.json', help='Credential file path')
@@ -277,8 +483,24 @@ def add_profile_arguments(parser):
 
     parser.add_argument('-x', '--archive-path', default='archives/', help='MIME Message archive path')
 
+    parser.add_argument('-a', '--archive-format', default='loose', choices=['loose', 'pack'],
+                        help='MIME Message archive format. \'loose\' stores each message as its own gzip file. '
+                             '\'pack\' appends messages to large segment files.')
+
+    parser.add_argument('-z', '--archive-codec', default='gzip', choices=['gzip', 'zlib', 'lzma'],
+                        help='MIME Message archive codec. \'zlib\' compresses with a preset dictionary trained from '
+                             'the archive, and \'lzma\' compresses the best, but slowly.')
+
+    parser.add_argument('--split-attachments', action='store_true',
+                        help='Split attachments out of messages into a content-addressed store in the archive, '
+                             'so that the same file is stored once.')
+
     parser.add_argument('-t', '--timezone', default='UTC', help='Timezone for diary date')
 
+    parser.add_argument('--quota-units', default=250, type=int,
+                        help='Gmail API quota units per second to spend for the account. '
+                             'Requests are throttled to stay within it.')
+
 
 def add_profile_path_argument(parser, **kwargs):
     parser.add_argument('-p', '--profile', default='./profile.json',
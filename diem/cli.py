@@ -1,17 +1,16 @@
 from collections import OrderedDict
 from logging import getLogger
 from json import dumps, load
-from os.path import exists, expanduser
-from pytz import timezone, utc
-from sys import exit
-
-from pyTree.Tree import Tree
+from os.path import exists, expanduser, isdir, join as path_join
+from sys import exit, stderr, stdout
+from time import perf_counter
 
 from . import diem, get_absolute_path
 from .args import get_args
 from .db import open_db
 from .logging import set_dict_config
-from .converters import DiaryTemplateFactory
+
+from gmail.metrics import metrics
 
 logger = getLogger(__name__)
 
@@ -27,10 +26,16 @@ class DiemCLI(object):
 
         set_dict_config(self.args.log_level, self.args.log_file)
 
+    @property
+    def timezone(self):
+        # pytz, pyTree, converters, and Gmail libraries are imported only by subcommands which use them,
+        # so that local subcommands start fast.
+        from pytz import timezone, utc
+
         if self.profile and 'timezone' in self.profile:
-            self.timezone = timezone(self.profile['timezone'])
+            return timezone(self.profile['timezone'])
         else:
-            self.timezone = utc
+            return utc
 
     def confirm_cli(self, message):
         if hasattr(self.args, 'force') and not self.args.force:
@@ -44,6 +49,37 @@ class DiemCLI(object):
         return True
 
     def run(self):
+        """
+        Run the subcommand, and report its metrics.
+        """
+        metrics.set_constant_label('subcommand', self.args.subcommand)
+
+        begin = perf_counter()
+        success = False
+
+        try:
+            self.run_subcommand()
+            success = True
+
+        except SystemExit as e:
+            success = not e.code
+            raise
+
+        finally:
+            if not success:
+                metrics.increment('errors_total')
+
+            metrics.finish_run(perf_counter() - begin, success)
+            self.report_metrics()
+
+    def report_metrics(self):
+        if not metrics.is_empty():
+            logger.info('Run summary:\n' + '\n'.join(metrics.get_summary()))
+
+        if self.args.metrics_file:
+            metrics.write_textfile(self.args.metrics_file)
+
+    def run_subcommand(self):
 
         logger.debug('arguments: ' + str(self.args))
         logger.debug('profile: ' + str(self.profile))
@@ -54,6 +90,9 @@ class DiemCLI(object):
         else:
             conn = None
 
+        if self.profile and self.profile.get('quota-units'):
+            diem.set_quota(self.profile['email'], self.profile['quota-units'])
+
         # subcommand process #########################################################################################
 
         # authorize
@@ -84,32 +123,61 @@ class DiemCLI(object):
                 conn=conn,
                 storage=self.profile['storage'],
                 email=self.profile['email'],
-                label_id=self.profile['label-id']
+                label_id=self.profile['label-id'],
+                batch_size=self.args.batch_size,
+                date_source=self.args.date_source,
+                sync_mode=self.args.sync_mode
             )
 
         # rebuild-structure
         elif self.args.subcommand in ('rebuild-database', 'rd'):
-            if self.confirm_cli('You are going to recreate the db tables. Proceed?'):
+            # a resumed rebuild continues the one already confirmed, and changes nothing until it completes.
+            if self.args.resume or self.confirm_cli('You are going to recreate the db tables. Proceed?'):
                 diem.rebuild_database(
                     conn=conn,
                     storage=self.profile['storage'],
                     email=self.profile['email'],
-                    label_id=self.profile['label-id']
+                    label_id=self.profile['label-id'],
+                    batch_size=self.args.batch_size,
+                    date_source=self.args.date_source,
+                    resume=self.args.resume
                 )
 
         # query
         elif self.args.subcommand in ('query', 'q'):
             response = diem.query(
                 conn=conn,
-                query_string=self.args.query_string
+                query_string=self.args.query_string,
+                limit=self.args.limit,
+                offset=self.args.offset,
+                timezone=self.timezone
+            )
+
+            count = 0
+            for mid, tid, diary_date in response:
+                if not count:
+                    print('MID\t\t\t\t\t\tTID\t\t\t\t\t\tDIARY DATE')
+                print('{0} (0x{0:x})\t{1} (0x{1:x})\t{2}'.format(mid, tid, diary_date, ))
+                count += 1
+
+            if not count:
+                print('No result.')
+
+        # search
+        elif self.args.subcommand in ('search', 's'):
+            response = diem.search(
+                conn=conn,
+                search_string=self.args.search_string,
+                limit=self.args.limit,
+                offset=self.args.offset
             )
 
             if not response:
                 print('No result.')
             else:
-                print('MID\t\t\t\t\t\tTID\t\t\t\t\t\tDIARY DATE')
-                for mid, tid, diary_date in response:
-                    print('{0} (0x{0:x})\t{1} (0x{1:x})\t{2}'.format(mid, tid, diary_date, ))
+                print('MID\t\t\t\t\t\tDIARY DATE\tSNIPPET')
+                for mid, diary_date, snippet in response:
+                    print('{0} (0x{0:x})\t{1}\t{2}'.format(mid, diary_date, ' '.join(snippet.split())))
 
         # fetch
         elif self.args.subcommand in ('fetch', 'f'):
@@ -117,7 +185,14 @@ class DiemCLI(object):
                 storage=self.profile['storage'],
                 email=self.profile['email'],
                 archive_path=self.profile['archive-path'],
-                mid_list=self.args.mid
+                mid_list=self.args.mid,
+                workers=self.args.workers,
+                batch_size=self.args.batch_size,
+                archive_format=self.profile.get('archive-format', 'loose'),
+                conn=conn,
+                archive_codec=self.profile.get('archive-codec', 'gzip'),
+                split_attachments=self.profile.get('split-attachments', False),
+                engine=self.args.engine
             )
 
         # fetch-incrementally
@@ -127,7 +202,16 @@ class DiemCLI(object):
                 storage=self.profile['storage'],
                 email=self.profile['email'],
                 label_id=self.profile['label-id'],
-                archive_path=self.profile['archive-path']
+                archive_path=self.profile['archive-path'],
+                workers=self.args.workers,
+                batch_size=self.args.batch_size,
+                date_source=self.args.date_source,
+                queue_size=self.args.queue_size,
+                sync_mode=self.args.sync_mode,
+                archive_format=self.profile.get('archive-format', 'loose'),
+                archive_codec=self.profile.get('archive-codec', 'gzip'),
+                split_attachments=self.profile.get('split-attachments', False),
+                engine=self.args.engine
             )
 
         # fix-missing
@@ -136,7 +220,38 @@ class DiemCLI(object):
                 conn=conn,
                 storage=self.profile['storage'],
                 email=self.profile['email'],
-                archive_path=self.profile['archive-path']
+                archive_path=self.profile['archive-path'],
+                workers=self.args.workers,
+                batch_size=self.args.batch_size,
+                archive_format=self.profile.get('archive-format', 'loose'),
+                archive_codec=self.profile.get('archive-codec', 'gzip'),
+                split_attachments=self.profile.get('split-attachments', False),
+                engine=self.args.engine
+            )
+
+        # reconcile
+        elif self.args.subcommand in ('reconcile', 'rc'):
+            diem.reconcile(conn, self.profile['archive-path'])
+
+        # reindex
+        elif self.args.subcommand in ('reindex', 'ri'):
+            diem.reindex(conn, self.profile['archive-path'])
+
+        # migrate-archive
+        elif self.args.subcommand in ('migrate-archive', 'ma'):
+            diem.migrate_archive(self.profile['archive-path'], self.args.remove_loose)
+
+        # compact-archive
+        elif self.args.subcommand in ('compact-archive', 'ca'):
+            diem.compact_archive(self.profile['archive-path'])
+
+        # recompress
+        elif self.args.subcommand in ('recompress', 'rz'):
+            diem.recompress(
+                conn=conn,
+                archive_path=self.profile['archive-path'],
+                codec=self.args.codec or self.profile.get('archive-codec', 'gzip'),
+                train=self.args.train
             )
 
         # export
@@ -152,26 +267,119 @@ class DiemCLI(object):
                     timezone=self.timezone
                 )
 
+                from .converters import DiaryTemplateFactory
                 print(DiaryTemplateFactory.as_json(exported, indent=2))
 
+        # bulk-export
+        elif self.args.subcommand in ('bulk-export', 'be'):
+            if self.args.date_range:
+                date_from, date_to = diem.parse_date_range(self.args.date_range)
+            else:
+                date_from, date_to = None, None
+
+            if self.args.output == '-':
+                output = stdout
+            else:
+                output = open(self.args.output, 'w', encoding='utf-8')
+
+            try:
+                count, failed, written, elapsed = diem.bulk_export(
+                    conn=conn,
+                    database=self.profile['database'],
+                    archive_path=self.profile['archive-path'],
+                    timezone=self.timezone,
+                    output=output,
+                    processes=self.args.processes,
+                    mid_list=self.args.mid,
+                    date_from=date_from,
+                    date_to=date_to
+                )
+            finally:
+                if output is not stdout:
+                    output.close()
+
+            # the summary goes to stderr, so that it is shown at any log level, and is not mixed with '-o -'.
+            print(
+                '%d replies, %d bytes exported in %.3f sec (%.1f replies/sec, %.1f KiB/sec). %d failed.' % (
+                    count, written, elapsed, count / elapsed if elapsed else 0,
+                    written / 1024 / elapsed if elapsed else 0, failed
+                ),
+                file=stderr
+            )
+
+            if failed:
+                exit(1)
+
         # message-structure
         elif self.args.subcommand in ('message-structure', 'ms'):
-            structure = diem.message_structure(self.args.mid, self.profile['archive-path'])
+            structure = diem.message_structure(self.args.mid, self.profile['archive-path'], conn)
             self.print_message_structure(structure)
 
         # view-diary
         elif self.args.subcommand in ('view-diary', 'vd'):
-            diary_content = diem.view_diary(self.args.mid, self.profile['archive-path'], self.args.content_type)
+            diary_content = diem.view_diary(self.args.mid, self.profile['archive-path'], self.args.content_type, conn)
             print(diary_content)
 
         # extract-attachment
         elif self.args.subcommand in ('extract-attachments', 'ea'):
-            if self.args.all:
+            if self.args.all or not self.args.attachment_id:
                 attachment_ids = 'all'
             else:
                 attachment_ids = self.args.attachment_id
 
-            diem.extract_attachments(self.args.mid, self.profile['archive-path'], attachment_ids, self.args.dest_dir)
+            if self.args.mid:
+                date_from, date_to = None, None
+            elif self.args.date_range:
+                date_from, date_to = diem.parse_date_range(self.args.date_range)
+            else:
+                raise Exception('Either --mid or --date-range is required.')
+
+            count, failed = diem.extract_attachments(
+                self.args.mid,
+                self.profile['archive-path'],
+                attachment_ids,
+                self.args.dest_dir,
+                conn,
+                self.args.link,
+                date_from,
+                date_to
+            )
+
+            if failed:
+                exit(1)
+
+        # serve
+        elif self.args.subcommand == 'serve':
+            diem.serve(
+                conn=conn,
+                archive_path=self.profile['archive-path'],
+                timezone=self.timezone,
+                host=self.args.host,
+                port=self.args.port,
+                cache_size=self.args.cache_size * 1024 * 1024,
+                workers=self.args.workers
+            )
+
+        # sync-all
+        elif self.args.subcommand in ('sync-all', 'sa'):
+            profiles = [(path, self.read_profile(path)) for path in self.get_profile_paths(self.args.profiles)]
+
+            results = diem.sync_all(
+                profiles=profiles,
+                jobs=self.args.jobs,
+                workers=self.args.workers,
+                batch_size=self.args.batch_size,
+                date_source=self.args.date_source,
+                queue_size=self.args.queue_size,
+                sync_mode=self.args.sync_mode,
+                engine=self.args.engine,
+                max_requests=self.args.max_requests
+            )
+
+            self.print_sync_summary(results)
+
+            if not all(result['success'] for result in results):
+                exit(1)
 
         # END of task
 
@@ -188,7 +396,11 @@ class DiemCLI(object):
         profile['email'] = self.args.email
         profile['label-id'] = self.args.label_id
         profile['archive-path'] = self.args.archive_path
+        profile['archive-format'] = self.args.archive_format
+        profile['archive-codec'] = self.args.archive_codec
+        profile['split-attachments'] = self.args.split_attachments
         profile['timezone'] = self.args.timezone
+        profile['quota-units'] = self.args.quota_units
 
         print(dumps(profile, indent=2))
 
@@ -210,6 +422,49 @@ class DiemCLI(object):
 
         return profile_obj
 
+    @staticmethod
+    def get_profile_paths(paths):
+        """
+        :param paths: profile file paths, or directories of them.
+        :return: list of profile file paths. Profiles of a directory are its *.json files, in name order.
+        """
+        from glob import glob
+
+        profile_paths = []
+
+        for path in paths:
+            path = expanduser(path)
+            if isdir(path):
+                found = sorted(glob(path_join(path, '*.json')))
+                if not found:
+                    print('No profile in %s!' % path)
+                    exit(1)
+                profile_paths.extend(found)
+            else:
+                profile_paths.append(path)
+
+        return profile_paths
+
+    @staticmethod
+    def print_sync_summary(results):
+        print('PROFILE\tEMAIL\tSTATUS\tINDEXED\tARCHIVED\tERRORS\tSECONDS')
+
+        for result in results:
+            print('%s\t%s\t%s\t%d\t%d\t%d\t%.3f' % (
+                result['name'], result['email'], 'ok' if result['success'] else 'FAILED', result['items'],
+                result['archived'], result['errors'], result['seconds']
+            ))
+
+        failed = [result for result in results if not result['success']]
+
+        print('Total %d profile(s), %d failed. %d item(s) indexed, %d message(s) archived, error %d message(s).' % (
+            len(results), len(failed), sum(result['items'] for result in results),
+            sum(result['archived'] for result in results), sum(result['errors'] for result in results)
+        ))
+
+        for result in failed:
+            print('%s failed: %s' % (result['name'], result['message']))
+
     @classmethod
     def print_message_structure(cls, structure):
         e = cls.message_structure_recursively(structure)
@@ -217,6 +472,8 @@ class DiemCLI(object):
 
     @classmethod
     def message_structure_recursively(cls, structure):
+        from pyTree.Tree import Tree
+
         if type(structure) == dict and 'parts' in structure:
             current_node = Tree(structure['content-type'])
             for part in structure['parts']:
@@ -2,7 +2,8 @@ from datetime import datetime, date
 from email import message_from_string, message_from_bytes
 from email.utils import mktime_tz, parsedate_tz
 from json import dumps
-from copy import deepcopy
+
+from .mimeindex import IndexedPart
 
 
 class DiaryTemplateFactory(object):
@@ -18,13 +19,23 @@ class DiaryTemplateFactory(object):
 
     @classmethod
     def as_json(cls, obj, **kwargs):
-        obj_copy = deepcopy(obj)
-        for key in obj_copy:
-            if type(obj_copy[key]) == datetime:
-                obj_copy[key] = obj_copy[key].strftime('%Y-%m-%d %H:%M:%S %Z')
-            elif type(obj_copy[key]) == date:
-                obj_copy[key] = obj_copy[key].strftime('%Y-%m-%d')
-        return dumps(obj_copy, **kwargs)
+        return dumps(cls.as_serializable(obj), **kwargs)
+
+    @classmethod
+    def as_serializable(cls, obj):
+        """
+        Shallow copy of obj with its date values formatted.
+        Only top level values are dates, so nested values are shared with obj, not copied.
+        """
+        output = {}
+        for key, value in obj.items():
+            if type(value) == datetime:
+                output[key] = value.strftime('%Y-%m-%d %H:%M:%S %Z')
+            elif type(value) == date:
+                output[key] = value.strftime('%Y-%m-%d')
+            else:
+                output[key] = value
+        return output
 
 
 class DefaultJSONConverter(object):
@@ -39,6 +50,8 @@ class DefaultJSONConverter(object):
             return message_from_bytes(message)
         elif type(message) == str:
             return message_from_string(message)
+        elif isinstance(message, IndexedPart):
+            return message
         else:
             raise Exception('Parse failed!')
 
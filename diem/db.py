@@ -1,38 +1,276 @@
+from contextlib import contextmanager
+from functools import wraps
+from logging import getLogger
+
+from gmail.metrics import metrics
+
 import sqlite3
 
 
+logger = getLogger(__name__)
+
+# seconds to wait for a lock held by another process, e.g. a cron job syncing while a query runs.
+BUSY_TIMEOUT = 30.0
+
+# number of prepared statements cached per connection.
+STATEMENT_CACHE_SIZE = 256
+
+
+class DiemStore(sqlite3.Connection):
+    """
+    Connection to the diem database.
+
+    Helpers of this module commit their changes by default. Inside a transaction() scope, commit() is deferred to
+    the end of the outermost scope, so that a series of helper calls is committed once, or not at all.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DiemStore, self).__init__(*args, **kwargs)
+        self.transaction_depth = 0
+
+    @contextmanager
+    def transaction(self):
+        """
+        Transaction scope. Scopes may be nested; only the outermost one commits, or rolls back on an exception.
+        The write lock is taken when the scope begins, so a concurrent writer waits for the busy timeout
+        instead of failing in the middle of the scope.
+        """
+        if not self.transaction_depth:
+            if self.in_transaction:
+                super(DiemStore, self).commit()
+            self.execute('BEGIN IMMEDIATE')
+
+        self.transaction_depth += 1
+
+        try:
+            yield self
+        except BaseException:
+            self.transaction_depth -= 1
+            if not self.transaction_depth:
+                self.rollback()
+            raise
+
+        self.transaction_depth -= 1
+        if not self.transaction_depth:
+            with metrics.timer('db_write_seconds', operation='commit'):
+                super(DiemStore, self).commit()
+
+    def commit(self):
+        if not self.transaction_depth:
+            with metrics.timer('db_write_seconds', operation='commit'):
+                super(DiemStore, self).commit()
+
+    def get_schema_version(self):
+        return self.execute('PRAGMA user_version').fetchone()[0]
+
+    def set_schema_version(self, version):
+        # PRAGMA statements do not take parameters.
+        self.execute('PRAGMA user_version = %d' % version)
+
+
+def timed_write(function):
+    """
+    Record the time of a write helper in the 'db_write_seconds' metric, by its name. Commits are recorded apart.
+    """
+    @wraps(function)
+    def _wrapper(*args, **kwargs):
+        with metrics.timer('db_write_seconds', operation=function.__name__):
+            return function(*args, **kwargs)
+
+    return _wrapper
+
+
 def open_db(db_name):
-    return sqlite3.connect(db_name)
+    """
+    Open the database in WAL mode, so that readers and a writer do not block each other,
+    and bring its schema up to date if it has any diem table.
+    """
+    conn = sqlite3.connect(
+        db_name,
+        timeout=BUSY_TIMEOUT,
+        factory=DiemStore,
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+
+    conn.execute('PRAGMA journal_mode = WAL')
+
+    # in WAL mode, a crash may lose the last transactions but never corrupts the database.
+    conn.execute('PRAGMA synchronous = NORMAL')
+
+    if conn.get_schema_version() or has_table(conn, 'diem_id_index'):
+        migrate(conn)
+
+    return conn
+
+
+def has_table(conn, table_name):
+    query = "SELECT COUNT(*) FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?"
+    return conn.execute(query, (table_name, )).fetchone()[0] > 0
+
+
+def get_db_file(conn):
+    """
+    :return: path of the database file of the connection. Empty for an in-memory database.
+    """
+    return conn.execute('PRAGMA database_list').fetchone()[2]
+
+
+def get_migrations():
+    """
+    Schema migrations. The database is at version n after the first n migrations are applied.
+    Append a new migration to change the schema; never edit the ones already released.
+
+    Every statement is idempotent, so a database created before versioning is migrated from version 0.
+    """
+    return [
+        # 1: indices of mails
+        get_index_table_queries() + [
+            'CREATE INDEX IF NOT EXISTS tid_index ON diem_id_index(tid)',
+        ],
+
+        # 2: sync state
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS diem_sync_state (
+              name            TEXT PRIMARY KEY,
+              value           TEXT
+            )
+            ''',
+        ],
+
+        # 3: archive manifest
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS diem_archive_manifest (
+              mid             INTEGER PRIMARY KEY,
+              size            INTEGER,
+              compressed_size INTEGER,
+              checksum        TEXT,
+              archived        TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+        ],
+
+        # 4: MIME layout index
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS diem_mime_parts (
+              mid             INTEGER,
+              seq             INTEGER,
+              part            TEXT,
+              parent          TEXT,
+              content_type    TEXT,
+              charset         TEXT,
+              encoding        TEXT,
+              file_name       TEXT,
+              x_attachment_id TEXT,
+              content_id      TEXT,
+              date            TEXT,
+              header_offset   INTEGER,
+              body_offset     INTEGER,
+              body_length     INTEGER,
+              PRIMARY KEY (mid, seq)
+            )
+            ''',
+        ],
+
+        # 5: full-text index. rowid is the mid of a reply mail
+        [
+            '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS diem_fulltext USING fts5 (
+              content,
+              tokenize = 'unicode61'
+            )
+            ''',
+        ],
+
+        # 6: date queries
+        get_index_queries(),
+
+        # 7: attachments split out into the attachment store of the archive
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS diem_attachments (
+              mid             INTEGER,
+              part            TEXT,
+              attachment_id   TEXT,
+              file_name       TEXT,
+              hash            TEXT,
+              PRIMARY KEY (mid, part)
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS attachment_hash_index ON diem_attachments(hash)',
+        ],
+    ]
+
+
+def migrate(conn):
+    """
+    Apply migrations the database has not applied yet, each in its own transaction.
+    Tables and indexes are added in place, without rebuilding the database.
+    """
+    migrations = get_migrations()
+    version = conn.get_schema_version()
+
+    if version > len(migrations):
+        raise Exception('Database schema version %d is newer than this diem supports (%d).' %
+                        (version, len(migrations)))
+
+    for number, queries in enumerate(migrations[version:], start=version + 1):
+        with conn.transaction():
+            for query in queries:
+                conn.execute(query)
+            conn.set_schema_version(number)
+
+        logger.info('Database schema migrated to version %d.', number)
+
+    return conn
 
 
 def create_tables(conn):
-    queries = [
+    return migrate(conn)
+
+
+def get_index_table_queries(suffix=''):
+    return [
         '''
-        CREATE TABLE IF NOT EXISTS diem_date_index (
+        CREATE TABLE IF NOT EXISTS diem_date_index%s (
           tid             INTEGER PRIMARY KEY,
           diary_date      DATE
         )
-        ''',
+        ''' % suffix,
 
         '''
-        CREATE TABLE IF NOT EXISTS diem_id_index (
+        CREATE TABLE IF NOT EXISTS diem_id_index%s (
           mid             INTEGER PRIMARY KEY,
           tid             INTEGER
         )
-        ''',
-
-        '''
-        CREATE INDEX IF NOT EXISTS tid_index ON diem_id_index(tid)
-        '''
+        ''' % suffix,
     ]
 
-    return execute_and_commit(conn, queries)
+
+def get_index_queries():
+    return [
+        'CREATE INDEX IF NOT EXISTS tid_index ON diem_id_index(tid)',
+
+        # date, month, year and range queries
+        'CREATE INDEX IF NOT EXISTS diary_date_index ON diem_date_index(diary_date)',
+
+        # 'on this day' queries: diary dates of the same month and day across years
+        'CREATE INDEX IF NOT EXISTS diary_month_day_index ON diem_date_index(substr(diary_date, 6))',
+    ]
 
 
 def drop_tables(conn):
     queries = [
         'DROP TABLE diem_date_index',
         'DROP TABLE diem_id_index',
+        'DROP TABLE IF EXISTS diem_sync_state',
+        'DROP TABLE IF EXISTS diem_archive_manifest',
+        'DROP TABLE IF EXISTS diem_mime_parts',
+        'DROP TABLE IF EXISTS diem_fulltext',
+        'DROP TABLE IF EXISTS diem_attachments',
+        'PRAGMA user_version = 0',
     ]
 
     return execute_and_commit(conn, queries)
@@ -61,26 +299,419 @@ def get_latest_mid(conn):
     return mid
 
 
-def update_date_index(conn, dates):
+def begin_rebuild(conn):
+    """
+    Start a journaled rebuild from scratch.
+    Indices are rebuilt into '_rebuild' suffixed tables, while the current tables are kept until finish_rebuild().
+    Each completed listing page is recorded in diem_rebuild_checkpoint.
+    """
+    queries = [
+        'DROP TABLE IF EXISTS diem_date_index_rebuild',
+        'DROP TABLE IF EXISTS diem_id_index_rebuild',
+        'DROP TABLE IF EXISTS diem_rebuild_checkpoint',
+    ] + get_index_table_queries('_rebuild') + [
+        '''
+        CREATE TABLE diem_rebuild_checkpoint (
+          page            INTEGER PRIMARY KEY,
+          page_token      TEXT,
+          next_page_token TEXT,
+          items           INTEGER,
+          dates           INTEGER,
+          created         TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+    ]
+
+    create_tables(conn)
+
+    return execute_and_commit(conn, queries)
+
+
+def get_rebuild_checkpoint(conn):
+    """
+    Get the last checkpoint of an unfinished rebuild.
+
+    :return: tuple of (page number, next page token), or None if there is no rebuild to resume.
+             The next page token is '' if all pages are already listed.
+    """
+    exists = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='diem_rebuild_checkpoint'"
+    ).fetchone()[0]
+
+    if not exists:
+        return None
+
+    return conn.execute(
+        'SELECT page, next_page_token FROM diem_rebuild_checkpoint ORDER BY page DESC LIMIT 1'
+    ).fetchone()
+
+
+@timed_write
+def save_rebuild_page(conn, page, page_token, next_page_token, structure, dates):
+    """
+    Write a listing page and its diary dates to the rebuild tables, and record the page as a checkpoint,
+    in a single transaction.
+    """
+    c = conn.cursor()
+
+    c.executemany(
+        'INSERT OR REPLACE INTO diem_id_index_rebuild (mid, tid) VALUES (?, ?)',
+        [(mid, tid) for mid, tid in structure if mid != tid]
+    )
+
+    c.executemany(
+        'INSERT OR REPLACE INTO diem_date_index_rebuild (tid, diary_date) VALUES (?, ?)',
+        [(tid, date) for tid, date in dates.items()]
+    )
+
+    c.execute(
+        'INSERT INTO diem_rebuild_checkpoint (page, page_token, next_page_token, items, dates) VALUES (?, ?, ?, ?, ?)',
+        (page, page_token, next_page_token, len(structure), len(dates))
+    )
+
+    conn.commit()
+
+
+def finish_rebuild(conn, history_id):
+    """
+    Swap the rebuilt tables in place of the current ones, atomically.
+    """
+    queries = [
+        'DROP TABLE IF EXISTS diem_date_index',
+        'DROP TABLE IF EXISTS diem_id_index',
+        'ALTER TABLE diem_date_index_rebuild RENAME TO diem_date_index',
+        'ALTER TABLE diem_id_index_rebuild RENAME TO diem_id_index',
+    ] + get_index_queries() + [
+        'DROP TABLE diem_rebuild_checkpoint',
+    ]
+
+    with conn.transaction():
+        for query in queries:
+            conn.execute(query)
+        set_history_id(conn, history_id)
+        delete_sync_state(conn, 'rebuild_history_id')
+
+
+def get_sync_state(conn, name):
+    row = conn.execute('SELECT value FROM diem_sync_state WHERE name=?', (name, )).fetchone()
+    if row:
+        return row[0]
+
+
+def set_sync_state(conn, name, value, commit=True):
+    conn.execute('INSERT OR REPLACE INTO diem_sync_state (name, value) VALUES (?, ?)', (name, value))
+
+    if commit:
+        conn.commit()
+
+
+def delete_sync_state(conn, name, commit=True):
+    conn.execute('DELETE FROM diem_sync_state WHERE name=?', (name, ))
+
+    if commit:
+        conn.commit()
+
+
+def get_history_id(conn):
+    """
+    Get the mailbox history id stored at the last sync. None if not stored yet.
+    """
+    value = get_sync_state(conn, 'history_id')
+    if value:
+        return int(value)
+
+
+def set_history_id(conn, history_id, commit=True):
+    set_sync_state(conn, 'history_id', str(history_id), commit)
+
+
+def update_archive_manifest(conn, records, commit=True):
+    """
+    :param records: list of tuples: (mid, size, compressed_size, checksum)
+    """
+    conn.executemany(
+        'INSERT OR REPLACE INTO diem_archive_manifest (mid, size, compressed_size, checksum) VALUES (?, ?, ?, ?)',
+        records
+    )
+
+    if commit:
+        conn.commit()
+
+
+def update_compressed_sizes(conn, sizes, commit=True):
+    """
+    :param sizes: list of (mid, compressed_size)
+    """
+    conn.executemany(
+        'UPDATE diem_archive_manifest SET compressed_size = ? WHERE mid = ?',
+        [(compressed_size, mid) for mid, compressed_size in sizes]
+    )
+
+    if commit:
+        conn.commit()
+
+
+@timed_write
+def save_message_indices(conn, indices, commit=True):
+    """
+    Write what diem.indexer.index_message() describes about archived messages.
+    """
+    update_archive_manifest(conn, [index['manifest'] for index in indices], commit=False)
+
+    for index in indices:
+        update_mime_parts(conn, index['mid'], index['parts'], commit=False)
+
+    update_fulltext(conn, [(index['mid'], index['text']) for index in indices], commit=False)
+
+    update_attachments(conn, [index['mid'] for index in indices],
+                       [attachment for index in indices for attachment in index['attachments']], commit=False)
+
+    if commit:
+        conn.commit()
+
+
+def clear_message_indices(conn, commit=True):
+    conn.execute('DELETE FROM diem_archive_manifest')
+    conn.execute('DELETE FROM diem_mime_parts')
+    conn.execute('DELETE FROM diem_fulltext')
+    conn.execute('DELETE FROM diem_attachments')
+
+    if commit:
+        conn.commit()
+
+
+def update_attachments(conn, mids, attachments, commit=True):
+    """
+    Replace split attachments of messages.
+
+    :param mids: list of mids whose split attachments are replaced.
+    :param attachments: list of (mid, part, attachment_id, file_name, hash)
+    """
+    conn.executemany('DELETE FROM diem_attachments WHERE mid = ?', [(mid, ) for mid in mids])
+    conn.executemany(
+        'INSERT INTO diem_attachments (mid, part, attachment_id, file_name, hash) VALUES (?, ?, ?, ?, ?)',
+        attachments
+    )
+
+    if commit:
+        conn.commit()
+
+
+def get_attachment_hashes(conn, mid):
+    """
+    :return: dict of part --> hash, of attachments split out of the message.
+    """
+    return dict(conn.execute('SELECT part, hash FROM diem_attachments WHERE mid = ?', (mid, )))
+
+
+def update_fulltext(conn, texts, commit=True):
+    """
+    :param texts: list of (mid, text). A message without text is removed from the full-text index.
+    """
+    conn.executemany('DELETE FROM diem_fulltext WHERE rowid = ?', [(mid, ) for mid, text in texts])
+    conn.executemany(
+        'INSERT INTO diem_fulltext (rowid, content) VALUES (?, ?)',
+        [(mid, text) for mid, text in texts if text]
+    )
+
+    if commit:
+        conn.commit()
+
+
+def clear_fulltext(conn, commit=True):
+    conn.execute('DELETE FROM diem_fulltext')
+
+    if commit:
+        conn.commit()
+
+
+def optimize_fulltext(conn):
+    conn.execute("INSERT INTO diem_fulltext (diem_fulltext) VALUES ('optimize')")
+    conn.commit()
+
+
+def search_fulltext(conn, search_string, limit=20, offset=0):
+    """
+    Search replies by the full-text index, in order of relevance.
+
+    :param search_string: FTS5 query, e.g. 'sunny walk', '"sunny walk"', 'sun*', 'sunny OR rainy'.
+    :return: cursor of (mid, diary_date, snippet).
+    """
+    query = '''
+            SELECT fulltext.rowid, date_index.diary_date,
+                   snippet(diem_fulltext, 0, '[', ']', '...', 16)
+              FROM diem_fulltext AS fulltext
+              LEFT JOIN diem_id_index AS id_index ON fulltext.rowid = id_index.mid
+              LEFT JOIN diem_date_index AS date_index ON id_index.tid = date_index.tid
+            WHERE diem_fulltext MATCH ?
+            ORDER BY fulltext.rank
+            LIMIT ? OFFSET ?
+            '''
+
+    return conn.execute(query, (search_string, limit, offset))
+
+
+# columns of diem_mime_parts --> keys of diem.mimeindex.scan_message() items
+mime_part_columns = [
+    ('part', 'part'),
+    ('parent', 'parent'),
+    ('content_type', 'content-type'),
+    ('charset', 'charset'),
+    ('encoding', 'encoding'),
+    ('file_name', 'file-name'),
+    ('x_attachment_id', 'x-attachment-id'),
+    ('content_id', 'content-id'),
+    ('date', 'date'),
+    ('header_offset', 'header-offset'),
+    ('body_offset', 'body-offset'),
+    ('body_length', 'body-length'),
+]
+
+
+def update_mime_parts(conn, mid, parts, commit=True):
+    """
+    :param parts: list of dicts, as diem.mimeindex.scan_message() returns.
+    """
+    query = 'INSERT INTO diem_mime_parts (mid, seq, %s) VALUES (?, ?, %s)' % (
+        ', '.join(column for column, key in mime_part_columns),
+        ', '.join('?' for _ in mime_part_columns)
+    )
+
+    conn.execute('DELETE FROM diem_mime_parts WHERE mid=?', (mid, ))
+    conn.executemany(
+        query,
+        [(mid, seq) + tuple(part[key] for column, key in mime_part_columns) for seq, part in enumerate(parts)]
+    )
+
+    if commit:
+        conn.commit()
+
+
+def get_mime_parts(conn, mid):
+    """
+    :return: list of dicts, as diem.mimeindex.scan_message() returns. Empty if mid is not indexed.
+    """
+    query = 'SELECT %s FROM diem_mime_parts WHERE mid=? ORDER BY seq' % (
+        ', '.join(column for column, key in mime_part_columns)
+    )
+
+    return [
+        dict((key, value) for (column, key), value in zip(mime_part_columns, row))
+        for row in conn.execute(query, (mid, ))
+    ]
+
+
+def count_archive_manifest(conn):
+    return conn.execute('SELECT COUNT(*) FROM diem_archive_manifest').fetchone()[0]
+
+
+def get_missing_mids(conn):
+    """
+    :return: list of reply mail mids not recorded in the archive manifest, from the latest one.
+    """
+    query = '''
+            SELECT id_index.mid FROM diem_id_index AS id_index
+              LEFT JOIN diem_archive_manifest AS manifest ON id_index.mid = manifest.mid
+            WHERE id_index.mid != id_index.tid AND manifest.mid IS NULL
+            ORDER BY id_index.mid DESC
+            '''
+
+    return [row[0] for row in conn.execute(query)]
+
+
+@timed_write
+def update_date_index(conn, dates, commit=True):
     date_items = [(tid, date) for tid, date in dates.items()]
 
     c = conn.cursor()
     c.executemany('INSERT OR REPLACE INTO diem_date_index (tid, diary_date) VALUES (?, ?)', date_items)
-    conn.commit()
+
+    if commit:
+        conn.commit()
 
 
-def update_id_index(conn, structure):
+@timed_write
+def update_id_index(conn, structure, commit=True):
     mid_tid_items = [(mid, tid) for mid, tid in structure if mid != tid]
 
     c = conn.cursor()
     c.executemany('INSERT OR REPLACE INTO diem_id_index (mid, tid) VALUES (?, ?)', mid_tid_items)
-    conn.commit()
+
+    if commit:
+        conn.commit()
 
 
 def is_valid_mid(conn, mid):
     return conn.execute('SELECT COUNT(*) FROM diem_id_index WHERE mid=?', (mid, )).fetchone()[0]
 
 
+diary_query = '''
+    SELECT
+      id_index.mid AS mid,
+      id_index.tid AS tid,
+      date_index.diary_date AS diary_date
+    FROM diem_id_index AS id_index
+      INNER JOIN diem_date_index AS date_index
+        ON id_index.tid = date_index.tid
+    '''
+
+
+def query_by_mid(conn, mid):
+    """
+    :return: cursor of (mid, tid, diary_date) whose mid or tid is mid.
+    """
+    query = diary_query + '''
+        WHERE id_index.mid = ? OR id_index.tid = ?
+        ORDER BY mid DESC
+        '''
+
+    return conn.execute(query, (mid, mid))
+
+
+def query_by_date_range(conn, date_from=None, date_to=None, limit=-1, offset=0):
+    """
+    :param date_from: 'YYYY-MM-DD', inclusive. None for no lower bound.
+    :param date_to: 'YYYY-MM-DD', inclusive. None for no upper bound.
+    :param limit: maximum number of rows. -1 for no limit.
+    :return: cursor of (mid, tid, diary_date), from the latest diary date.
+    """
+    query = diary_query + '''
+        WHERE date_index.diary_date BETWEEN ? AND ?
+        ORDER BY diary_date DESC, mid DESC
+        LIMIT ? OFFSET ?
+        '''
+
+    return conn.execute(query, (date_from or '0000-00-00', date_to or '9999-99-99', limit, offset))
+
+
+def query_by_month_day(conn, month_day, limit=-1, offset=0):
+    """
+    Query diaries written on the same day across years.
+
+    :param month_day: 'MM-DD'.
+    :return: cursor of (mid, tid, diary_date), from the latest diary date.
+    """
+    query = diary_query + '''
+        WHERE substr(date_index.diary_date, 6) = ?
+        ORDER BY diary_date DESC, mid DESC
+        LIMIT ? OFFSET ?
+        '''
+
+    return conn.execute(query, (month_day, limit, offset))
+
+
+def query_all(conn, limit=-1, offset=0):
+    """
+    :return: cursor of (mid, tid, diary_date), from the latest mid.
+    """
+    query = diary_query + '''
+        ORDER BY mid DESC
+        LIMIT ? OFFSET ?
+        '''
+
+    return conn.execute(query, (limit, offset))
+
+
 def get_diary_date(conn, mid):
     query = '''
             SELECT date_index.diary_date FROM diem_date_index AS date_index
@@ -93,3 +724,32 @@ def get_diary_date(conn, mid):
     if result:
         return result[0]
 
+
+def iter_diaries(conn, date_from=None, date_to=None):
+    """
+    Iterate (mid, diary_date) of replies, in order of diary date.
+
+    :param date_from: 'YYYY-MM-DD', inclusive. None for no lower bound.
+    :param date_to: 'YYYY-MM-DD', inclusive. None for no upper bound.
+    """
+    query = '''
+            SELECT id_index.mid, date_index.diary_date FROM diem_date_index AS date_index
+              JOIN diem_id_index AS id_index ON date_index.tid = id_index.tid
+            '''
+    conditions = []
+    params = []
+
+    if date_from:
+        conditions.append('date_index.diary_date >= ?')
+        params.append(date_from)
+
+    if date_to:
+        conditions.append('date_index.diary_date <= ?')
+        params.append(date_to)
+
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    query += ' ORDER BY date_index.diary_date, id_index.mid'
+
+    return conn.execute(query, params)
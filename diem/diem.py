@@ -1,14 +1,18 @@
+from collections import OrderedDict
+from functools import partial
 from logging import getLogger
-from os.path import join as path_join
-from os.path import exists as path_exists
 from re import match
+from threading import Event
+from time import perf_counter
 
-from gmail.api import get_service
-from gmail import fetch as gmail_fetch
+from gmail import archive as gmail_archive
+from gmail import codec as gmail_codec
+from gmail import scheduler as gmail_scheduler
+from gmail.attachments import AttachmentStore
 
 from . import get_absolute_path
 from . import db as diem_db
-from .converters import DefaultJSONConverter
+from .pipeline import Stage, DEFAULT_QUEUE_SIZE
 
 
 logger = getLogger(__name__)
@@ -20,12 +24,38 @@ def authorize(credential, storage):
     logger.info('Authorization process complete.')
 
 
+def get_service(storage):
+    """
+    Build an authorized Gmail service. googleapiclient and oauth2client are imported only here,
+    so that local subcommands never load them.
+    """
+    from gmail.api import get_service
+    return get_service(storage)
+
+
+def get_async_fetcher(storage, email, connections):
+    """
+    Start the asyncio engine of Gmail requests, authorized with the token of storage, on a thread of its own.
+    Close it when done.
+    """
+    from gmail.aio import AsyncFetcher, StorageToken
+    return AsyncFetcher(email, StorageToken(storage), max_connections=connections)
+
+
 def get_labels(storage, email):
     from gmail.api import get_service, get_labels
     labels = get_labels(service=get_service(storage), email=email)
     return labels
 
 
+def set_quota(email, units_per_second):
+    """
+    Set the Gmail API quota units per second which requests for email may spend.
+    """
+    gmail_scheduler.configure_scheduler(email, units_per_second)
+    logger.debug('Quota of %s: %d unit(s) per second.' % (email, units_per_second))
+
+
 def create_tables(conn):
     diem_db.create_tables(conn)
     logger.info('create_tables completed.')
@@ -36,116 +66,595 @@ def drop_tables(conn):
     logger.info('drop_tables completed.')
 
 
-def update_database(conn, storage, email, label_id):
+def update_database(conn, storage, email, label_id, batch_size=1, date_source='raw',
+                    sync_mode='history'):
+    from gmail import fetch as gmail_fetch
 
     logger.info('update_database started.')
 
     service = get_service(storage)
+    history_id = diem_db.get_history_id(conn) if sync_mode == 'history' else None
+    sync_state = {}
 
     # fetch structure: list of (mid, tid)
-    structure = gmail_fetch.fetch_structure(
-        service=service,
-        email=email,
-        label_id=label_id,
-        latest_mid=diem_db.get_latest_mid(conn)
-    )
-
-    diem_db.update_id_index(conn, structure)
+    structure = []
+    for page in iter_structure_pages(service, email, label_id, diem_db.get_latest_mid(conn), history_id, sync_state):
+        structure.extend(page)
 
     # extract all diary date within alarm mails: dict mid --> date
     date_indices = gmail_fetch.extract_diary_dates(
         service=service,
         email=email,
-        structure=structure
+        structure=structure,
+        batch_size=batch_size,
+        date_source=date_source
     )
 
-    diem_db.update_date_index(conn, date_indices)
+    with conn.transaction():
+        diem_db.update_id_index(conn, structure)
+        diem_db.update_date_index(conn, date_indices)
+        diem_db.set_history_id(conn, sync_state['history_id'])
 
     logger.info('update_database completed.')
 
     return structure, date_indices
 
 
-def rebuild_database(conn, storage, email, label_id):
+def iter_structure_pages(service, email, label_id, latest_mid, history_id, sync_state):
+    """
+    Yield pages of new (mid, tid) items of the label.
+
+    If history_id is given, only messages added since then are listed, so a sync without any new mail costs
+    a single API call. If history_id is None, or it is expired, the message box is listed from the newest message
+    until latest_mid is reached.
+
+    Either way, the current history id of the mailbox is stored in sync_state['history_id'].
+    """
+    from gmail import fetch as gmail_fetch
+
+    if history_id:
+        try:
+            for page in gmail_fetch.iter_history(service, email, label_id, history_id, sync_state):
+                yield page
+            return
+
+        except gmail_fetch.HistoryExpiredError:
+            logger.warning('History id %d is expired. Falling back to listing the message box.' % history_id)
+
+    # take the history id before listing, so that messages arrived while listing are caught at the next sync.
+    sync_state['history_id'] = gmail_fetch.get_history_id(service, email)
+
+    for page in gmail_fetch.iter_structure(service, email, label_id, latest_mid):
+        yield page
+
+
+def rebuild_database(conn, storage, email, label_id, batch_size=1, date_source='raw',
+                     resume=False):
+    """
+    Rebuild the database, page by page.
+
+    Every listing page and its diary dates are committed to rebuild tables with a checkpoint,
+    and the rebuilt tables replace the current ones at once only when all pages are done.
+    So an interrupted rebuild leaves the current tables untouched, and can be continued with resume=True.
+    """
+    from gmail import fetch as gmail_fetch
+
     logger.info('rebuild_database started.')
-    drop_tables(conn)
-    create_tables(conn)
-    update_database(conn, storage, email, label_id)
-    logger.info('rebuild_database completed.')
-
-
-def query(conn, query_string):
-
-    t = '''
-        SELECT
-          id_index.mid as mid,
-          id_index.tid as tid,
-          date_index.diary_date AS diary_date
-        FROM diem_id_index AS id_index
-          INNER JOIN diem_date_index AS date_index
-            ON id_index.tid = date_index.tid
-          WHERE %s
-          ORDER BY mid DESC
-        '''
+
+    service = get_service(storage)
+
+    checkpoint = diem_db.get_rebuild_checkpoint(conn) if resume else None
+    history_id = diem_db.get_sync_state(conn, 'rebuild_history_id') if checkpoint else None
+
+    # the history id is saved before the first page. A rebuild without it cannot be resumed safely.
+    if checkpoint and history_id is None:
+        logger.warning('The rebuild to resume has no history id saved. Starting over from the first page.')
+        checkpoint = None
+
+    if checkpoint:
+        page, page_token = checkpoint
+        history_id = int(history_id)
+        logger.info('Resuming rebuild_database after page %d.' % page)
+
+    else:
+        if resume:
+            logger.info('No rebuild to resume. Starting from the first page.')
+
+        diem_db.begin_rebuild(conn)
+
+        # take the history id before listing, so that messages arrived while rebuilding are caught at the next sync.
+        history_id = gmail_fetch.get_history_id(service, email)
+        diem_db.set_sync_state(conn, 'rebuild_history_id', str(history_id))
+
+        page = 0
+        page_token = ''
+
+    # page 0 means no page is listed yet. After that, an empty page_token means all pages are listed.
+    while page == 0 or page_token:
+        structure, next_page_token = gmail_fetch.list_messages_page(service, email, label_id, page_token)
+
+        date_indices = gmail_fetch.extract_diary_dates(
+            service=service,
+            email=email,
+            structure=structure,
+            batch_size=batch_size,
+            date_source=date_source
+        )
+
+        page += 1
+        diem_db.save_rebuild_page(conn, page, page_token, next_page_token, structure, date_indices)
+        logger.info('rebuild_database: page %d saved. %d item(s).' % (page, len(structure)))
+
+        page_token = next_page_token
+
+    diem_db.finish_rebuild(conn, history_id)
+
+    logger.info('rebuild_database completed. %d page(s).' % page)
+
+
+def parse_date_range(date_range):
+    """
+    Parse 'YYYY-MM-DD..YYYY-MM-DD' into a tuple of two date strings. An omitted bound is None.
+    """
+    from datetime import datetime
+
+    if '..' not in date_range:
+        raise Exception('Invalid date range: %s' % date_range)
+
+    bounds = tuple(x.strip() or None for x in date_range.split('..', 1))
+
+    for bound in bounds:
+        if bound:
+            try:
+                datetime.strptime(bound, '%Y-%m-%d')
+            except ValueError:
+                raise Exception('Invalid date in the date range: %s' % bound)
+
+    return bounds
+
+
+def query(conn, query_string, limit=None, offset=0, timezone=None):
+    """
+    Query reply mails by mid or by diary date.
+
+    :param query_string: one of
+                         an integer mid or tid,
+                         'YYYY-MM-DD' for a date, 'YYYY-MM' for a month, 'YYYY' for a year,
+                         'YYYY-MM-DD..YYYY-MM-DD' for a date range, whose either bound may be omitted,
+                         'MM-DD' for the day across years, 'today' for today across years,
+                         'latest' for the latest reply, or 'all' for every reply.
+    :param limit: maximum number of rows. None for no limit.
+    :param offset: number of rows to skip.
+    :param timezone: timezone of 'today'. Defaults to the local time.
+    :return: cursor of (mid, tid, diary_date). Rows are read from the database as they are iterated.
+    """
+    if limit is None:
+        limit = -1
 
     if type(query_string) == int:
-        q = t % 'id_index.mid=? OR id_index.tid=?'
-        response = conn.execute(q, (query_string, query_string)).fetchall()
+        return diem_db.query_by_mid(conn, query_string)
+
+    elif match(r'^\d{4}-\d{2}-\d{2}$', query_string):
+        return diem_db.query_by_date_range(conn, query_string, query_string, limit, offset)
+
+    elif match(r'^\d{4}-\d{2}$', query_string):
+        return diem_db.query_by_date_range(conn, query_string + '-01', query_string + '-31', limit, offset)
+
+    elif match(r'^\d{4}$', query_string):
+        return diem_db.query_by_date_range(conn, query_string + '-01-01', query_string + '-12-31', limit, offset)
 
-    elif match(r'^(\d{4})-(\d{2})-(\d{2})$', query_string):
-        q = t % 'diary_date=?'
-        response = conn.execute(q, (query_string, )).fetchall()
+    elif '..' in query_string:
+        date_from, date_to = parse_date_range(query_string)
+        return diem_db.query_by_date_range(conn, date_from, date_to, limit, offset)
+
+    elif match(r'^\d{2}-\d{2}$', query_string):
+        return diem_db.query_by_month_day(conn, query_string, limit, offset)
+
+    elif query_string == 'today':
+        from datetime import datetime
+        return diem_db.query_by_month_day(conn, datetime.now(timezone).strftime('%m-%d'), limit, offset)
 
     elif query_string == 'latest':
-        q = t % '1=1'
-        response = (conn.execute(q).fetchone(), )
+        return diem_db.query_all(conn, 1, offset)
 
     elif query_string == 'all':
-        q = t % '1=1'
-        response = conn.execute(q).fetchall()
+        return diem_db.query_all(conn, limit, offset)
 
     else:
         raise Exception('Invalid string for query: %s' % query_string)
 
-    return response
 
+def fetch(storage, email, archive_path, mid_list, workers=1, batch_size=1,
+          archive_format=gmail_archive.DEFAULT_ARCHIVE_FORMAT, conn=None, archive_codec=gmail_codec.DEFAULT_CODEC,
+          split_attachments=False, engine='threads'):
+    """
+    Fetch and archive reply mails of mid_list. If conn is given, archived messages are recorded in the database.
+    If split_attachments is True, attachments are split out into the attachment store of the archive.
 
-def fetch(storage, email, archive_path, mid_list):
-    service = get_service(storage)
-    gmail_fetch.fetch_and_archive(service, email, archive_path, mid_list)
+    engine 'threads' downloads with a service per worker thread, and 'asyncio' with workers connections
+    on one event loop. See gmail.aio.
+    """
+    from gmail import fetch as gmail_fetch
+    from .indexer import index_message
 
+    if engine == 'asyncio':
+        fetcher = get_async_fetcher(storage, email, workers)
+        service = None
+        mails = fetcher.iter_mails(mid_list)
+    else:
+        fetcher = None
+        service = get_service(storage)
+        mails = None
+
+    indices = []
+
+    def _on_archived(mid, mime, compressed_size):
+        if conn:
+            indices.append(index_message(mid, mime, compressed_size))
+
+    try:
+        count, error = gmail_fetch.fetch_and_archive(
+            service=service,
+            email=email,
+            archive_path=archive_path,
+            mid_list=mid_list,
+            workers=workers,
+            service_builder=partial(get_service, storage),
+            batch_size=batch_size,
+            archive_format=archive_format,
+            on_archived=_on_archived,
+            archive_codec=archive_codec,
+            splitter=get_splitter(archive_path) if split_attachments else None,
+            mails=mails
+        )
+    finally:
+        if fetcher:
+            fetcher.close()
+
+    if conn:
+        diem_db.save_message_indices(conn, indices)
+
+    return count, error
+
+
+def get_splitter(archive_path):
+    from .splitter import split_attachments
+    return partial(split_attachments, archive_dir=gmail_archive.get_archive_dir(archive_path))
+
+
+def fetch_incrementally(conn, storage, email, label_id, archive_path, workers=1, batch_size=1,
+                        date_source='raw', queue_size=DEFAULT_QUEUE_SIZE, sync_mode='history',
+                        archive_format=gmail_archive.DEFAULT_ARCHIVE_FORMAT, archive_codec=gmail_codec.DEFAULT_CODEC,
+                        split_attachments=False, engine='threads'):
+    """
+    Update the database and fetch new reply mails, as a streaming pipeline:
+
+      listing pages --> extracting diary dates --> archiving reply mails --> indexing
+
+    Each stage runs in its own thread, with its own service, and stages are connected by queues of queue_size pages.
+    So listing, downloads, and DB writes overlap, and only a few pages are held in memory at once.
+    Each page is committed in a short transaction of its own, as soon as it is archived, so that the write lock is
+    never held for the downloads, and an interrupted run keeps the pages it has done. The next run lists again from
+    where the interrupted one started, and the history id is saved only when a sync completes.
+    With engine 'asyncio', reply mails are downloaded by gmail.aio, with workers connections. See fetch().
+    """
+    from gmail import fetch as gmail_fetch
+    from .indexer import index_message
 
-def fetch_incrementally(conn, storage, email, label_id, archive_path):
     logger.info('fetch_incrementally started.')
 
-    structure, date_indices = update_database(conn, storage, email, label_id)
+    service_builder = partial(get_service, storage)
+    splitter = get_splitter(archive_path) if split_attachments else None
+
+    # services of the stages below are built lazily, so that a sync without new mails builds only one.
+    def _extract_dates(pages):
+        service = None
+        for page in pages:
+            service = service or service_builder()
+            yield page, gmail_fetch.extract_diary_dates(service, email, page, batch_size, date_source)
+
+    def _archive(dated_pages):
+        service = None
+        fetcher = None
+        try:
+            for page, dates in dated_pages:
+                mid_list = [mid for mid, tid in page if mid != tid]
+                indices = []
+                if mid_list:
+                    # the connections of the asyncio engine are kept alive from page to page.
+                    if engine == 'asyncio':
+                        fetcher = fetcher or get_async_fetcher(storage, email, workers)
+                    else:
+                        service = service or service_builder()
+                    count, error = gmail_fetch.fetch_and_archive(
+                        service, email, archive_path, mid_list, workers, service_builder, batch_size, archive_format,
+                        on_archived=lambda mid, mime, compressed_size: indices.append(
+                            index_message(mid, mime, compressed_size)
+                        ),
+                        archive_codec=archive_codec,
+                        splitter=splitter,
+                        mails=fetcher.iter_mails(mid_list) if fetcher else None
+                    )
+                else:
+                    count, error = 0, 0
+                yield page, dates, count, error, indices
+        finally:
+            if fetcher:
+                fetcher.close()
+
+    # conn belongs to this thread, so the stages get everything they need from it beforehand.
+    # listing goes from the newest message down, so after an interrupted sync, the newest mid in the database
+    # may be above pages never listed. The mid the interrupted sync started from is used instead.
+    started_mid = diem_db.get_sync_state(conn, 'sync_started_mid')
+
+    if started_mid is None:
+        latest_mid = diem_db.get_latest_mid(conn)
+        diem_db.set_sync_state(conn, 'sync_started_mid', str(latest_mid))
+    else:
+        latest_mid = int(started_mid)
+        logger.info('Continuing an interrupted sync from mid %d (0x%x).' % (latest_mid, latest_mid))
 
-    mid_list = [mid for mid, tid in structure if mid != tid]
-    if mid_list:
-        service = get_service(storage)
-        gmail_fetch.fetch_and_archive(service, email, archive_path, mid_list)
+    history_id = diem_db.get_history_id(conn) if sync_mode == 'history' else None
+    sync_state = {}
 
-    logger.info('fetch_incrementally completed.')
+    # set when the sync stops, so that no stage is left blocked on its queue, holding its service or connections.
+    cancel = Event()
 
+    pages = Stage(
+        'list',
+        iter_structure_pages(service_builder(), email, label_id, latest_mid, history_id, sync_state),
+        queue_size,
+        cancel
+    )
+    dated_pages = Stage('dates', _extract_dates(pages), queue_size, cancel)
+    archived_pages = Stage('archive', _archive(dated_pages), queue_size, cancel)
+
+    total_items = 0
+    total_count = 0
+    total_error = 0
+
+    try:
+        for page, dates, count, error, indices in archived_pages:
+            with conn.transaction():
+                diem_db.update_id_index(conn, page)
+                diem_db.update_date_index(conn, dates)
+                diem_db.save_message_indices(conn, indices)
+
+            total_items += len(page)
+            total_count += count
+            total_error += error
+
+        with conn.transaction():
+            diem_db.set_history_id(conn, sync_state['history_id'])
+            diem_db.delete_sync_state(conn, 'sync_started_mid')
+
+    finally:
+        cancel.set()
+        for stage in (pages, dated_pages, archived_pages):
+            stage.join()
+
+    logger.info(
+        'fetch_incrementally completed. %d item(s) indexed. %d message(s) archived. Error %d message(s).' %
+        (total_items, total_count, total_error)
+    )
 
-def fix_missing(conn, storage, email, archive_path):
+    return total_items, total_count, total_error
+
+
+def sync_all(profiles, jobs=4, workers=1, batch_size=1, date_source='raw', queue_size=DEFAULT_QUEUE_SIZE,
+             sync_mode='history', engine='threads', max_requests=None):
+    """
+    Sync several accounts at once: fetch_incrementally() of each profile, jobs profiles at a time.
+
+    Every account has a database connection of its own, and a scheduler of its own, with the quota units of its
+    profile, so that a busy or throttled account never slows down the others. A failed sync is logged,
+    and the other ones go on.
+
+    Requests in flight across accounts are bounded by max_requests: the schedulers of all the profiles share a budget
+    of max_requests slots, and every request, of listing, of dates and of archiving, holds one while it is in flight.
+    Each profile synced at once also gets an equal share of max_requests as its workers, not to start workers
+    which would only wait for the budget, and jobs is lowered if max_requests is less than jobs.
+
+    :param profiles: list of (name, profile dict) tuples.
+    :param jobs: profiles synced concurrently at most.
+    :param workers: download workers of each profile, or connections with the asyncio engine, up to its share.
+    :param max_requests: HTTP requests in flight across all profiles at most. None for jobs x workers.
+    :return: list of dicts, one for each profile in the order of profiles, with keys
+             name, email, success, items, archived, errors, seconds, and message, the error of a failed sync.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    for key in ('database', 'archive-path'):
+        paths = [get_absolute_path(profile[key]) for name, profile in profiles]
+        for path in set(paths):
+            if paths.count(path) > 1:
+                raise Exception('Profiles share the %s %s. Sync them one at a time.' % (key, path))
+
+    for name, profile in profiles:
+        if profile.get('quota-units'):
+            set_quota(profile['email'], profile['quota-units'])
+
+    jobs = max(1, min(jobs, len(profiles), max_requests or jobs))
+    budget = None
+
+    if max_requests:
+        from threading import BoundedSemaphore
+
+        workers = max(1, min(workers, max_requests // jobs))
+        budget = BoundedSemaphore(max_requests)
+
+    for name, profile in profiles:
+        gmail_scheduler.set_budget(profile['email'], budget)
+
+    logger.info('sync_all started. %d profile(s), %d job(s) of %d worker(s) each.' % (len(profiles), jobs, workers))
+
+    def _sync(item):
+        name, profile = item
+        result = OrderedDict([
+            ('name', name), ('email', profile.get('email')), ('success', False),
+            ('items', 0), ('archived', 0), ('errors', 0), ('seconds', 0.0), ('message', None),
+        ])
+        begin = perf_counter()
+
+        try:
+            conn = diem_db.open_db(profile['database'])
+            try:
+                result['items'], result['archived'], result['errors'] = fetch_incrementally(
+                    conn=conn,
+                    storage=profile['storage'],
+                    email=profile['email'],
+                    label_id=profile['label-id'],
+                    archive_path=profile['archive-path'],
+                    workers=workers,
+                    batch_size=batch_size,
+                    date_source=date_source,
+                    queue_size=queue_size,
+                    sync_mode=sync_mode,
+                    archive_format=profile.get('archive-format', 'loose'),
+                    archive_codec=profile.get('archive-codec', 'gzip'),
+                    split_attachments=profile.get('split-attachments', False),
+                    engine=engine
+                )
+            finally:
+                conn.close()
+            result['success'] = True
+
+        except Exception as e:
+            logger.exception('Sync of profile %s failed.' % name)
+            result['message'] = str(e) or e.__class__.__name__
+
+        result['seconds'] = round(perf_counter() - begin, 3)
+        logger.info('Sync of profile %s %s in %.3f sec.' % (
+            name, 'completed' if result['success'] else 'failed', result['seconds']
+        ))
+
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='sync') as executor:
+            results = list(executor.map(_sync, profiles))
+    finally:
+        for name, profile in profiles:
+            gmail_scheduler.set_budget(profile['email'], None)
+
+    logger.info('sync_all completed. %d of %d profile(s) failed.' % (
+        len([result for result in results if not result['success']]), len(results)
+    ))
+
+    return results
+
+
+def fix_missing(conn, storage, email, archive_path, workers=1, batch_size=1,
+                archive_format=gmail_archive.DEFAULT_ARCHIVE_FORMAT, archive_codec=gmail_codec.DEFAULT_CODEC,
+                split_attachments=False, engine='threads'):
     logger.info('fix_missing started.')
 
-    q = "SELECT mid FROM diem_id_index WHERE mid != tid ORDER BY mid DESC"
-    mid_list = []
+    # archives written before the manifest existed are not recorded yet.
+    if not diem_db.count_archive_manifest(conn):
+        logger.info('Archive manifest is empty. Reconciling it with the archive first.')
+        reconcile(conn, archive_path)
 
-    for row in conn.execute(q):
-        mid = row[0]
-        message_path = path_join(archive_path, '%x.gz' % mid)
-        if path_exists(message_path):
-            logger.debug('mid %d (0x%x) already archived.' % (mid, mid))
-        else:
-            logger.debug('mid %d (0x%x) not archived. Append to mid_list' % (mid, mid))
-            mid_list.append(mid)
+    mid_list = diem_db.get_missing_mids(conn)
+    logger.debug('%d message(s) not archived.' % len(mid_list))
+
+    count, error = fetch(storage, email, archive_path, mid_list, workers, batch_size, archive_format, conn,
+                         archive_codec, split_attachments, engine)
+
+    logger.info('fix_missing completed. %d message(s) archived. Error %d message(s).' % (count, error))
+
+
+def reconcile(conn, archive_path):
+    """
+    Rebuild the archive manifest and MIME layout index from the archive, in one scan.
+    """
+    from .indexer import index_message
+
+    logger.info('reconcile started.')
+
+    count = 0
+    indices = []
+
+    with conn.transaction():
+        diem_db.clear_message_indices(conn)
+
+        for mid, mime, compressed_size in gmail_archive.iter_archives(archive_path):
+            indices.append(index_message(mid, mime, compressed_size))
+            count += 1
+
+            if len(indices) >= 500:
+                diem_db.save_message_indices(conn, indices)
+                indices = []
+
+        diem_db.save_message_indices(conn, indices)
+
+    logger.info('reconcile completed. %d message(s) in the archive.' % count)
 
-    fetch(storage, email, archive_path, mid_list)
 
-    logger.info('fix_missing_completed. %d message(s) archived.')
+def reindex(conn, archive_path):
+    """
+    Rebuild the full-text index from the archive.
+    """
+    from .fulltext import extract_text
+    from .mimeindex import scan_message
+
+    logger.info('reindex started.')
+
+    count = 0
+    texts = []
+
+    with conn.transaction():
+        diem_db.clear_fulltext(conn)
+
+        for mid, mime, compressed_size in gmail_archive.iter_archives(archive_path):
+            texts.append((mid, extract_text(mime, scan_message(mime))))
+            count += 1
+
+            if len(texts) >= 500:
+                diem_db.update_fulltext(conn, texts)
+                texts = []
+
+        diem_db.update_fulltext(conn, texts)
+
+    diem_db.optimize_fulltext(conn)
+
+    logger.info('reindex completed. %d message(s) indexed.' % count)
+
+
+def search(conn, search_string, limit=20, offset=0):
+    """
+    Full-text search of replies.
+
+    :return: list of (mid, diary_date, snippet), in order of relevance.
+    """
+    import sqlite3
+
+    try:
+        return diem_db.search_fulltext(conn, search_string, limit, offset).fetchall()
+    except sqlite3.OperationalError as e:
+        raise Exception('Search failed: %s' % e)
+
+
+def migrate_archive(archive_path, remove_loose=False):
+    gmail_archive.migrate_archive(archive_path, remove_loose)
+
+
+def compact_archive(archive_path):
+    gmail_archive.compact_archive(archive_path)
+
+
+def recompress(conn, archive_path, codec, train=False):
+    """
+    Encode the archive again with codec, and update compressed sizes in the archive manifest.
+    """
+    sizes = []
+
+    count, skipped = gmail_archive.recompress_archive(
+        archive_path, codec, train, on_recompressed=lambda mid, compressed_size: sizes.append((mid, compressed_size))
+    )
+
+    diem_db.update_compressed_sizes(conn, sizes)
+
+    return count, skipped
 
 
 def export(conn, mid, archive_path, timezone):
@@ -159,7 +668,7 @@ def export(conn, mid, archive_path, timezone):
     class_ = getattr(import_module('diem.converters'), 'DefaultJSONConverter')
 
     instance = class_(
-        message=gmail_fetch.get_archive(mid, archive_path),
+        message=load_message(mid, archive_path, conn),
         diary_date=diary_date,
         timezone=timezone
     )
@@ -167,57 +676,218 @@ def export(conn, mid, archive_path, timezone):
     return instance.convert()
 
 
-def message_structure(mid, archive_path):
-    parsed = DefaultJSONConverter.parse(gmail_fetch.get_archive(mid, archive_path))
+# export workers: each process opens its own database connection, kept in this dict.
+_export_worker_state = {}
+
+# number of replies converted by a worker process at a time.
+EXPORT_CHUNK_SIZE = 16
+
+
+def bulk_export(conn, database, archive_path, timezone, output, processes=1, mid_list=None, date_from=None,
+                date_to=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Export replies as JSON Lines, one reply per line, in order of diary date.
+
+    Parsing and converting run in a pool of processes, and lines are written to output in order as they are ready.
+    Only a window of chunks is in flight at a time, so that memory does not grow with the number of replies.
+
+    :param conn: database connection.
+    :param database: database path, opened again by each worker process.
+    :param output: writable text file.
+    :param processes: number of worker processes. If 1, replies are converted in this process.
+    :param mid_list: list of mids to export. If None, replies in the date range are exported.
+    :param date_from: 'YYYY-MM-DD', inclusive.
+    :param date_to: 'YYYY-MM-DD', inclusive.
+    :return: tuple of the number of exported replies, the number of failures, the number of written bytes,
+             and elapsed seconds.
+    """
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import islice
+    from time import time
+
+    if mid_list is None:
+        targets = diem_db.iter_diaries(conn, date_from, date_to)
+    else:
+        targets = _iter_mid_dates(conn, mid_list)
+
+    targets = iter(targets)
+    chunks = iter(lambda: list(islice(targets, chunk_size)), [])
+
+    count = 0
+    failed = 0
+    written = 0
+    begin = time()
+
+    def _write(result):
+        nonlocal count, failed, written
+        for line in result:
+            if line is None:
+                failed += 1
+                continue
+            output.write(line)
+            output.write('\n')
+            count += 1
+            written += len(line) + 1
+
+    if processes > 1:
+        with ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=_init_export_worker,
+                initargs=(database, archive_path, timezone)) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_export_chunk, chunk))
+                if len(pending) >= processes * 2:
+                    _write(pending.popleft().result())
+            while pending:
+                _write(pending.popleft().result())
+    else:
+        _export_worker_state.update(conn=conn, archive_path=archive_path, timezone=timezone)
+        try:
+            for chunk in chunks:
+                _write(_export_chunk(chunk))
+        finally:
+            _export_worker_state.clear()
+
+    output.flush()
+
+    elapsed = time() - begin
+
+    return count, failed, written, elapsed
+
+
+def _iter_mid_dates(conn, mid_list):
+    for mid in mid_list:
+        diary_date = diem_db.get_diary_date(conn, mid)
+        if diary_date:
+            yield mid, diary_date
+        else:
+            logger.error('MID %s is not exist, or not fetched yet!' % mid)
+
+
+def _init_export_worker(database, archive_path, timezone):
+    _export_worker_state.update(conn=diem_db.open_db(database), archive_path=archive_path, timezone=timezone)
+
+
+def _export_chunk(chunk):
+    """
+    Convert a chunk of (mid, diary_date) into JSON lines. A failed reply results in None.
+    """
+    from .converters import DefaultJSONConverter, DiaryTemplateFactory
+
+    conn = _export_worker_state['conn']
+    archive_path = _export_worker_state['archive_path']
+    timezone = _export_worker_state['timezone']
+
+    lines = []
+
+    for mid, diary_date in chunk:
+        try:
+            exported = DefaultJSONConverter(
+                message=load_message(mid, archive_path, conn),
+                diary_date=diary_date,
+                timezone=timezone
+            ).convert()
+            exported['mid'] = mid
+            lines.append(DiaryTemplateFactory.as_json(exported))
+        except Exception as e:
+            logger.error('Exporting MID %d (0x%x) failed: %s' % (mid, mid, e))
+            lines.append(None)
+
+    return lines
+
+
+def load_message(mid, archive_path, conn=None):
+    """
+    Load an archived message.
+
+    If the MIME layout of the message is indexed, an indexed message is returned without reading the archive.
+    Its parts are read from the archive only when their payloads are asked, by seeking directly to them.
+    Otherwise the whole message is read, to be parsed.
+    """
+    rows = get_mime_layout(conn, mid) if conn else None
+
+    if not rows:
+        return gmail_archive.get_archive(mid, archive_path)
+
+    def _reader(offset, length):
+        with gmail_archive.open_archive(mid, archive_path) as f:
+            f.seek(offset)
+            return f.read(length)
+
+    return build_message(rows, _reader, archive_path)
+
+
+def get_mime_layout(conn, mid):
+    """
+    :return: MIME layout rows of the message, with the 'hash' of each split attachment. Empty if it is not indexed.
+    """
+    rows = diem_db.get_mime_parts(conn, mid)
+
+    if rows:
+        hashes = diem_db.get_attachment_hashes(conn, mid)
+        for row in rows:
+            row['hash'] = hashes.get(row['part'])
+
+    return rows
+
+
+def build_message(rows, reader, archive_path):
+    """
+    :param rows: MIME layout rows. See get_mime_layout().
+    :param reader: callable, reader(offset, length) returns bytes of the message as stored.
+    :return: diem.mimeindex.IndexedPart of the root.
+    """
+    from .mimeindex import build_indexed_message
+
+    attachment_store = AttachmentStore(gmail_archive.get_archive_dir(archive_path))
+
+    return build_indexed_message(rows, reader, attachment_store.get)
+
+
+def message_structure(mid, archive_path, conn=None):
+    from .converters import DefaultJSONConverter
+
+    parsed = DefaultJSONConverter.parse(load_message(mid, archive_path, conn))
     return DefaultJSONConverter.get_message_structure(parsed)
 
 
-def view_diary(mid, archive_path, content_type):
-    parsed = DefaultJSONConverter.parse(gmail_fetch.get_archive(mid, archive_path))
+def view_diary(mid, archive_path, content_type, conn=None):
+    from .converters import DefaultJSONConverter
+
+    parsed = DefaultJSONConverter.parse(load_message(mid, archive_path, conn))
 
     if content_type in ('text/html', 'text/plain'):
         subpart = DefaultJSONConverter.find_subpart(parsed, content_type)
         return str(subpart.get_payload(decode=True), encoding=subpart.get_content_charset())
 
 
-def extract_attachments(mid, archive_path, attachment_ids, dest_dir):
-    parsed = DefaultJSONConverter.parse(gmail_fetch.get_archive(mid, archive_path))
-    _dest_dir = get_absolute_path(dest_dir)
-
-    # in 'all' condition, found_table is None.
-    # if attachment_ids is a list, found_table is a dict whose keys are attachment_ids, initialized with False value
-    found_table = None
-    if type(attachment_ids) == list:
-        found_table = {}
-        for id in attachment_ids:
-            found_table[id] = False
-    elif attachment_ids == 'all':
-        found_table = None
-    else:
-        Exception('Invalid attachment_ids: %s' % attachment_ids)
-
-    # traversing all multi-parts, extract specified files
-    for part in parsed.walk():
-        file_name = part.get_filename()
-
-        if not file_name:
-            continue
-
-        attachment_id = part.get('X-Attachment-Id') or part.get('Content-ID').strip('<>')
-        # if attachment_ids were a list:
-        if found_table:
-            if attachment_id in found_table and not found_table[attachment_id]:
-                found_table[attachment_id] = True  # attachment_id is found
-            else:
-                # If attachment_id is not in the list, then the case is supposed to be skipped.
-                continue
+def extract_attachments(mid_list, archive_path, attachment_ids, dest_dir, conn=None, link=False, date_from=None,
+                        date_to=None):
+    """
+    Extract attachments of messages into dest_dir, streaming each wanted part straight into its file.
+    An attachment split out into the attachment store is copied from it, or hard linked to it if link is True,
+    without decoding the message. See diem.extractor.
 
-        # extract this file
-        with open(path_join(_dest_dir, file_name), 'wb') as f:
-            f.write(part.get_payload(decode=True))
+    :param mid_list: list of mids. If None, replies in the date range are extracted from.
+                     With more than one message, each one gets a sub-directory of dest_dir, named after its mid.
+    :param date_from: 'YYYY-MM-DD', inclusive.
+    :param date_to: 'YYYY-MM-DD', inclusive.
+    :return: tuple of (number of files extracted, list of mids which failed)
+    """
+    from .extractor import extract_attachments as _extract_attachments
 
-        logger.debug('MID %d (0x%x) attachment id \'%s\' extracted as \'%s\'.' % (mid, mid, attachment_id, file_name))
+    if mid_list is None:
+        mid_list = [mid for mid, diary_date in diem_db.iter_diaries(conn, date_from, date_to)]
 
+    return _extract_attachments(mid_list, archive_path, attachment_ids, get_absolute_path(dest_dir), conn, link)
 
 
+def serve(conn, archive_path, timezone, host, port, cache_size, workers):
+    """
+    Serve the diary over a read-only HTTP API, until interrupted. See diem.server.
+    """
+    from .server import serve as _serve
 
+    _serve(conn, archive_path, timezone, host, port, cache_size, workers)
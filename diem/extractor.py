@@ -0,0 +1,478 @@
+"""
+Streaming attachment extraction.
+
+A message is read from the archive as a stream, and only the parts asked for are decoded, a buffer at a time,
+straight into their files. The MIME tree of a message is never built, and no payload is ever held as a whole.
+
+If the MIME layout of a message is indexed, wanted parts are read by seeking to their bodies, in order of offset.
+Otherwise the message is scanned line by line for its part boundaries.
+"""
+from binascii import a2b_base64, a2b_qp
+from email.parser import BytesHeaderParser
+from logging import getLogger
+from os import makedirs
+from os.path import join as path_join
+
+import re
+
+from gmail import archive as gmail_archive
+from gmail.attachments import AttachmentStore, parse_placeholder
+
+from . import db as diem_db
+
+logger = getLogger(__name__)
+
+# bytes read from the archive at a time. A line longer than this is read in pieces.
+READ_BUFFER_SIZE = 64 * 1024
+
+PLACEHOLDER_PREFIX = b'diem-attachment:'
+
+# RFC 2046: a boundary is 70 characters at most. With '--', '--' and trailing white space, a delimiter line is shorter.
+MAX_DELIMITER_LENGTH = 128
+
+line_break_expr = re.compile(br'\r?\n')
+header_end_expr = re.compile(br'\r?\n\r?\n')
+
+# a placeholder line is about 100 bytes. See gmail.attachments.make_placeholder().
+MAX_PLACEHOLDER_SIZE = 256
+
+
+def extract_attachments(mid_list, archive_path, attachment_ids, dest_dir, conn=None, link=False):
+    """
+    Extract attachments of messages into dest_dir, in one pass over each message.
+
+    :param mid_list: list of mids. With a single mid, files are extracted into dest_dir itself,
+                     and with more, into a sub-directory of dest_dir named after each mid.
+    :param archive_path:
+    :param attachment_ids: 'all', or a list of attachment ids to extract, each one at most once per message.
+    :param dest_dir:
+    :param conn: if given, messages whose MIME layout is indexed are read by seeking to the wanted parts.
+    :param link: hard link attachments split out into the attachment store, instead of copying them.
+    :return: tuple of (number of files extracted, list of mids which failed)
+    """
+    if attachment_ids != 'all' and type(attachment_ids) != list:
+        raise Exception('Invalid attachment_ids: %s' % attachment_ids)
+
+    attachment_store = AttachmentStore(gmail_archive.get_archive_dir(archive_path))
+    count = 0
+    failed = []
+
+    for mid in mid_list:
+        if len(mid_list) > 1:
+            mid_dir = path_join(dest_dir, str(mid))
+        else:
+            mid_dir = dest_dir
+
+        selector = PartSelector(attachment_ids, mid_dir, attachment_store, link)
+
+        try:
+            rows = diem_db.get_mime_parts(conn, mid) if conn else None
+            if rows:
+                hashes = diem_db.get_attachment_hashes(conn, mid)
+                extract_indexed_parts(mid, archive_path, rows, hashes, selector)
+            else:
+                with gmail_archive.open_archive(mid, archive_path) as f:
+                    scan_parts(f, selector)
+        except Exception as e:
+            # a broken archive, a bad encoding or an unknown charset fails this message only.
+            logger.error('Attachments of MID %d (0x%x) are not extracted: %s' % (mid, mid, str(e) or e.__class__.__name__))
+            failed.append(mid)
+            continue
+
+        count += selector.count
+
+    logger.info('%d attachment(s) of %d message(s) extracted.' % (count, len(mid_list) - len(failed)))
+
+    if failed:
+        logger.error('%d message(s) failed: %s' % (len(failed), ', '.join('%d (0x%x)' % (mid, mid) for mid in failed)))
+
+    return count, failed
+
+
+class PartSelector(object):
+    """
+    Decides which parts of a message to extract, and opens a writer for each of them.
+    """
+
+    def __init__(self, attachment_ids, dest_dir, attachment_store, link=False):
+        # if attachment_ids is a list, found is a dict of attachment_id --> True if extracted already.
+        self.found = None if attachment_ids == 'all' else dict((i, False) for i in attachment_ids)
+        self.dest_dir = dest_dir
+        self.attachment_store = attachment_store
+        self.link = link
+        self.count = 0
+
+    def select(self, file_name, attachment_id):
+        """
+        :return: True if the part is to be extracted.
+        """
+        if not file_name:
+            return False
+
+        if self.found is not None:
+            if attachment_id not in self.found or self.found[attachment_id]:
+                return False
+            self.found[attachment_id] = True
+
+        return True
+
+    def is_done(self):
+        """
+        :return: True if every attachment asked for is extracted already.
+        """
+        return self.found is not None and all(self.found.values())
+
+    def get_path(self, file_name):
+        makedirs(self.dest_dir, exist_ok=True)
+        self.count += 1
+        return path_join(self.dest_dir, file_name)
+
+    def copy(self, file_name, digest):
+        copy_attachment(self.attachment_store.get_path(digest), self.get_path(file_name), self.link)
+
+    def open_writer(self, file_name, encoding):
+        return PartWriter(self, file_name, encoding)
+
+
+class PartWriter(object):
+    """
+    Decodes the body of a part as it is written, into the file of the attachment.
+    A body which is the placeholder of a split attachment is copied from the attachment store instead.
+    """
+
+    def __init__(self, selector, file_name, encoding):
+        self.selector = selector
+        self.file_name = file_name
+        self.decoder = get_decoder(encoding)
+        self.f = None
+        # the beginning of the body, kept until it is told whether the body is a placeholder.
+        self.head = b''
+
+    def write(self, data):
+        if self.f is None:
+            self.head += data
+            stripped = self.head.lstrip()
+
+            if len(stripped) < len(PLACEHOLDER_PREFIX):
+                return
+            if stripped.startswith(PLACEHOLDER_PREFIX) and len(self.head) <= MAX_PLACEHOLDER_SIZE:
+                return
+
+            data, self.head = self.head, b''
+            self.f = open(self.selector.get_path(self.file_name), 'wb')
+
+        self.f.write(self.decoder.decode(data))
+
+    def close(self):
+        if self.f is None:
+            placeholder = parse_placeholder(self.head) if self.head.lstrip().startswith(PLACEHOLDER_PREFIX) else None
+
+            if placeholder:
+                self.selector.copy(self.file_name, placeholder[0])
+                return
+
+            self.f = open(self.selector.get_path(self.file_name), 'wb')
+            self.f.write(self.decoder.decode(self.head))
+            self.head = b''
+
+        self.f.write(self.decoder.flush())
+        self.f.close()
+
+
+class Base64Decoder(object):
+    """
+    Decodes base64 a chunk at a time. Characters which do not make a full quantum yet are kept for the next chunk.
+    """
+
+    def __init__(self):
+        self.pending = b''
+
+    def decode(self, data):
+        data = self.pending + data.translate(None, b' \t\r\n')
+        end = len(data) - len(data) % 4
+        self.pending = data[end:]
+        return a2b_base64(data[:end])
+
+    def flush(self):
+        pending, self.pending = self.pending, b''
+        return a2b_base64(pending) if pending else b''
+
+
+class QuotedPrintableDecoder(object):
+    """
+    Decodes quoted-printable a line at a time, so that a soft line break or an escape is never cut in two.
+    """
+
+    def __init__(self):
+        self.pending = b''
+
+    def decode(self, data):
+        data = self.pending + data
+        end = data.rfind(b'\n') + 1
+        self.pending = data[end:]
+        return a2b_qp(data[:end])
+
+    def flush(self):
+        pending, self.pending = self.pending, b''
+        return a2b_qp(pending)
+
+
+class IdentityDecoder(object):
+    def decode(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+def get_decoder(encoding):
+    encoding = (encoding or '').strip().lower()
+
+    if encoding == 'base64':
+        return Base64Decoder()
+    elif encoding == 'quoted-printable':
+        return QuotedPrintableDecoder()
+    else:
+        return IdentityDecoder()
+
+
+def get_attachment_id(x_attachment_id, content_id):
+    return x_attachment_id or (content_id or '').strip('<>') or None
+
+
+def _text(value):
+    # a header of raw 8-bit bytes is parsed as an email.header.Header.
+    return None if value is None else str(value)
+
+
+def extract_indexed_parts(mid, archive_path, rows, hashes, selector, buffer_size=READ_BUFFER_SIZE):
+    """
+    Extract wanted parts of an indexed message. Split attachments are copied without reading the archive,
+    and the rest are read in order of offset, so the archive is read forward once, up to the last wanted part.
+
+    :param rows: MIME layout of the message. See diem.db.get_mime_parts().
+    :param hashes: dict of part --> hash of split attachments. See diem.db.get_attachment_hashes().
+    """
+    wanted = []
+
+    for row in rows:
+        if row['content-type'].startswith('multipart/'):
+            continue
+
+        if not selector.select(row['file-name'], get_attachment_id(row['x-attachment-id'], row['content-id'])):
+            continue
+
+        if hashes.get(row['part']):
+            selector.copy(row['file-name'], hashes[row['part']])
+        else:
+            wanted.append(row)
+
+    if not wanted:
+        return
+
+    with gmail_archive.open_archive(mid, archive_path) as f:
+        for row in sorted(wanted, key=lambda r: r['body-offset']):
+            writer = selector.open_writer(row['file-name'], row['encoding'])
+            f.seek(row['body-offset'])
+            remaining = row['body-length']
+
+            while remaining > 0:
+                data = f.read(min(buffer_size, remaining))
+                if not data:
+                    break
+                writer.write(data)
+                remaining -= len(data)
+
+            writer.close()
+
+
+def scan_parts(f, selector, buffer_size=READ_BUFFER_SIZE):
+    """
+    Scan a message for its parts, a buffer at a time, and extract wanted ones as they pass by.
+    Parts are numbered as diem.mimeindex.scan_message() numbers them. Parts not wanted are skipped without decoding,
+    and the rest of the message is not read at all once there is nothing left to extract.
+
+    :param f: binary file object of the message.
+    """
+    buf = b''
+    pos = 0
+    eof = False
+
+    def _fill():
+        nonlocal buf, pos, eof
+        data = f.read(buffer_size)
+        eof = not data
+        buf = buf[pos:] + data
+        pos = 0
+
+    # open multipart containers, outermost first: list of [delimiter, part id, number of children so far]
+    containers = []
+    part_id = '0'
+    writer = None
+    in_headers = True
+    # a delimiter at the very start of a body has no line break before it.
+    at_line_start = True
+
+    # a part being written is finished, even if it is the last one wanted.
+    while writer or not selector.is_done():
+        if in_headers:
+            if len(buf) - pos < 2 and not eof:
+                _fill()
+                continue
+
+            blank = line_break_expr.match(buf, pos)
+            searched = blank or header_end_expr.search(buf, pos)
+
+            if not searched and not eof:
+                _fill()
+                continue
+
+            header_end = searched.end() if searched else len(buf)
+            writer = _start_part(buf[pos:header_end], part_id, containers, selector)
+            pos = header_end
+            in_headers = False
+            at_line_start = True
+            continue
+
+        if not containers:
+            # the body of a single part message, or the epilogue of the outermost container, runs to the end.
+            if writer:
+                writer.write(buf[pos:])
+            pos = len(buf)
+            if eof:
+                break
+            _fill()
+            continue
+
+        if at_line_start and len(buf) - pos < 2 and not eof:
+            _fill()
+            continue
+
+        if at_line_start and buf.startswith(b'--', pos):
+            candidate = (pos, pos)
+        else:
+            # bytes.find() is much faster than a regular expression with an optional '\r' in front.
+            found = buf.find(b'\n--', pos)
+            if found < 0:
+                candidate = None
+            elif found > pos and buf[found - 1] == 0x0d:
+                candidate = (found - 1, found + 1)
+            else:
+                candidate = (found, found + 1)
+
+        if candidate is None:
+            # a line break and '--' may be cut at the end of the buffer.
+            end = max(pos, len(buf) - 3) if not eof else len(buf)
+            if writer:
+                writer.write(buf[pos:end])
+            pos = end
+            at_line_start = False
+            if eof:
+                break
+            _fill()
+            continue
+
+        start, line_start = candidate
+        line_end = buf.find(b'\n', line_start)
+
+        # RFC 2046: a boundary is 70 characters at most, so a longer line is not a delimiter.
+        if line_end < 0 and not eof and len(buf) - line_start < MAX_DELIMITER_LENGTH:
+            if writer:
+                writer.write(buf[pos:start])
+            pos = start
+            _fill()
+            continue
+
+        line_end = len(buf) if line_end < 0 else line_end + 1
+        level, closing = _match_delimiter(buf[line_start:line_end], containers)
+
+        if level is None:
+            if writer:
+                writer.write(buf[pos:line_start + 2])
+            pos = line_start + 2
+            at_line_start = False
+            continue
+
+        # the line break before a delimiter belongs to the delimiter, not to the body.
+        if writer:
+            writer.write(buf[pos:start])
+            writer.close()
+            writer = None
+
+        pos = line_end
+        del containers[level + 1:]
+
+        at_line_start = True
+
+        if closing:
+            # the epilogue of the container is skipped, up to a delimiter of an outer container.
+            containers.pop()
+        else:
+            container = containers[level]
+            container[2] += 1
+            parent_id = container[1]
+            part_id = str(container[2]) if parent_id == '0' else '%s.%d' % (parent_id, container[2])
+            in_headers = True
+
+    if writer:
+        writer.close()
+
+
+def _match_delimiter(line, containers):
+    """
+    :return: tuple of (level of the container whose delimiter the line is, True if it is a close delimiter),
+             or (None, False).
+    """
+    stripped = line.rstrip(b' \t\r\n')
+
+    for level in range(len(containers) - 1, -1, -1):
+        delimiter = containers[level][0]
+        if stripped == delimiter:
+            return level, False
+        if stripped == delimiter + b'--':
+            return level, True
+
+    return None, False
+
+
+def _start_part(header_bytes, part_id, containers, selector):
+    """
+    :return: PartWriter if the part is to be extracted, otherwise None.
+    """
+    headers = BytesHeaderParser().parsebytes(header_bytes)
+    boundary = headers.get_boundary()
+
+    if headers.get_content_maintype() == 'multipart' and boundary:
+        containers.append([b'--' + boundary.encode('ascii', 'surrogateescape'), part_id, 0])
+        return None
+
+    file_name = headers.get_filename()
+    attachment_id = get_attachment_id(_text(headers.get('X-Attachment-Id')), _text(headers.get('Content-ID')))
+
+    if not selector.select(file_name, attachment_id):
+        return None
+
+    return selector.open_writer(file_name, _text(headers.get('Content-Transfer-Encoding')))
+
+
+def copy_attachment(source, dest, link=False):
+    """
+    Copy a file of the attachment store, or hard link to it. A hard link falls back to a copy across file systems.
+    """
+    from os import link as os_link, remove
+    from os.path import exists, samefile
+    from shutil import copyfile
+
+    if exists(dest):
+        if samefile(source, dest):
+            return
+        remove(dest)
+
+    if link:
+        try:
+            os_link(source, dest)
+            return
+        except OSError as e:
+            logger.debug('Hard link to %s failed, so it is copied: %s' % (source, e))
+
+    copyfile(source, dest)
@@ -0,0 +1,73 @@
+from html.parser import HTMLParser
+
+from .mimeindex import decode_body
+
+
+def extract_text(mime, parts):
+    """
+    Extract the searchable text of a message: the decoded text/plain body, or the HTML-stripped text/html body
+    if the message has no text/plain one. Attachments are not searched.
+
+    :param mime: message bytes.
+    :param parts: MIME layout of the message. See diem.mimeindex.scan_message().
+    :return: str, or None if the message has no text body.
+    """
+    bodies = {}
+
+    for part in parts:
+        content_type = part['content-type']
+        if content_type in ('text/plain', 'text/html') and not part['file-name'] and content_type not in bodies:
+            bodies[content_type] = part
+
+    if 'text/plain' in bodies:
+        return _decode_text(mime, bodies['text/plain'])
+    elif 'text/html' in bodies:
+        return strip_html(_decode_text(mime, bodies['text/html']))
+
+
+def _decode_text(mime, part):
+    offset = part['body-offset']
+    body = decode_body(mime[offset:offset + part['body-length']], part['encoding'])
+
+    try:
+        return body.decode(part['charset'] or 'ascii', 'replace')
+    except LookupError:
+        # unknown charset
+        return body.decode('utf-8', 'replace')
+
+
+def strip_html(html):
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.get_text()
+
+
+class _TextExtractor(HTMLParser):
+    BLOCK_TAGS = {'br', 'p', 'div', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote'}
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+
+    def __init__(self):
+        super(_TextExtractor, self).__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.chunks.append(data)
+
+    def get_text(self):
+        lines = (' '.join(line.split()) for line in ''.join(self.chunks).splitlines())
+        return '\n'.join(line for line in lines if line)
@@ -0,0 +1,49 @@
+from hashlib import sha256
+
+from gmail.attachments import parse_placeholder
+
+from .fulltext import extract_text
+from .mimeindex import scan_message
+
+
+def index_message(mid, mime, compressed_size):
+    """
+    Describe an archived message for the database.
+
+    :param mid:
+    :param mime: message bytes, as stored in the archive.
+    :param compressed_size: size of the message in the archive.
+    :return: dict. 'manifest' key has a tuple: (mid, size, compressed_size, checksum),
+             'parts' key has the MIME layout of the message. See diem.mimeindex.scan_message(),
+             'text' key has the searchable text of the message. See diem.fulltext.extract_text(),
+             and 'attachments' key has a list of attachments split out of the message, as tuples:
+             (mid, part, attachment_id, file_name, hash). See diem.splitter.split_attachments().
+    """
+    parts = scan_message(mime)
+
+    return {
+        'mid': mid,
+        'manifest': (mid, len(mime), compressed_size, sha256(mime).hexdigest()),
+        'parts': parts,
+        'text': extract_text(mime, parts),
+        'attachments': find_split_attachments(mid, mime, parts),
+    }
+
+
+def find_split_attachments(mid, mime, parts):
+    attachments = []
+
+    for part in parts:
+        offset = part['body-offset']
+
+        # mime may be a mmap, which has no startswith().
+        if not part['file-name'] or mime[offset:offset + 16] != b'diem-attachment:':
+            continue
+
+        placeholder = parse_placeholder(mime[offset:offset + part['body-length']])
+
+        if placeholder:
+            attachment_id = part['x-attachment-id'] or (part['content-id'] or '').strip('<>') or None
+            attachments.append((mid, part['part'], attachment_id, part['file-name'], placeholder[0]))
+
+    return attachments
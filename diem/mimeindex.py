@@ -0,0 +1,189 @@
+from base64 import decodebytes, encodebytes
+from email.parser import BytesHeaderParser
+from quopri import decodestring as qp_decodestring
+
+import re
+
+header_end_expr = re.compile(br'\r?\n\r?\n')
+
+
+def scan_message(mime):
+    """
+    Scan the MIME layout of a message.
+
+    Every part, multipart containers included, is described in the order of email.message.Message.walk().
+    Offsets are byte offsets in mime, the decompressed message as stored in the archive.
+
+    :param mime: message bytes.
+    :return: list of dicts. Keys are:
+             part, parent, content-type, charset, encoding, file-name, x-attachment-id, content-id, date,
+             header-offset, body-offset, body-length.
+    """
+    parts = []
+    _scan_part(mime, 0, len(mime), '0', None, parts)
+    return parts
+
+
+def _scan_part(mime, start, end, part_id, parent_id, parts):
+    searched = header_end_expr.search(mime, start, end)
+    if searched:
+        body_start = searched.end()
+    else:
+        body_start = end
+
+    headers = BytesHeaderParser().parsebytes(mime[start:body_start])
+
+    parts.append({
+        'part': part_id,
+        'parent': parent_id,
+        'content-type': headers.get_content_type(),
+        'charset': _text(headers.get_content_charset()),
+        'encoding': _text(headers.get('Content-Transfer-Encoding')),
+        'file-name': _text(headers.get_filename()),
+        'x-attachment-id': _text(headers.get('X-Attachment-Id')),
+        'content-id': _text(headers.get('Content-ID')),
+        'date': _text(headers.get('Date')) if parent_id is None else None,
+        'header-offset': start,
+        'body-offset': body_start,
+        'body-length': end - body_start,
+    })
+
+    boundary = headers.get_boundary()
+
+    if headers.get_content_maintype() != 'multipart' or not boundary:
+        return
+
+    # RFC 2046: a delimiter line is '--boundary' at the beginning of a line,
+    # and the line break before it belongs to the delimiter, not to the preceding part.
+    delimiter_expr = re.compile(
+        br'(?:^|\r?\n)--' + re.escape(boundary.encode('ascii')) + br'(--)?[ \t]*(?:\r?\n|$)',
+        re.MULTILINE
+    )
+
+    child_start = None
+    child_number = 0
+
+    for delimiter in delimiter_expr.finditer(mime, body_start, end):
+        if child_start is not None:
+            child_number += 1
+            child_id = str(child_number) if parent_id is None else '%s.%d' % (part_id, child_number)
+            _scan_part(mime, child_start, delimiter.start(), child_id, part_id, parts)
+
+        if delimiter.group(1):
+            # close delimiter
+            break
+
+        child_start = delimiter.end()
+
+
+def _text(value):
+    """
+    Header values of raw 8-bit headers carry surrogate escapes, which cannot be stored as text.
+    """
+    if value is None:
+        return None
+
+    return str(value).encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
+
+
+def decode_body(body, encoding):
+    """
+    Decode the body of a part by its Content-Transfer-Encoding.
+    """
+    encoding = (encoding or '').strip().lower()
+
+    if encoding == 'base64':
+        return decodebytes(body)
+    elif encoding == 'quoted-printable':
+        return qp_decodestring(body)
+    else:
+        return body
+
+
+class IndexedPart(object):
+    """
+    A part of an archived message, described by its MIME layout index.
+    It provides the subset of email.message.Message interface used by diem, and its payload is read
+    from the archive only when asked, by seeking to the part body.
+    The payload of an attachment split out of the message, whose row has 'hash' key, is read from the attachment store.
+    """
+
+    # header name --> key of the indexed part
+    HEADERS = {
+        'content-transfer-encoding': 'encoding',
+        'x-attachment-id': 'x-attachment-id',
+        'content-id': 'content-id',
+        'date': 'date',
+    }
+
+    def __init__(self, row, reader, attachment_reader=None):
+        self.row = row
+        self.reader = reader
+        self.attachment_reader = attachment_reader
+        self.children = []
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def get(self, name, failobj=None):
+        key = self.HEADERS.get(name.lower())
+        if key and self.row[key] is not None:
+            return self.row[key]
+        return failobj
+
+    def get_content_type(self):
+        return self.row['content-type']
+
+    def get_content_charset(self, failobj=None):
+        return self.row['charset'] or failobj
+
+    def get_filename(self, failobj=None):
+        return self.row['file-name'] or failobj
+
+    def is_multipart(self):
+        return self.row['content-type'].startswith('multipart/')
+
+    def get_payload(self, decode=False):
+        if self.is_multipart():
+            return self.children
+
+        if self.row.get('hash') and self.attachment_reader:
+            payload = self.attachment_reader(self.row['hash'])
+            return payload if decode else encodebytes(payload).decode('ascii')
+
+        body = self.reader(self.row['body-offset'], self.row['body-length'])
+
+        if decode:
+            return decode_body(body, self.row['encoding'])
+        else:
+            return body.decode('ascii', 'surrogateescape')
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            for part in child.walk():
+                yield part
+
+
+def build_indexed_message(rows, reader, attachment_reader=None):
+    """
+    Build a tree of IndexedPart from MIME layout rows.
+
+    :param rows: list of dicts, as scan_message() returns, in walk order.
+    :param reader: callable, reader(offset, length) returns bytes of the decompressed message.
+    :param attachment_reader: callable, attachment_reader(hash) returns the payload of a split attachment.
+    :return: IndexedPart of the root, or None if rows is empty.
+    """
+    parts = {}
+    root = None
+
+    for row in rows:
+        part = IndexedPart(row, reader, attachment_reader)
+        parts[row['part']] = part
+
+        if row['parent'] is None:
+            root = part
+        else:
+            parts[row['parent']].children.append(part)
+
+    return root
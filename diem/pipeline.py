@@ -0,0 +1,84 @@
+from logging import getLogger
+from queue import Queue, Empty, Full
+from threading import Event, Thread
+
+logger = getLogger(__name__)
+
+# Default number of items waiting between two stages.
+DEFAULT_QUEUE_SIZE = 4
+
+# seconds a stage waits on its queue at a time, before it checks whether the pipeline is cancelled.
+POLL_INTERVAL = 0.5
+
+_END = object()
+
+
+class Stage(object):
+    """
+    A pipeline stage. Iterates over a generator in a background thread, and hands its items over
+    through a bounded queue, so that a slow consumer holds the producer back instead of piling items up in memory.
+
+    Stages are chained by passing a stage, as an iterable, to the generator of the next stage.
+    An exception raised in a stage is re-raised to the one iterating over it, and so down to the last consumer.
+
+    Stages of a pipeline share a cancel event. Once it is set, every stage stops waiting on its queues,
+    closes its generator, so that its finally blocks release what it holds, and its thread ends.
+    Set it, and join the stages, when the consumer stops early or fails.
+    """
+
+    def __init__(self, name, iterable, queue_size=DEFAULT_QUEUE_SIZE, cancel=None):
+        self.name = name
+        self.iterable = iterable
+        self.queue = Queue(maxsize=queue_size)
+        self.cancel = cancel or Event()
+
+        self.thread = Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for item in self.iterable:
+                if not self._put((item, None)):
+                    logger.debug('Stage \'%s\' cancelled.' % self.name)
+                    return
+        except Exception as e:
+            logger.error('Stage \'%s\' stopped by an error: %s' % (self.name, e))
+            self._put((_END, e))
+        else:
+            self._put((_END, None))
+        finally:
+            close = getattr(self.iterable, 'close', None)
+            if close:
+                close()
+
+    def _put(self, item):
+        """
+        :return: False if the pipeline is cancelled before item is queued.
+        """
+        while not self.cancel.is_set():
+            try:
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def __iter__(self):
+        while True:
+            try:
+                item, error = self.queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                if self.cancel.is_set():
+                    return
+                continue
+
+            if item is _END:
+                if error:
+                    raise error
+                return
+            yield item
+
+    def join(self):
+        self.thread.join()
@@ -0,0 +1,638 @@
+"""
+Read-only HTTP API of the diary, for a web front end. See serve().
+
+    GET /query?q=<query string>[&limit=N][&offset=N]   diaries, as the query subcommand finds them.
+    GET /search?q=<FTS5 query>[&limit=N][&offset=N]    full-text search.
+    GET /export/<mid>                                  a diary, as the export subcommand converts it.
+    GET /view/<mid>[?content-type=text/plain]          the body of a diary.
+    GET /attachments/<mid>                             attachments of a diary.
+    GET /attachments/<mid>/<attachment id>             an attachment file.
+    GET /status                                        cache statistics.
+
+A mid is decimal, or hexadecimal with '0x'. mids in responses are decimal strings, because a mid does not fit
+in a JavaScript number. Errors are JSON objects: {"error": "..."}. limit is 100 rows by default, and 1000 at most.
+
+The server runs on one asyncio event loop, which never blocks on the database or on the archive.
+Database reads run in a thread of their own, with a connection of its own.
+Decompressing archives and parsing and converting messages run in a pool of worker threads.
+Decompressed messages and converted diaries are kept in an LRU cache, bounded by a byte budget.
+Concurrent requests of a value which is not cached yet wait for the same load, instead of each loading it.
+"""
+from asyncio import current_task, ensure_future, gather, get_running_loop, shield, start_server, wait_for, Event, \
+    IncompleteReadError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+from logging import getLogger
+from signal import SIGINT, SIGTERM
+from threading import Lock
+from time import perf_counter
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import re
+
+from gmail import archive as gmail_archive
+from gmail.attachments import join_attachments
+from gmail.metrics import metrics
+
+from . import diem
+from . import db as diem_db
+
+logger = getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+
+DEFAULT_PORT = 8080
+
+# bytes of decompressed messages and converted diaries kept in memory
+DEFAULT_CACHE_SIZE = 128 * 1024 * 1024
+
+DEFAULT_WORKERS = 4
+
+# rows of /query and /search, unless the request asks for a limit.
+DEFAULT_LIMIT = 100
+
+# rows of /query and /search a request may ask for at most.
+MAX_LIMIT = 1000
+
+# a request line or a header line longer than this is refused.
+MAX_LINE_SIZE = 16 * 1024
+
+MAX_HEADERS = 100
+
+# idle seconds before a keep-alive connection is closed.
+KEEP_ALIVE_TIMEOUT = 30
+
+# seconds a client has to send the headers and the body of a request, once its request line is read.
+REQUEST_TIMEOUT = 10
+
+STATUS_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+routes = [
+    (re.compile(r'^/query$'), 'query'),
+    (re.compile(r'^/search$'), 'search'),
+    (re.compile(r'^/export/([^/]+)$'), 'export'),
+    (re.compile(r'^/view/([^/]+)$'), 'view'),
+    (re.compile(r'^/attachments/([^/]+)$'), 'attachments'),
+    (re.compile(r'^/attachments/([^/]+)/([^/]+)$'), 'attachment'),
+    (re.compile(r'^/status$'), 'status'),
+]
+
+mid_expr = re.compile(r'^0x([0-9a-f]{1,16})$', re.IGNORECASE)
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+class ByteLRUCache(object):
+    """
+    LRU cache bounded by the total size of its values, in bytes. A value larger than the budget is not cached.
+    Values are bytes, or anything else whose size is given when it is put.
+    It is shared by the event loop and the workers.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+
+        # keys are tuples, whose first item is the kind of the value.
+        if entry is None:
+            metrics.increment('cache_misses_total', kind=key[0])
+            return None
+
+        metrics.increment('cache_hits_total', kind=key[0])
+        return entry[0]
+
+    def put(self, key, value, size=None):
+        size = len(value) if size is None else size
+
+        if size > self.budget:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.budget:
+                evicted_key, (evicted, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def get_stats(self):
+        with self.lock:
+            return OrderedDict([
+                ('entries', len(self.entries)),
+                ('bytes', self.size),
+                ('budget', self.budget),
+                ('hits', self.hits),
+                ('misses', self.misses),
+            ])
+
+
+class DiemServer(object):
+    """
+    :param conn: database connection. The server reads the database through a connection of its own,
+                 opened on the same file.
+    :param archive_path:
+    :param timezone: timezone of exported dates, and of 'today' queries.
+    :param cache_size: byte budget of the cache.
+    :param workers: number of worker threads.
+    """
+
+    def __init__(self, conn, archive_path, timezone, cache_size=DEFAULT_CACHE_SIZE, workers=DEFAULT_WORKERS):
+        self.db_file = diem_db.get_db_file(conn)
+        if not self.db_file:
+            raise Exception('An in-memory database cannot be served.')
+
+        self.archive_path = archive_path
+        self.archive_dir = gmail_archive.get_archive_dir(archive_path)
+        self.timezone = timezone
+        self.cache = ByteLRUCache(cache_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='diem-worker')
+        # a sqlite connection is used by the thread which opened it. See open_db_conn().
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='diem-db',
+                                              initializer=self.open_db_conn)
+        self.db_conn = None
+        # cache key --> future of the value being loaded
+        self.pending = {}
+        self.server = None
+        # connection handler task --> its writer
+        self.connections = {}
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """
+        :return: tuple of (host, port) the server listens on. Port 0 picks a free port.
+        """
+        self.server = await start_server(self.handle_connection, host, port, limit=MAX_LINE_SIZE)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        """
+        Stop listening, close idle connections, and wait for the requests being answered.
+        """
+        if self.server:
+            self.server.close()
+
+        for writer in self.connections.values():
+            writer.close()
+
+        await gather(*self.connections.keys(), return_exceptions=True)
+        self.executor.shutdown(wait=True)
+        self.db_executor.submit(self.close_db_conn).result()
+        self.db_executor.shutdown(wait=True)
+
+    async def handle_connection(self, reader, writer):
+        task = current_task()
+        self.connections[task] = writer
+
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+
+                method, target, version, headers = request
+                keep_alive = (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close') or \
+                             (version == 'HTTP/1.0' and headers.get('connection', '').lower() == 'keep-alive')
+
+                status, content_type, body, extra_headers = await self.respond(method, target)
+
+                response_headers = [
+                    ('Content-Type', content_type),
+                    ('Content-Length', str(len(body))),
+                    ('Connection', 'keep-alive' if keep_alive else 'close'),
+                ] + extra_headers
+
+                writer.write(('HTTP/1.1 %d %s\r\n%s\r\n' % (
+                    status, STATUS_REASONS.get(status, ''), ''.join('%s: %s\r\n' % header for header in response_headers)
+                )).encode('latin-1'))
+                if method != 'HEAD':
+                    writer.write(body)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+
+        except (ConnectionError, IncompleteReadError, TimeoutError):
+            pass
+
+        except RequestError as e:
+            body = dumps({'error': str(e)}).encode('utf-8')
+            writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                          'Connection: close\r\n\r\n' % (e.status, STATUS_REASONS[e.status], len(body))).encode('latin-1'))
+            writer.write(body)
+
+        finally:
+            writer.close()
+            self.connections.pop(task, None)
+
+    async def read_request(self, reader):
+        """
+        :return: tuple of (method, target, version, headers), or None if the client closed the connection.
+        """
+        try:
+            request_line = await wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+        except ValueError:
+            raise RequestError(400, 'Request line too long.')
+
+        if not request_line.strip():
+            return None
+
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise RequestError(400, 'Invalid request line.')
+
+        # a client which stops in the middle of a request does not hold its connection open.
+        headers = await wait_for(self.read_headers(reader), REQUEST_TIMEOUT)
+
+        return parts[0], parts[1], parts[2], headers
+
+    async def read_headers(self, reader):
+        """
+        Read the headers of a request, and its body, which is ignored.
+
+        :return: dict of lower-case header names --> values.
+        """
+        headers = {}
+
+        for i in range(MAX_HEADERS + 1):
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise RequestError(400, 'Header line too long.')
+
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            name, separator, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise RequestError(400, 'Too many headers.')
+
+        # every endpoint is read-only. A request body is read, and ignored.
+        if headers.get('content-length', '0').isdigit() and int(headers.get('content-length', '0')):
+            await reader.readexactly(int(headers['content-length']))
+
+        return headers
+
+    async def respond(self, method, target):
+        """
+        :return: tuple of (status, content type, body bytes, list of extra headers)
+        """
+        begin = perf_counter()
+        endpoint = 'unknown'
+
+        try:
+            if method not in ('GET', 'HEAD'):
+                raise RequestError(405, 'Method %s is not allowed.' % method)
+
+            url = urlsplit(target)
+            query = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+
+            for expr, name in routes:
+                matched = expr.match(url.path)
+                if matched:
+                    endpoint = name
+                    handler = getattr(self, 'handle_' + name)
+                    response = await handler(query, *[unquote(group) for group in matched.groups()])
+                    break
+            else:
+                raise RequestError(404, 'No such endpoint: %s' % url.path)
+
+            if isinstance(response, tuple):
+                content_type, body, extra_headers = response
+            else:
+                content_type, body, extra_headers = 'application/json', response, []
+
+            status = 200
+
+        except RequestError as e:
+            status = e.status
+            content_type, body, extra_headers = 'application/json', dumps({'error': str(e)}).encode('utf-8'), []
+
+        except Exception as e:
+            logger.exception('%s %s failed.' % (method, target))
+            status = 500
+            content_type, body, extra_headers = 'application/json', dumps({'error': str(e)}).encode('utf-8'), []
+
+        metrics.increment('http_requests_total', endpoint=endpoint, status=status)
+        metrics.observe('http_request_seconds', perf_counter() - begin, endpoint=endpoint)
+        logger.info('%s %s %d %d' % (method, target, status, len(body)))
+
+        return status, content_type + ('; charset=utf-8' if content_type == 'application/json' else ''), body, \
+            extra_headers
+
+    def run_in_worker(self, func, *args):
+        return get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def run_in_db(self, func, *args):
+        """
+        Call func(conn, *args) in the database thread.
+        """
+        return get_running_loop().run_in_executor(self.db_executor, lambda: func(self.db_conn, *args))
+
+    def open_db_conn(self):
+        self.db_conn = diem_db.open_db(self.db_file)
+
+    def close_db_conn(self):
+        if self.db_conn:
+            self.db_conn.close()
+            self.db_conn = None
+
+    async def get_cached(self, key, load):
+        """
+        :param load: coroutine function which loads the value.
+        :return: the cached value of key, or the value loaded and cached. A load in flight is shared.
+        """
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+
+        future = self.pending.get(key)
+
+        if future is None:
+            async def _load():
+                try:
+                    loaded = await load()
+                    self.cache.put(key, loaded)
+                    return loaded
+                finally:
+                    del self.pending[key]
+
+            future = self.pending[key] = ensure_future(_load())
+
+        # a request which goes away does not cancel the load, which others may be waiting for.
+        return await shield(future)
+
+    # endpoints ##################################################################################################
+
+    async def handle_query(self, query):
+        query_string = parse_query_string(get_parameter(query, 'q'))
+        limit, offset = get_limit(query)
+
+        try:
+            rows = await self.run_in_db(
+                lambda conn: diem.query(conn, query_string, limit, offset, self.timezone).fetchall()
+            )
+        except Exception as e:
+            raise RequestError(400, str(e))
+
+        return dumps([
+            OrderedDict([('mid', str(mid)), ('tid', str(tid)), ('diary-date', diary_date)])
+            for mid, tid, diary_date in rows
+        ]).encode('utf-8')
+
+    async def handle_search(self, query):
+        limit, offset = get_limit(query)
+
+        try:
+            rows = await self.run_in_db(diem.search, get_parameter(query, 'q'), limit, offset)
+        except Exception as e:
+            raise RequestError(400, str(e))
+
+        return dumps([
+            OrderedDict([('mid', str(mid)), ('diary-date', diary_date), ('snippet', snippet)])
+            for mid, diary_date, snippet in rows
+        ]).encode('utf-8')
+
+    async def handle_export(self, query, mid):
+        mid = parse_mid(mid)
+        diary_date = await self.run_in_db(diem_db.get_diary_date, mid)
+
+        if not diary_date:
+            raise RequestError(404, 'MID %d is not a diary.' % mid)
+
+        async def _export():
+            rows = await self.run_in_db(diem.get_mime_layout, mid)
+            mime = await self.load_message(mid)
+            return await self.run_in_worker(self.export_message, mid, mime, rows, diary_date)
+
+        return await self.get_cached(('export', mid, diary_date), _export)
+
+    async def handle_view(self, query, mid):
+        mid = parse_mid(mid)
+        content_type = query.get('content-type', 'text/html')
+
+        if content_type not in ('text/html', 'text/plain'):
+            raise RequestError(400, 'Invalid content-type: %s' % content_type)
+
+        async def _view():
+            rows = await self.run_in_db(diem.get_mime_layout, mid)
+            mime = await self.load_message(mid)
+            return await self.run_in_worker(self.view_message, mid, mime, rows, content_type)
+
+        return await self.get_cached(('view', mid, content_type), _view)
+
+    async def handle_attachments(self, query, mid):
+        mid = parse_mid(mid)
+        rows = await self.get_layout(mid)
+
+        return dumps([
+            OrderedDict([
+                ('part', row['part']),
+                ('attachment-id', get_attachment_id(row)),
+                ('file-name', row['file-name']),
+                ('content-type', row['content-type']),
+            ])
+            for row in rows if row['file-name'] and not row['content-type'].startswith('multipart/')
+        ]).encode('utf-8')
+
+    async def handle_attachment(self, query, mid, attachment_id):
+        mid = parse_mid(mid)
+
+        for row in await self.get_layout(mid):
+            if row['file-name'] and attachment_id in (get_attachment_id(row), row['part']):
+                break
+        else:
+            raise RequestError(404, 'MID %d has no attachment %s.' % (mid, attachment_id))
+
+        if row.get('hash'):
+            payload = await self.run_in_worker(self.read_attachment, row['hash'])
+        else:
+            mime = await self.load_message(mid)
+            payload = await self.run_in_worker(decode_part, mime, row)
+
+        disposition = 'attachment; filename*=UTF-8\'\'%s' % quote(row['file-name'])
+
+        return row['content-type'], payload, [('Content-Disposition', disposition)]
+
+    async def handle_status(self, query):
+        return dumps(OrderedDict([('cache', self.cache.get_stats())])).encode('utf-8')
+
+    # loading, in threads ########################################################################################
+
+    async def load_message(self, mid):
+        """
+        :return: the message as stored, decompressed. Split attachments are left as placeholders.
+        """
+        return await self.get_cached(('archive', mid), lambda: self.run_in_worker(self.read_archive, mid))
+
+    async def get_layout(self, mid):
+        """
+        :return: MIME layout rows of the message, scanned from the archive if the message is not indexed.
+        """
+        rows = await self.run_in_db(diem.get_mime_layout, mid)
+
+        if not rows:
+            from .mimeindex import scan_message
+
+            rows = await self.run_in_worker(scan_message, await self.load_message(mid))
+
+        return rows
+
+    def read_archive(self, mid):
+        try:
+            return gmail_archive.get_archive(mid, self.archive_path, as_stored=True)
+        except OSError:
+            raise RequestError(404, 'MID %d is not archived.' % mid)
+
+    def read_attachment(self, digest):
+        from gmail.attachments import AttachmentStore
+
+        return AttachmentStore(self.archive_dir).get(digest)
+
+    def build_message(self, mime, rows):
+        if rows:
+            return diem.build_message(rows, lambda offset, length: mime[offset:offset + length], self.archive_path)
+        else:
+            return join_attachments(mime, self.archive_dir)
+
+    def export_message(self, mid, mime, rows, diary_date):
+        from .converters import DefaultJSONConverter, DiaryTemplateFactory
+
+        exported = DefaultJSONConverter(
+            message=self.build_message(mime, rows),
+            diary_date=diary_date,
+            timezone=self.timezone
+        ).convert()
+        exported['mid'] = str(mid)
+
+        return DiaryTemplateFactory.as_json(exported).encode('utf-8')
+
+    def view_message(self, mid, mime, rows, content_type):
+        from .converters import DefaultJSONConverter
+
+        parsed = DefaultJSONConverter.parse(self.build_message(mime, rows))
+        subpart = DefaultJSONConverter.find_subpart(parsed, content_type)
+
+        if not subpart:
+            raise RequestError(404, 'MID %d has no %s body.' % (mid, content_type))
+
+        content = str(subpart.get_payload(decode=True), encoding=subpart.get_content_charset() or 'ascii',
+                      errors='replace')
+
+        return dumps(OrderedDict([
+            ('mid', str(mid)),
+            ('content-type', content_type),
+            ('content', content),
+        ])).encode('utf-8')
+
+
+def decode_part(mime, row):
+    from .mimeindex import decode_body
+
+    offset = row['body-offset']
+    return decode_body(mime[offset:offset + row['body-length']], row['encoding'])
+
+
+def get_attachment_id(row):
+    from .extractor import get_attachment_id as _get_attachment_id
+
+    return _get_attachment_id(row['x-attachment-id'], row['content-id'])
+
+
+def get_parameter(query, name):
+    if not query.get(name):
+        raise RequestError(400, 'Parameter \'%s\' is required.' % name)
+    return query[name]
+
+
+def get_limit(query):
+    try:
+        limit, offset = int(query.get('limit', DEFAULT_LIMIT)), int(query.get('offset', 0))
+    except ValueError:
+        raise RequestError(400, 'limit and offset must be integers.')
+
+    # SQLite takes a negative limit for no limit at all.
+    if not 0 <= limit <= MAX_LIMIT or offset < 0:
+        raise RequestError(400, 'limit must be 0 to %d, and offset must not be negative.' % MAX_LIMIT)
+
+    return limit, offset
+
+
+def parse_mid(value):
+    matched = mid_expr.match(value)
+
+    if matched:
+        return int(matched.group(1), 16)
+    elif value.isdigit():
+        return int(value)
+    else:
+        raise RequestError(400, 'Invalid mid: %s' % value)
+
+
+def parse_query_string(value):
+    """
+    Convert a mid in a query string, as the query subcommand does. 4 digits are a year, not a mid.
+    """
+    matched = mid_expr.match(value)
+
+    if matched:
+        return int(matched.group(1), 16)
+    elif value.isdigit() and len(value) != 4:
+        return int(value)
+    else:
+        return value
+
+
+def serve(conn, archive_path, timezone, host=DEFAULT_HOST, port=DEFAULT_PORT, cache_size=DEFAULT_CACHE_SIZE,
+          workers=DEFAULT_WORKERS):
+    """
+    Run the HTTP API until SIGINT or SIGTERM.
+    """
+    from asyncio import run
+
+    async def _main():
+        server = DiemServer(conn, archive_path, timezone, cache_size, workers)
+        stopped = Event()
+        loop = get_running_loop()
+
+        for signal_number in (SIGINT, SIGTERM):
+            loop.add_signal_handler(signal_number, stopped.set)
+
+        try:
+            address = await server.start(host, port)
+            logger.info('Serving on http://%s:%d/ with %d worker(s) and a %d byte cache.' % (
+                address[0], address[1], workers, cache_size
+            ))
+            await stopped.wait()
+        finally:
+            await server.close()
+
+        logger.info('Server stopped. Cache: %s' % dict(server.cache.get_stats()))
+
+    run(_main())
@@ -0,0 +1,67 @@
+from base64 import decodebytes
+from binascii import Error as BinasciiError
+
+from gmail.attachments import AttachmentStore, encode_base64, make_placeholder
+
+from .mimeindex import scan_message
+
+# Attachments smaller than this stay inline. Splitting them would save little, for a file each.
+SPLIT_MIN_SIZE = 4 * 1024
+
+
+def split_attachments(mime, archive_dir, min_size=SPLIT_MIN_SIZE):
+    """
+    Move base64 attachment payloads of a message into the attachment store of the archive,
+    leaving placeholders in their place. See gmail.attachments.
+
+    A payload is split only if encoding it again gives back the very same bytes,
+    so gmail.attachments.join_attachments() restores the message exactly.
+
+    :param mime: message bytes.
+    :return: message bytes to store.
+    """
+    store = None
+    chunks = []
+    position = 0
+
+    for part in scan_message(mime):
+        if part['content-type'].startswith('multipart/') or not part['file-name']:
+            continue
+
+        if (part['encoding'] or '').strip().lower() != 'base64':
+            continue
+
+        start = part['body-offset']
+        end = start + part['body-length']
+        body = mime[start:end]
+
+        line_break = b'\r\n' if b'\r\n' in body else b'\n'
+        line_length = body.find(line_break)
+        if line_length <= 0:
+            line_length = len(body)
+
+        try:
+            payload = decodebytes(body)
+        except BinasciiError:
+            continue
+
+        if len(payload) < min_size:
+            continue
+
+        trailing = body.endswith(line_break)
+        if encode_base64(payload, line_length, line_break, trailing) != body:
+            continue
+
+        store = store or AttachmentStore(archive_dir)
+        digest = store.put(payload)
+
+        chunks.append(mime[position:start])
+        chunks.append(make_placeholder(digest, line_length, line_break, trailing))
+        position = end
+
+    if not chunks:
+        return mime
+
+    chunks.append(mime[position:])
+
+    return b''.join(chunks)
@@ -0,0 +1,645 @@
+"""
+Asyncio engine of the Gmail API: listing message boxes, and getting messages in metadata or raw format,
+with the REST endpoints called directly over a pool of keep-alive HTTP/1.1 connections.
+
+A request in flight costs a socket and a coroutine, not a thread and an httplib2.Http with a service of its own,
+so hundreds of requests may be in flight from one thread. Requests take their quota units from the token bucket
+of gmail.scheduler for the same email, and run within its adaptive concurrency limit, so this engine and the
+blocking one share the quota of a user, and back off the same way when they are throttled.
+
+    async with AsyncGmail(email, StorageToken(storage_file)) as gmail:
+        structure = await gmail.fetch_structure(label_id, latest_mid)
+        async for mid, message in gmail.iter_mails(mid_list):
+            ...
+
+Blocking code uses it through AsyncFetcher, which runs the event loop in a thread of its own.
+"""
+from asyncio import Condition, IncompleteReadError, Lock, Semaphore, gather, get_running_loop, new_event_loop, \
+    open_connection, run_coroutine_threadsafe, sleep, wait_for
+from collections import deque
+from json import loads
+from logging import getLogger
+from random import uniform
+from threading import Thread
+from urllib.parse import quote, urlencode, urlsplit
+
+import zlib
+
+from .metrics import metrics
+from .scheduler import get_scheduler, classify_status, get_retry_after, NotFoundError, BACKOFF_BASE, BACKOFF_CAP, \
+    MAX_RETRIES, NOT_FOUND, FATAL, RETRY, THROTTLED, QUOTA_COSTS
+
+logger = getLogger(__name__)
+
+GMAIL_ROOT_URL = 'https://gmail.googleapis.com/'
+
+# connections kept to the API host, which is also the number of requests in flight.
+DEFAULT_MAX_CONNECTIONS = 100
+
+# seconds a request may take, from sending it until its whole response is read.
+DEFAULT_TIMEOUT = 120
+
+# a status line, or a header line, longer than this is a broken response.
+MAX_LINE_SIZE = 64 * 1024
+
+# seconds a request waits at most for a free slot of the concurrency limit, before it tries again.
+# A slot freed by this client wakes it at once, but one freed by another thread does not.
+SLOT_POLL_INTERVAL = 0.05
+
+MAX_HEADERS = 100
+
+
+class HttpError(Exception):
+    """
+    Raised on a response of status 400 or more. Attributes follow googleapiclient.errors.HttpError,
+    so that gmail.scheduler can read the reason and Retry-After of it.
+    """
+
+    def __init__(self, status, reason, headers, content):
+        super(HttpError, self).__init__('HTTP %d %s: %s' % (status, reason, content[:200].decode('utf-8', 'replace')))
+        self.status = status
+        self.resp = headers
+        self.content = content
+
+
+def classify_error(error):
+    """
+    :return: error class of gmail.scheduler. See gmail.scheduler.classify_error().
+    """
+    if isinstance(error, HttpError):
+        return classify_status(error.status, error)
+
+    elif isinstance(error, (OSError, IncompleteReadError)):
+        # connection reset, timeout, name resolution failure, a response cut short, ...
+        return RETRY
+
+    return FATAL
+
+
+class ConnectionPool(object):
+    """
+    HTTP/1.1 connections to one host, kept alive and reused by requests, one request at a time per connection.
+
+    :param url: scheme, host and port of the connections. http and https are supported.
+    :param max_connections: connections open at most. Requests beyond them wait for a connection to be free.
+    :param timeout: seconds a request may take.
+    """
+
+    def __init__(self, url, max_connections=DEFAULT_MAX_CONNECTIONS, timeout=DEFAULT_TIMEOUT):
+        parts = urlsplit(url)
+
+        if parts.scheme not in ('http', 'https'):
+            raise Exception('Invalid URL scheme: %s' % url)
+
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.secure = parts.scheme == 'https'
+        self.host_header = parts.netloc
+        self.timeout = timeout
+        self.semaphore = Semaphore(max_connections)
+        self.idle = []
+        self.ssl_context = None
+
+    async def request(self, method, path, headers):
+        """
+        :param method: 'GET', or another method without a request body.
+        :param path: path and query string of the request.
+        :param headers: list of (name, value) tuples, besides Host and Connection.
+        :return: tuple of (status, reason, dict of lower-case header names --> values, body bytes)
+        """
+        async with self.semaphore:
+            while True:
+                reused = bool(self.idle)
+                reader, writer = self.idle.pop() if reused else await self.connect()
+
+                try:
+                    response, keep_alive = await wait_for(
+                        self.exchange(reader, writer, method, path, headers), self.timeout
+                    )
+
+                except (ConnectionError, IncompleteReadError) as e:
+                    writer.close()
+                    # the server may close an idle connection at any time. The request is sent again, once,
+                    # on a new connection, which is safe as requests of this engine never change anything.
+                    if reused:
+                        logger.debug('Idle connection to %s closed: %s. Reconnecting.' % (self.host, e))
+                        continue
+                    raise
+
+                except BaseException:
+                    writer.close()
+                    raise
+
+                if keep_alive:
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+
+                return response
+
+    async def connect(self):
+        ssl_context = None
+
+        if self.secure:
+            if self.ssl_context is None:
+                from ssl import create_default_context
+                self.ssl_context = create_default_context()
+            ssl_context = self.ssl_context
+
+        metrics.increment('gmail_connections_total')
+
+        return await wait_for(
+            open_connection(self.host, self.port, ssl=ssl_context, server_hostname=self.host if ssl_context else None,
+                            limit=MAX_LINE_SIZE),
+            self.timeout
+        )
+
+    async def exchange(self, reader, writer, method, path, headers):
+        """
+        Send a request, and read its response.
+
+        :return: tuple of (response, whether the connection may be reused)
+        """
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % self.host_header, 'Connection: keep-alive']
+        lines.extend('%s: %s' % header for header in headers)
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise IncompleteReadError(b'', None)
+
+        parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/') or not parts[1].isdigit():
+            raise ConnectionError('Invalid status line: %r' % status_line[:100])
+
+        version, status, reason = parts[0], int(parts[1]), parts[2] if len(parts) > 2 else ''
+        response_headers = await read_headers(reader)
+        connection = response_headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = await read_chunked(reader)
+        elif 'content-length' in response_headers:
+            try:
+                length = int(response_headers['content-length'])
+            except ValueError:
+                raise ConnectionError('Invalid Content-Length: %r' % response_headers['content-length'][:100])
+            body = await reader.readexactly(length)
+        else:
+            body = await reader.read()
+            keep_alive = False
+
+        if response_headers.get('content-encoding', '').lower() == 'gzip':
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            except zlib.error as e:
+                raise ConnectionError('Broken gzip body: %s' % e)
+
+        metrics.increment('gmail_response_bytes_total', len(body))
+
+        return (status, reason, response_headers, body), keep_alive
+
+    async def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+
+
+async def read_headers(reader):
+    """
+    :return: dict of lower-case header names --> values.
+    """
+    headers = {}
+
+    for i in range(MAX_HEADERS + 1):
+        line = await reader.readline()
+
+        if line in (b'\r\n', b'\n'):
+            return headers
+        elif not line:
+            raise IncompleteReadError(b'', None)
+
+        name, separator, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    raise ConnectionError('Too many headers.')
+
+
+async def read_chunked(reader):
+    """
+    :return: body of a chunked response.
+    :raise ConnectionError: on a malformed chunk size, which is a broken response, retried as a network error is.
+    :raise IncompleteReadError: if the body is cut short.
+    """
+    chunks = []
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise IncompleteReadError(b'', None)
+
+        try:
+            size = int(line.split(b';', 1)[0], 16)
+        except ValueError:
+            raise ConnectionError('Invalid chunk size: %r' % line[:100])
+
+        if not size:
+            # trailers, up to the empty line
+            await read_headers(reader)
+            return b''.join(chunks)
+
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+class StorageToken(object):
+    """
+    OAuth access token of an oauth2client Storage file, the one gmail.api.get_service() is authorized with.
+
+    oauth2client is blocking, so the credentials are loaded and refreshed in a worker thread.
+    A refreshed token is written back to the storage file by oauth2client, as it is by the blocking engine.
+    """
+
+    def __init__(self, storage_file):
+        self.storage_file = storage_file
+        self.credentials = None
+        self.lock = Lock()
+
+    async def get(self):
+        """
+        :return: a valid access token. It is refreshed first if it is expired.
+        """
+        if self.credentials is None or self.credentials.access_token_expired:
+            await self.refresh()
+
+        return self.credentials.access_token
+
+    async def refresh(self, rejected=None):
+        """
+        Load the credentials, and refresh the access token if it is expired, or rejected by the server.
+        Requests rejected at once refresh the token once.
+
+        :param rejected: access token the server responded 401 to.
+        """
+        async with self.lock:
+            if self.credentials is not None and not self.credentials.access_token_expired and \
+                    self.credentials.access_token != rejected:
+                return
+
+            self.credentials = await get_running_loop().run_in_executor(None, self.load, rejected)
+
+    def load(self, rejected):
+        from httplib2 import Http
+        from .api import get_credentials
+
+        credentials = get_credentials(self.storage_file)
+
+        if credentials.access_token_expired or credentials.access_token == rejected:
+            logger.info('Refreshing the access token of %s.' % self.storage_file)
+            credentials.refresh(Http())
+
+        return credentials
+
+
+class AsyncGmail(object):
+    """
+    Gmail API client of one user, on the running event loop.
+
+    :param email:
+    :param token: object with coroutines get() and refresh(rejected), like StorageToken.
+    :param root_url: URL to send requests to instead of GMAIL_ROOT_URL, e.g. a local stand-in server.
+    :param max_connections: requests in flight at most, each on a connection of its own.
+    :param timeout: seconds a request may take.
+    :param max_retries: retries of a throttled or failed request.
+    """
+
+    def __init__(self, email, token, root_url=GMAIL_ROOT_URL, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 timeout=DEFAULT_TIMEOUT, max_retries=MAX_RETRIES):
+        self.email = email
+        self.token = token
+        self.base_path = urlsplit(root_url).path.rstrip('/') + '/gmail/v1/users/%s/' % quote(email, safe='')
+        self.pool = ConnectionPool(root_url, max_connections, timeout)
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        # notified when this client gives a slot of the concurrency limit back.
+        self.slot_released = Condition()
+
+        # max_connections is the upper bound of concurrent requests, as workers are for gmail.fetch.iter_mails().
+        get_scheduler(email).set_max_concurrency(max_connections)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def acquire_slot(self, scheduler):
+        """
+        Wait for a slot of the gmail.scheduler.AdaptiveLimit, and of the budget of the scheduler if it has one,
+        without blocking the loop.
+
+        :return: the budget a slot is taken from, or None. Give it to release_slot().
+        """
+        async with self.slot_released:
+            while True:
+                if scheduler.limit.try_acquire():
+                    budget = scheduler.budget
+                    if not budget or budget.acquire(blocking=False):
+                        return budget
+                    scheduler.limit.release()
+
+                try:
+                    await wait_for(self.slot_released.wait(), SLOT_POLL_INTERVAL)
+                except TimeoutError:
+                    pass
+
+    async def release_slot(self, scheduler, budget):
+        if budget:
+            budget.release()
+        scheduler.limit.release()
+
+        async with self.slot_released:
+            self.slot_released.notify()
+
+    async def call(self, method, path, params):
+        """
+        GET a resource of the user, within the quota and the concurrency limit of the scheduler of email.
+        Throttled and transient errors are retried with jittered exponential backoff, and throttling cuts
+        the concurrency limit, as gmail.scheduler does.
+
+        :param method: one of gmail.scheduler.QUOTA_COSTS.
+        :param path: path under users/<email>/.
+        :param params: list of (name, value) tuples of the query string.
+        :return: parsed JSON response.
+        :raise NotFoundError: on 404 or 410.
+        """
+        scheduler = get_scheduler(self.email)
+        target = self.base_path + path + ('?' + urlencode(params) if params else '')
+        refreshed = False
+        attempt = 0
+
+        while True:
+            wait = scheduler.bucket.try_acquire(QUOTA_COSTS[method])
+            while wait:
+                await sleep(wait)
+                wait = scheduler.bucket.try_acquire(QUOTA_COSTS[method])
+
+            budget = await self.acquire_slot(scheduler)
+
+            metrics.increment('gmail_requests_total', method=method)
+            metrics.increment('gmail_messages_total', method=method)
+
+            try:
+                with metrics.timer('gmail_request_seconds', method=method):
+                    token = await self.token.get()
+                    status, reason, headers, body = await self.pool.request('GET', target, [
+                        ('Authorization', 'Bearer %s' % token),
+                        ('Accept', 'application/json'),
+                        ('Accept-Encoding', 'gzip'),
+                    ])
+
+                if status >= 400:
+                    raise HttpError(status, reason, headers, body)
+
+                response = loads(body.decode('utf-8'))
+
+            except HttpError as e:
+                if e.status == 401 and not refreshed:
+                    refreshed = True
+                    await self.token.refresh(token)
+                    continue
+                error = e
+
+            except (OSError, IncompleteReadError) as e:
+                error = e
+
+            else:
+                scheduler.limit.on_success()
+                return response
+
+            finally:
+                await self.release_slot(scheduler, budget)
+
+            error_class = classify_error(error)
+            metrics.increment('gmail_errors_total', error_class=error_class)
+
+            if error_class == NOT_FOUND:
+                raise NotFoundError(str(error))
+
+            if error_class == FATAL or attempt >= self.max_retries:
+                raise error
+
+            if error_class == THROTTLED:
+                scheduler.on_throttled()
+
+            wait = get_retry_after(error)
+            if wait is None:
+                wait = uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+            logger.warning('Request failed (%s): %s. Retrying in %.2f sec.' % (error_class, error, wait))
+
+            attempt += 1
+            metrics.increment('gmail_retries_total')
+            await sleep(wait)
+
+    async def list_messages_page(self, label_id, page_token=''):
+        """
+        :return: tuple of (list of tuples: (message_id, thread_id), next page token). See gmail.fetch.
+        """
+        params = [('labelIds', label_id), ('includeSpamTrash', 'false')]
+        if page_token:
+            params.append(('pageToken', page_token))
+
+        response = await self.call('messages.list', 'messages', params)
+
+        output = [(int(message['id'], 16), int(message['threadId'], 16)) for message in response.get('messages', [])]
+
+        return output, response.get('nextPageToken', '')
+
+    async def iter_structure(self, label_id, latest_mid):
+        """
+        List message_id, thread_id of message box page by page, from the newest message until latest_mid.
+
+        :return: async generator of lists of tuples: (message_id, thread_id)
+        """
+        page_token = ''
+        first_loop = True
+
+        while page_token or first_loop:
+            first_loop = False
+
+            messages, page_token = await self.list_messages_page(label_id, page_token)
+
+            output = []
+
+            for message_id, thread_id in messages:
+                if message_id <= latest_mid:
+                    page_token = ''
+                    break
+
+                output.append((message_id, thread_id))
+
+            if output:
+                yield output
+
+    async def fetch_structure(self, label_id, latest_mid):
+        """
+        :return: list of tuples: (message_id, thread_id)
+        """
+        output = []
+
+        async for page in self.iter_structure(label_id, latest_mid):
+            output.extend(page)
+
+        return output
+
+    async def fetch_mail(self, message_id, message_format='raw'):
+        """
+        :param message_id:
+        :param message_format: 'raw', 'metadata', or 'minimal'
+        :return: response, like gmail.fetch.fetch_mail(), or None if the message does not exist.
+        """
+        params = [('format', message_format)]
+        if message_format == 'metadata':
+            params.append(('metadataHeaders', 'Date'))
+
+        try:
+            return await self.call('messages.get', 'messages/%x' % message_id, params)
+
+        except NotFoundError:
+            logger.error('Email address \'%s\', message id: %d (0x%x) not found.' % (self.email, message_id, message_id))
+            return None
+
+    async def fetch_mails(self, mid_list, message_format='raw'):
+        """
+        Fetch mails of mid_list at once.
+
+        A message which still fails after its retries is never taken for a missing one: every request is waited for,
+        failed ones are logged, and then the error of the first one is raised, as gmail.fetch.iter_mails() raises it.
+
+        :return: list of (message_id, response) tuples in the order of mid_list.
+                 response is None if the message does not exist.
+        """
+        results = await gather(*[self.fetch_mail(mid, message_format) for mid in mid_list], return_exceptions=True)
+        errors = []
+
+        for mid, result in zip(mid_list, results):
+            if isinstance(result, BaseException):
+                logger.error('Request of message id %d (0x%x) failed: %s' % (mid, mid, result))
+                errors.append(result)
+
+        if errors:
+            raise errors[0]
+
+        return list(zip(mid_list, results))
+
+    async def iter_mails(self, mid_list, message_format='raw', window=None):
+        """
+        Fetch mails of mid_list, with up to window requests in flight, and yield them in the order of mid_list.
+
+        :param window: requests in flight at most, and responses held at most. Twice max_connections by default.
+        :return: async generator of tuples: (message_id, response). response is None if the message does not exist.
+        :raise: the error of a message which still fails after its retries. See fetch_mails().
+        """
+        loop = get_running_loop()
+        window = window or self.max_connections * 2
+        mids = iter(mid_list)
+        pending = deque()
+
+        try:
+            for mid in mids:
+                pending.append((mid, loop.create_task(self.fetch_mail(mid, message_format))))
+                if len(pending) >= window:
+                    mid, task = pending.popleft()
+                    yield mid, await task
+
+            while pending:
+                mid, task = pending.popleft()
+                yield mid, await task
+
+        finally:
+            for mid, task in pending:
+                task.cancel()
+
+
+class AsyncFetcher(object):
+    """
+    AsyncGmail for blocking callers: the client runs on an event loop in a daemon thread,
+    and iter_mails() is a plain generator, like gmail.fetch.iter_mails().
+
+        with AsyncFetcher(email, StorageToken(storage_file)) as fetcher:
+            fetch_and_archive(None, email, archive_path, mid_list, mails=fetcher.iter_mails(mid_list))
+
+    :param email:
+    :param token: See AsyncGmail.
+    :param kwargs: passed to AsyncGmail.
+    """
+
+    def __init__(self, email, token, **kwargs):
+        self.loop = new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name='gmail-aio', daemon=True)
+        self.thread.start()
+        self.client = self.run(self.create_client(email, token, kwargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    async def create_client(email, token, kwargs):
+        # created on the loop, so that its locks belong to it.
+        return AsyncGmail(email, token, **kwargs)
+
+    def run(self, coroutine):
+        return run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def fetch_structure(self, label_id, latest_mid):
+        return self.run(self.client.fetch_structure(label_id, latest_mid))
+
+    def iter_mails(self, mid_list, message_format='raw', window=None):
+        """
+        Fetch mails of mid_list window messages at a time, and yield them in the order of mid_list.
+        The next window is downloaded while the caller handles the current one.
+
+        :return: generator of tuples: (message_id, response). response is None if the message does not exist.
+        :raise: the error of a message which still fails after its retries, so that a sync stops before it saves
+                its history id, as it does with gmail.fetch.iter_mails().
+        """
+        window = window or self.client.max_connections
+        chunks = (mid_list[i:i + window] for i in range(0, len(mid_list), window))
+        pending = None
+
+        try:
+            for chunk in chunks:
+                previous, pending = pending, run_coroutine_threadsafe(
+                    self.client.fetch_mails(chunk, message_format), self.loop
+                )
+                if previous:
+                    for item in previous.result():
+                        yield item
+
+            if pending:
+                for item in pending.result():
+                    yield item
+                pending = None
+
+        finally:
+            if pending:
+                pending.cancel()
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -1,3 +1,7 @@
+from json import load
+from os.path import dirname, join as path_join
+from threading import Lock, local
+
 from httplib2 import Http
 
 # google oauth2client libraries
@@ -8,6 +12,18 @@ from oauth2client.file import Storage
 GMAIL_SCOPE = 'https://www.googleapis.com/auth/gmail.readonly'
 REDIRECT_URI = 'urn:ietf:wg:oauth:2.0:oob'
 
+# static copy of https://gmail.googleapis.com/$discovery/rest?version=v1, so that building a service needs no network.
+DISCOVERY_DOCUMENT_PATH = path_join(dirname(__file__), 'discovery', 'gmail.v1.json')
+
+_discovery_document = None
+
+# credentials of each storage file, shared by threads. oauth2client guards their refresh with a lock of the storage.
+_credentials = {}
+_credentials_lock = Lock()
+
+# services of each storage file, per thread. httplib2.Http is not thread-safe, so neither is a service.
+_thread_data = local()
+
 
 def authorize(credential_file, storage_file):
 
@@ -21,20 +37,85 @@ def authorize(credential_file, storage_file):
 
     Storage(storage_file).put(flow.step2_exchange(code))
 
+    clear_service_cache()
+
+
+def get_discovery_document():
+    """
+    :return: dict, the bundled Gmail API discovery document. Parsed once per process.
+    """
+    global _discovery_document
+
+    if _discovery_document is None:
+        with open(DISCOVERY_DOCUMENT_PATH, 'r', encoding='utf-8') as f:
+            _discovery_document = load(f)
+
+    return _discovery_document
+
+
+def build_service(http, root_url=None):
+    """
+    Build a Gmail service from the bundled discovery document, without any network I/O.
+
+    :param http: httplib2.Http compatible object, usually authorized by credentials.
+                 A stand-in like googleapiclient.http.HttpMockSequence serves requests offline.
+    :param root_url: URL to send requests to instead of https://gmail.googleapis.com/, e.g. a local stand-in server.
+    """
+    document = get_discovery_document()
+
+    if root_url:
+        document = dict(document, rootUrl=root_url)
+
+    return discovery.build_from_document(document, http=http)
+
+
+def get_credentials(storage_file):
+    with _credentials_lock:
+        credentials = _credentials.get(storage_file)
+
+        if not credentials:
+            credentials = Storage(storage_file).get()
+
+            if not credentials or credentials.invalid:
+                raise Exception('credentials are invalid. Please authorize first.')
+
+            _credentials[storage_file] = credentials
+
+        return credentials
+
 
 def get_service(storage_file):
+    """
+    Get a Gmail service authorized with the token of storage_file.
+
+    A service is built once per thread and storage file, and reused afterwards.
+    An expired access token is refreshed when the service is built, and while it is used, on demand.
+    """
+    services = getattr(_thread_data, 'services', None)
+    if services is None:
+        services = _thread_data.services = {}
+
+    if storage_file not in services:
+        credentials = get_credentials(storage_file)
 
-    credentials = Storage(storage_file).get()
+        http = Http()
 
-    if not credentials:
-        raise Exception('credentials are invalid. Please authorize first.')
+        if credentials.access_token_expired:
+            credentials.refresh(http)
 
-    http = Http()
+        services[storage_file] = build_service(credentials.authorize(http))
 
-    if credentials.access_token_expired:
-        credentials.refresh(http)
+    return services[storage_file]
+
+
+def clear_service_cache():
+    """
+    Forget cached credentials, and services of the calling thread, e.g. after the storage file is replaced.
+    """
+    with _credentials_lock:
+        _credentials.clear()
 
-    return discovery.build(serviceName='gmail', version='v1', http=credentials.authorize(http))
+    _thread_data.services = {}
 
 
 def get_labels(service, email):
@@ -53,8 +134,10 @@ def get_labels(service, email):
     """
 
     from operator import itemgetter
+    from .scheduler import get_scheduler
 
-    labels = service.users().labels().list(userId=email).execute()['labels']
+    request = service.users().labels().list(userId=email)
+    labels = get_scheduler(email).execute(request, 'labels.list')['labels']
 
     labels.sort(key=itemgetter('name'))
 
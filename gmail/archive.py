@@ -0,0 +1,810 @@
+from gzip import GzipFile
+from logging import getLogger
+from random import sample as random_sample
+from mmap import mmap, ACCESS_READ
+from os import getcwd, listdir, register_at_fork, remove, rename, replace as os_replace, fsync, scandir
+from os.path import isabs as path_isabs
+from os.path import exists as path_exists, getsize, expanduser, realpath, join as path_join
+from shutil import copyfileobj
+from struct import Struct
+from tempfile import TemporaryFile
+from threading import local
+
+import re
+import sqlite3
+
+from .attachments import join_attachments
+from .codec import Codec, CODEC_EXTENSIONS, DEFAULT_CODEC, train_dictionary
+
+logger = getLogger(__name__)
+
+ARCHIVE_FORMATS = ('loose', 'pack')
+
+DEFAULT_ARCHIVE_FORMAT = 'loose'
+
+loose_name_expr = re.compile(r'^([0-9a-f]+)\.(gz|zz|xz)$')
+
+PACK_INDEX_NAME = 'pack-index.db'
+
+segment_name_expr = re.compile(r'^pack-(\d{5})\.seg$')
+
+# A segment is closed, and a new one is started, when it would grow over this size.
+MAX_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# number of messages sampled to train a preset dictionary
+DICTIONARY_SAMPLE_SIZE = 256
+
+# Every record in a segment starts with a header: magic, mid, and the length of the compressed message.
+# The index alone is enough to read a record, but headers keep segments self-describing.
+RECORD_MAGIC = b'DIEM'
+record_header = Struct('>4sQI')
+
+# bytes copied at a time, when a message is streamed into a segment.
+COPY_BUFFER_SIZE = 256 * 1024
+
+# archive readers of each archive directory, per thread. A PackStore must be used by a single thread.
+_thread_data = local()
+
+
+def get_archive_dir(archive_path):
+    if path_isabs(archive_path):
+        return realpath(archive_path)
+    else:
+        return realpath(expanduser(path_join(getcwd(), archive_path)))
+
+
+def open_store(archive_path, archive_format=DEFAULT_ARCHIVE_FORMAT, codec=DEFAULT_CODEC):
+    """
+    Open an archive store for writing.
+
+    :param archive_path:
+    :param archive_format: 'loose' stores each message as its own '<mid>.<extension>' file.
+                           'pack' appends messages to large segment files, indexed by mid.
+    :param codec: codec to encode messages with. See gmail.codec.Codec. Messages of any codec can be read.
+    :return: LooseStore or PackStore
+    """
+    archive_dir = get_archive_dir(archive_path)
+
+    if archive_format == 'loose':
+        return LooseStore(archive_dir, codec)
+    elif archive_format == 'pack':
+        return PackStore(archive_dir, codec)
+    else:
+        raise Exception('Invalid archive format: %s' % archive_format)
+
+
+def get_archive(mid, archive_path, as_stored=False):
+    """
+    Read a message from the archive, whether it is packed or loose.
+    Attachments split out of the message are put back, so the message is returned as it was fetched,
+    unless as_stored is True.
+    """
+    archive_dir = get_archive_dir(archive_path)
+    mime = get_reader(archive_dir).get(mid)
+
+    if as_stored:
+        return mime
+
+    return join_attachments(mime, archive_dir)
+
+
+def open_archive(mid, archive_path):
+    """
+    Open a message in the archive as a binary file object of the decompressed message, which can seek.
+    Unlike get_archive(), split attachments are left as placeholders.
+    Seeking forward decompresses up to the position, but does not keep what is skipped.
+    A zlib message is decompressed at once, because of its preset dictionary.
+    """
+    return get_reader(get_archive_dir(archive_path)).open(mid)
+
+
+def get_reader(archive_dir):
+    """
+    :return: ArchiveReader of archive_dir for the calling thread. It is opened at the first call, and kept.
+    """
+    readers = getattr(_thread_data, 'readers', None)
+    if readers is None:
+        readers = _thread_data.readers = {}
+
+    if archive_dir not in readers:
+        readers[archive_dir] = ArchiveReader(archive_dir)
+
+    return readers[archive_dir]
+
+
+def close_readers():
+    """
+    Close the archive readers of the calling thread, e.g. after segments are rewritten, so that no map of a removed
+    segment is kept.
+    """
+    for reader in getattr(_thread_data, 'readers', {}).values():
+        reader.close()
+
+    _thread_data.readers = {}
+
+
+def _forget_readers():
+    # a forked process must not use the index connection of its parent. It opens readers of its own.
+    _thread_data.readers = {}
+
+
+register_at_fork(after_in_child=_forget_readers)
+
+
+def get_archived_mids(archive_path):
+    """
+    :return: set of every mid in the archive, packed or loose.
+    """
+    archive_dir = get_archive_dir(archive_path)
+
+    mids = LooseStore(archive_dir).mids()
+
+    if PackStore.exists(archive_dir):
+        with PackStore(archive_dir) as store:
+            mids.update(store.mids())
+
+    return mids
+
+
+def iter_archives(archive_path):
+    """
+    Read every message in the archive, in one scan of the archive directory.
+    A message both packed and loose is read from the pack store, as get_archive() does.
+    Messages are read as they are stored: split attachments are left as placeholders.
+
+    :return: generator of tuples: (mid, mime, compressed size)
+    """
+    archive_dir = get_archive_dir(archive_path)
+    packed_mids = set()
+
+    if PackStore.exists(archive_dir):
+        with PackStore(archive_dir) as store:
+            for mid, segment, offset, length in store.iter_locations():
+                packed_mids.add(mid)
+                yield mid, store.codec.decode(store.read_record(segment, offset, length)), length
+
+    loose = LooseStore(archive_dir)
+
+    for mid, path, size in loose.iter_entries():
+        if mid not in packed_mids:
+            with open(path, 'rb') as f:
+                yield mid, loose.codec.decode(f.read()), size
+
+
+def migrate_archive(archive_path, remove_loose=False):
+    """
+    Move loose files into the pack store. Loose files are already encoded, and every codec is self-describing,
+    so they are copied into segments as they are.
+
+    :return: number of migrated messages.
+    """
+    archive_dir = get_archive_dir(archive_path)
+    loose = LooseStore(archive_dir)
+    count = 0
+
+    logger.info('migrate_archive started. archive_path: %s' % archive_dir)
+
+    entries = sorted(loose.iter_entries())
+
+    with PackStore(archive_dir) as store:
+        for mid, path, size in entries:
+            with open(path, 'rb') as f:
+                store.put_compressed(mid, f.read())
+            count += 1
+
+    # loose files are removed only after the pack index is committed.
+    if remove_loose:
+        for mid, path, size in entries:
+            remove(path)
+
+    logger.info('migrate_archive completed. %d message(s) migrated.' % count)
+
+    return count
+
+
+def compact_archive(archive_path):
+    archive_dir = get_archive_dir(archive_path)
+
+    if not PackStore.exists(archive_dir):
+        logger.info('compact_archive: no pack store in %s.' % archive_dir)
+        return
+
+    with PackStore(archive_dir) as store:
+        store.compact()
+
+    close_readers()
+
+
+def train_archive_dictionary(archive_path, sample_size=DICTIONARY_SAMPLE_SIZE):
+    """
+    Train a preset dictionary of the zlib codec from a random sample of the archive, and save it in the archive.
+    Messages encoded from now on use the new dictionary. Messages encoded before keep decoding with their own.
+
+    :return: checksum of the dictionary, or None if the archive is empty.
+    """
+    archive_dir = get_archive_dir(archive_path)
+    mids = sorted(get_archived_mids(archive_path))
+
+    if not mids:
+        logger.info('train_archive_dictionary: no message in %s.' % archive_dir)
+        return None
+
+    picked = random_sample(mids, min(sample_size, len(mids)))
+    zdict = train_dictionary(get_archive(mid, archive_path, as_stored=True) for mid in picked)
+
+    logger.info('Preset dictionary trained from %d message(s). %d bytes.' % (len(picked), len(zdict)))
+
+    return Codec('zlib', archive_dir).dictionaries.add(zdict)
+
+
+def recompress_archive(archive_path, codec, train=False, sample_size=DICTIONARY_SAMPLE_SIZE, on_recompressed=None):
+    """
+    Encode every message in the archive again with codec. Messages already encoded with codec are skipped;
+    for zlib, those encoded with the latest preset dictionary.
+    Old pack records are reclaimed by compacting the pack store at the end.
+
+    :param codec: 'gzip', 'zlib', or 'lzma'.
+    :param train: if True, train a new preset dictionary first. For zlib, one is trained anyway if there is none.
+    :param on_recompressed: callable, called as on_recompressed(mid, compressed_size) for each recompressed message.
+    :return: tuple of the number of recompressed messages, and the number of skipped ones.
+    """
+    archive_dir = get_archive_dir(archive_path)
+
+    logger.info('recompress_archive started. archive_path: %s, codec: %s' % (archive_dir, codec))
+
+    if codec == 'zlib' and (train or not Codec(codec, archive_dir).dictionaries.get_latest()):
+        train_archive_dictionary(archive_path, sample_size)
+
+    count = 0
+    skipped = 0
+    old_size = 0
+    new_size = 0
+
+    def _recompress(store, mid, data):
+        nonlocal count, skipped, old_size, new_size
+
+        if store.codec.is_current(data):
+            skipped += 1
+            return
+
+        compressed = store.codec.encode(store.codec.decode(data))
+        store.put_compressed(mid, compressed)
+
+        count += 1
+        old_size += len(data)
+        new_size += len(compressed)
+
+        if on_recompressed:
+            on_recompressed(mid, len(compressed))
+
+    if PackStore.exists(archive_dir):
+        with PackStore(archive_dir, codec) as store:
+            for mid, segment, offset, length in list(store.iter_locations()):
+                _recompress(store, mid, store.read_record(segment, offset, length))
+
+            if count:
+                store.compact()
+
+        close_readers()
+
+    loose = LooseStore(archive_dir, codec)
+
+    for mid, path, size in list(loose.iter_entries()):
+        with open(path, 'rb') as f:
+            _recompress(loose, mid, f.read())
+
+    logger.info(
+        'recompress_archive completed. %d message(s) recompressed, %d skipped. %d bytes before, %d bytes after.' %
+        (count, skipped, old_size, new_size)
+    )
+
+    return count, skipped
+
+
+class ArchiveReader(object):
+    """
+    Reads messages of an archive, packed or loose.
+
+    Readers are kept per thread and archive directory by get_reader(), so that reading message after message
+    connects to the pack index, maps segments, and loads preset dictionaries once, not once per message.
+    Segments grown or added, and dictionaries added, since are picked up as they are read.
+    """
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.loose = LooseStore(archive_dir)
+        self.pack = None
+
+    def get_pack(self):
+        # a pack store may be created after the reader is, by migrate-archive or a fetch in pack format.
+        if self.pack is None and PackStore.exists(self.archive_dir):
+            self.pack = PackStore(self.archive_dir)
+
+        return self.pack
+
+    def get(self, mid):
+        pack = self.get_pack()
+        mime = pack.get(mid) if pack else None
+
+        if mime is None:
+            mime = self.loose.get(mid)
+
+        return mime
+
+    def open(self, mid):
+        pack = self.get_pack()
+
+        if pack:
+            record = pack.get_record(mid)
+            if record is not None:
+                return pack.codec.open(record)
+
+        return self.loose.open(mid)
+
+    def close(self):
+        if self.pack:
+            self.pack.close()
+            self.pack = None
+
+
+class LooseStore(object):
+    """
+    Each message is stored as its own file, '<mid>.gz', '<mid>.zz' or '<mid>.xz' by its codec.
+    """
+
+    def __init__(self, archive_dir, codec=DEFAULT_CODEC):
+        self.archive_dir = archive_dir
+        self.codec = Codec(codec, archive_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        pass
+
+    def get_path(self, mid, extension=None):
+        """
+        :param extension: file name extension. If None, the path of the existing file of mid is returned,
+                          or the path with the extension of the codec of this store if there is none.
+        """
+        if extension:
+            return path_join(self.archive_dir, '%x.%s' % (mid, extension))
+
+        for extension in CODEC_EXTENSIONS.values():
+            path = path_join(self.archive_dir, '%x.%s' % (mid, extension))
+            if path_exists(path):
+                return path
+
+        return self.get_path(mid, self.codec.get_extension())
+
+    def put(self, mid, mime):
+        """
+        Encode mime to '<mid>.<extension>'. The message is written to a temporary file first, and then renamed,
+        so that an interrupted run never leaves a truncated archive behind.
+        """
+        return self.put_compressed(mid, self.codec.encode(mime))
+
+    def put_compressed(self, mid, compressed):
+        """
+        Store an already encoded message. A file of mid in another codec is removed.
+
+        :return: size of the file.
+        """
+        file_name = self.get_path(mid, self.codec.get_extension())
+        temp_name = file_name + '.tmp'
+
+        with open(temp_name, 'wb') as f:
+            f.write(compressed)
+
+        self.replace(mid, temp_name, file_name)
+
+        return len(compressed)
+
+    def put_stream(self, mid, chunks):
+        """
+        Encode a message given as chunks, writing each chunk as it is compressed. See gmail.codec.Codec.encode_stream().
+
+        :param chunks: iterable of bytes.
+        :return: size of the file.
+        """
+        file_name = self.get_path(mid, self.codec.get_extension())
+        temp_name = file_name + '.tmp'
+
+        with open(temp_name, 'wb') as f:
+            size = self.codec.encode_stream(chunks, f)
+
+        self.replace(mid, temp_name, file_name)
+
+        return size
+
+    def replace(self, mid, temp_name, file_name):
+        """
+        Move the temporary file of mid to its place, and remove the file of mid in another codec.
+        """
+        os_replace(temp_name, file_name)
+
+        for extension in CODEC_EXTENSIONS.values():
+            path = self.get_path(mid, extension)
+            if path != file_name and path_exists(path):
+                remove(path)
+
+        logger.debug('Message id %x encoded to %s.' % (mid, file_name))
+
+    def get(self, mid):
+        path = self.get_path(mid)
+
+        with open(path, 'rb') as f:
+            mime = self.codec.decode(f.read())
+
+        logger.debug('Archive \'%s\' extracted successfully. %d bytes' % (path, len(mime)))
+
+        return mime
+
+    def open(self, mid):
+        path = self.get_path(mid)
+
+        # a gzip file is decompressed as it is read.
+        if path.endswith('.gz'):
+            return GzipFile(path, mode='rb')
+
+        with open(path, 'rb') as f:
+            return self.codec.open(f.read())
+
+    def mids(self):
+        return set(mid for mid, path, size in self.iter_entries())
+
+    def iter_entries(self):
+        """
+        :return: generator of tuples: (mid, path, file size)
+        """
+        for entry in scandir(self.archive_dir):
+            matched = loose_name_expr.match(entry.name)
+            if matched:
+                yield int(matched.group(1), 16), entry.path, entry.stat().st_size
+
+
+class PackStore(object):
+    """
+    Append-only pack store.
+
+    Messages are encoded by the codec of the store, and appended as records to segment files 'pack-NNNNN.seg'.
+    The location of each message is kept in a SQLite index, 'pack-index.db': (mid, segment, offset, length).
+    Segments are read through memory maps.
+
+    A message written again is appended again, and the old record becomes garbage until compact() is called.
+    A PackStore object must be used by a single thread.
+    The index table is created by the first write, so that a store which only reads never writes to the index.
+    """
+
+    # Index changes are committed every this many records, and when the store is closed.
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, archive_dir, codec=DEFAULT_CODEC):
+        self.archive_dir = archive_dir
+        self.codec = Codec(codec, archive_dir)
+        self.conn = sqlite3.connect(path_join(archive_dir, PACK_INDEX_NAME))
+        # True once the index table is known to exist.
+        self.indexed = False
+
+        self.maps = {}
+        self.uncommitted = 0
+        self.segment = None
+        self.segment_file = None
+
+    @staticmethod
+    def exists(archive_dir):
+        return path_exists(path_join(archive_dir, PACK_INDEX_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.flush()
+
+        if self.segment_file:
+            self.segment_file.close()
+            self.segment_file = None
+
+        for segment_map, segment_file in self.maps.values():
+            segment_map.close()
+            segment_file.close()
+        self.maps = {}
+
+        self.conn.close()
+
+    def flush(self):
+        """
+        Make appended records durable, and commit their index entries.
+        Segment data always reaches the disk before the index entries pointing to it.
+        """
+        if self.segment_file:
+            self.segment_file.flush()
+            fsync(self.segment_file.fileno())
+
+        self.conn.commit()
+        self.uncommitted = 0
+
+    def create_index(self):
+        if self.indexed:
+            return
+
+        self.conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS pack_index (
+              mid             INTEGER PRIMARY KEY,
+              segment         INTEGER,
+              offset          INTEGER,
+              length          INTEGER
+            )
+            '''
+        )
+        self.conn.commit()
+        self.indexed = True
+
+    def has_index(self):
+        # the table may be created later by a writer in another thread or process, so a miss is not kept.
+        if not self.indexed:
+            query = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'pack_index'"
+            self.indexed = self.conn.execute(query).fetchone()[0] > 0
+
+        return self.indexed
+
+    def get_segment_path(self, segment):
+        return path_join(self.archive_dir, 'pack-%05d.seg' % segment)
+
+    def get_segments(self):
+        segments = []
+
+        for file_name in listdir(self.archive_dir):
+            matched = segment_name_expr.match(file_name)
+            if matched:
+                segments.append(int(matched.group(1)))
+
+        return sorted(segments)
+
+    def put(self, mid, mime):
+        """
+        :return: compressed size of the message.
+        """
+        size = self.put_compressed(mid, self.codec.encode(mime))
+        logger.debug('Message id %x packed to segment %d.' % (mid, self.segment))
+
+        return size
+
+    def put_compressed(self, mid, record):
+        """
+        Append an already encoded message.
+
+        :return: size of the record.
+        """
+        segment_file = self.get_writable_segment(record_header.size + len(record))
+        offset = segment_file.tell() + record_header.size
+
+        segment_file.write(record_header.pack(RECORD_MAGIC, mid, len(record)))
+        segment_file.write(record)
+
+        self.add_index(mid, offset, len(record))
+
+        return len(record)
+
+    def put_stream(self, mid, chunks, buffer_size=COPY_BUFFER_SIZE):
+        """
+        Append a message given as chunks. A record header carries the length of the record, which is not known
+        until the message is compressed, so the record is compressed to a temporary file in the archive directory
+        first, and then copied to the segment, buffer_size bytes at a time.
+
+        :param chunks: iterable of bytes.
+        :return: size of the record.
+        """
+        with TemporaryFile(dir=self.archive_dir) as temp_file:
+            length = self.codec.encode_stream(chunks, temp_file)
+            temp_file.seek(0)
+
+            segment_file = self.get_writable_segment(record_header.size + length)
+            offset = segment_file.tell() + record_header.size
+
+            segment_file.write(record_header.pack(RECORD_MAGIC, mid, length))
+            copyfileobj(temp_file, segment_file, buffer_size)
+
+        self.add_index(mid, offset, length)
+
+        logger.debug('Message id %x packed to segment %d.' % (mid, self.segment))
+
+        return length
+
+    def add_index(self, mid, offset, length):
+        self.create_index()
+        self.conn.execute(
+            'INSERT OR REPLACE INTO pack_index (mid, segment, offset, length) VALUES (?, ?, ?, ?)',
+            (mid, self.segment, offset, length)
+        )
+
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_INTERVAL:
+            self.flush()
+
+    def get_writable_segment(self, size):
+        if self.segment_file is None:
+            segments = self.get_segments()
+            self.segment = segments[-1] if segments else 0
+            self.segment_file = open(self.get_segment_path(self.segment), 'ab')
+
+        if self.segment_file.tell() > 0 and self.segment_file.tell() + size > MAX_SEGMENT_SIZE:
+            self.flush()
+            self.segment_file.close()
+            self.segment += 1
+            self.segment_file = open(self.get_segment_path(self.segment), 'ab')
+
+        return self.segment_file
+
+    def get(self, mid):
+        """
+        :return: message bytes, or None if mid is not in the store.
+        """
+        record = self.get_record(mid)
+
+        if record is None:
+            return None
+
+        mime = self.codec.decode(record)
+
+        logger.debug('Packed message id %x extracted successfully. %d bytes' % (mid, len(mime)))
+
+        return mime
+
+    def get_record(self, mid):
+        """
+        :return: encoded message bytes, or None if mid is not in the store.
+        """
+        if not self.has_index():
+            return None
+
+        row = self.conn.execute('SELECT segment, offset, length FROM pack_index WHERE mid=?', (mid, )).fetchone()
+
+        if row:
+            return self.read_record(*row)
+
+    def read_record(self, segment, offset, length):
+        # records appended by this store may not be on disk yet.
+        if segment == self.segment and self.segment_file:
+            self.segment_file.flush()
+
+        if segment in self.maps:
+            segment_map, segment_file = self.maps[segment]
+            if offset + length > len(segment_map):
+                # the segment has grown since it was mapped.
+                segment_map.close()
+                segment_file.close()
+                del self.maps[segment]
+
+        if segment not in self.maps:
+            segment_file = open(self.get_segment_path(segment), 'rb')
+            self.maps[segment] = (mmap(segment_file.fileno(), 0, access=ACCESS_READ), segment_file)
+
+        return self.maps[segment][0][offset:offset + length]
+
+    def mids(self):
+        if not self.has_index():
+            return set()
+
+        return set(row[0] for row in self.conn.execute('SELECT mid FROM pack_index'))
+
+    def iter_locations(self):
+        """
+        :return: generator of tuples: (mid, segment, offset, length), in the order of the segments.
+        """
+        if not self.has_index():
+            return
+
+        for row in self.conn.execute('SELECT mid, segment, offset, length FROM pack_index ORDER BY segment, offset'):
+            yield row
+
+    def compact(self):
+        """
+        Rewrite live records into new segments, and remove old segments with all garbage in them.
+        New segments are renamed into place before the index is switched to them, and old segments are removed
+        only after the index is committed, so an interrupted compaction loses no message.
+        Segments the index does not point to, and temporary segments, which an interrupted compaction leaves behind,
+        are removed first.
+        """
+        self.flush()
+        self.create_index()
+        self.remove_orphans()
+
+        old_segments = self.get_segments()
+        if not old_segments:
+            return
+
+        logger.info('compact started. %d segment(s).' % len(old_segments))
+
+        if self.segment_file:
+            self.segment_file.close()
+            self.segment_file = None
+
+        rows = self.conn.execute('SELECT mid, segment, offset, length FROM pack_index ORDER BY segment, offset').fetchall()
+
+        segment = old_segments[-1] + 1
+        temp_file = None
+        temp_paths = []
+        new_locations = []
+
+        for mid, old_segment, old_offset, length in rows:
+            record = self.read_record(old_segment, old_offset, length)
+
+            if temp_file and temp_file.tell() + record_header.size + length > MAX_SEGMENT_SIZE:
+                self.close_temp_segment(temp_file)
+                temp_file = None
+                segment += 1
+
+            if not temp_file:
+                temp_paths.append((self.get_segment_path(segment) + '.tmp', self.get_segment_path(segment)))
+                temp_file = open(temp_paths[-1][0], 'wb')
+
+            offset = temp_file.tell() + record_header.size
+            temp_file.write(record_header.pack(RECORD_MAGIC, mid, length))
+            temp_file.write(record)
+            new_locations.append((segment, offset, mid))
+
+        if temp_file:
+            self.close_temp_segment(temp_file)
+
+        for temp_path, path in temp_paths:
+            rename(temp_path, path)
+
+        self.conn.executemany('UPDATE pack_index SET segment=?, offset=? WHERE mid=?', new_locations)
+        self.conn.commit()
+
+        for segment_map, segment_file in self.maps.values():
+            segment_map.close()
+            segment_file.close()
+        self.maps = {}
+
+        old_size = sum(getsize(self.get_segment_path(old_segment)) for old_segment in old_segments)
+        new_size = sum(getsize(path) for temp_path, path in temp_paths)
+
+        for old_segment in old_segments:
+            remove(self.get_segment_path(old_segment))
+
+        logger.info(
+            'compact completed. %d message(s) in %d segment(s). %d bytes before, %d bytes after.' %
+            (len(rows), len(temp_paths), old_size, new_size)
+        )
+
+    def remove_orphans(self):
+        """
+        Remove segments no index entry points to, and temporary segments of a compaction.
+        """
+        referenced = set(row[0] for row in self.conn.execute('SELECT DISTINCT segment FROM pack_index'))
+
+        for segment in self.get_segments():
+            if segment not in referenced:
+                logger.info('Removing segment %d, which no message is indexed in.' % segment)
+                self.close_segment(segment)
+                remove(self.get_segment_path(segment))
+
+        for file_name in listdir(self.archive_dir):
+            if file_name.endswith('.seg.tmp') and segment_name_expr.match(file_name[:-len('.tmp')]):
+                logger.info('Removing %s, left by an interrupted compaction.' % file_name)
+                remove(path_join(self.archive_dir, file_name))
+
+    def close_segment(self, segment):
+        if segment == self.segment and self.segment_file:
+            self.segment_file.close()
+            self.segment_file = None
+
+        if segment in self.maps:
+            segment_map, segment_file = self.maps.pop(segment)
+            segment_map.close()
+            segment_file.close()
+
+    @staticmethod
+    def close_temp_segment(temp_file):
+        temp_file.flush()
+        fsync(temp_file.fileno())
+        temp_file.close()
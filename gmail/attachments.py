@@ -0,0 +1,102 @@
+from base64 import b64encode
+from hashlib import sha256
+from logging import getLogger
+from os import chmod, makedirs, replace as os_replace
+from os.path import exists as path_exists, join as path_join
+
+import re
+
+logger = getLogger(__name__)
+
+ATTACHMENT_DIR_NAME = 'attachments'
+
+# The body of a base64 part split out of a message is replaced by a placeholder line:
+#
+#   diem-attachment:<sha-256 of the decoded payload>:<base64 line length>:<crlf|lf>:<1 if the body ends with a line break>
+#
+# ':' is not a base64 character, so a placeholder never appears in a base64 body of a real message.
+placeholder_expr = re.compile(br'^diem-attachment:([0-9a-f]{64}):(\d+):(crlf|lf):([01])(?=\r?$)', re.MULTILINE)
+
+LINE_BREAKS = {
+    'crlf': b'\r\n',
+    'lf': b'\n',
+}
+
+
+class AttachmentStore(object):
+    """
+    Content-addressed store of attachment payloads, in the 'attachments' directory of the archive.
+    A payload is saved once as 'attachments/<first 2 hex digits>/<sha-256>', however many messages carry it.
+    Files are read-only, so that a hard link to one can be handed out safely.
+    """
+
+    def __init__(self, archive_dir):
+        self.root = path_join(archive_dir, ATTACHMENT_DIR_NAME)
+
+    def get_path(self, digest):
+        return path_join(self.root, digest[:2], digest)
+
+    def put(self, data):
+        """
+        :return: sha-256 hex digest of data.
+        """
+        digest = sha256(data).hexdigest()
+        path = self.get_path(digest)
+
+        if path_exists(path):
+            logger.debug('Attachment %s is already stored.' % digest)
+            return digest
+
+        makedirs(path_join(self.root, digest[:2]), exist_ok=True)
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        chmod(path + '.tmp', 0o444)
+        os_replace(path + '.tmp', path)
+
+        return digest
+
+    def get(self, digest):
+        with open(self.get_path(digest), 'rb') as f:
+            return f.read()
+
+
+def encode_base64(data, line_length, line_break, trailing):
+    encoded = b64encode(data)
+    lines = [encoded[i:i + line_length] for i in range(0, len(encoded), line_length)]
+    return line_break.join(lines) + (line_break if trailing else b'')
+
+
+def make_placeholder(digest, line_length, line_break, trailing):
+    eol = 'crlf' if line_break == b'\r\n' else 'lf'
+    return ('diem-attachment:%s:%d:%s:%d' % (digest, line_length, eol, 1 if trailing else 0)).encode('ascii')
+
+
+def parse_placeholder(body):
+    """
+    :return: tuple of (digest, line_length, line_break, trailing) if body is a placeholder, otherwise None.
+    """
+    matched = placeholder_expr.fullmatch(body.strip())
+    if matched:
+        return (
+            matched.group(1).decode('ascii'),
+            int(matched.group(2)),
+            LINE_BREAKS[matched.group(3).decode('ascii')],
+            matched.group(4) == b'1'
+        )
+
+
+def join_attachments(mime, archive_dir):
+    """
+    Put split attachments back into a message, as they were before they were split.
+    """
+    if b'diem-attachment:' not in mime:
+        return mime
+
+    store = AttachmentStore(archive_dir)
+
+    def _replace(matched):
+        digest, line_length, line_break, trailing = parse_placeholder(matched.group(0))
+        return encode_base64(store.get(digest), line_length, line_break, trailing)
+
+    return placeholder_expr.sub(_replace, mime)
@@ -0,0 +1,295 @@
+from collections import Counter
+from gzip import compress as gzip_compress, decompress as gzip_decompress, GzipFile
+from io import BytesIO
+from logging import getLogger
+from lzma import compress as lzma_compress, decompress as lzma_decompress, LZMACompressor, LZMAFile
+from os import listdir, replace as os_replace
+from os.path import join as path_join
+from struct import unpack
+
+import re
+import zlib
+
+from .metrics import metrics
+
+logger = getLogger(__name__)
+
+CODECS = ('gzip', 'zlib', 'lzma')
+
+DEFAULT_CODEC = 'gzip'
+
+# loose file name extension of each codec
+CODEC_EXTENSIONS = {
+    'gzip': 'gz',
+    'zlib': 'zz',
+    'lzma': 'xz',
+}
+
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+# zlib accepts a preset dictionary up to the size of its window.
+ZDICT_SIZE = 32 * 1024
+
+dictionary_name_expr = re.compile(r'^zdict-(\d{5})\.bin$')
+
+
+def detect_codec(data):
+    """
+    Every codec is self-describing, so the codec of an encoded message is told by its first bytes.
+    A zlib stream compressed with a preset dictionary carries the Adler-32 checksum of the dictionary, too.
+    """
+    if data[:2] == GZIP_MAGIC:
+        return 'gzip'
+    elif data[:6] == XZ_MAGIC:
+        return 'lzma'
+    elif len(data) >= 2 and data[0] & 0x0f == 8 and (data[0] * 256 + data[1]) % 31 == 0:
+        return 'zlib'
+    else:
+        raise Exception('Unknown archive codec.')
+
+
+def get_dictionary_id(data):
+    """
+    :return: Adler-32 checksum of the preset dictionary of a zlib stream, or None if it has no dictionary.
+    """
+    if data[1] & 0x20:
+        return unpack('>I', data[2:6])[0]
+
+
+class Dictionaries(object):
+    """
+    Preset dictionaries of the zlib codec, saved as 'zdict-NNNNN.bin' files in the archive directory.
+    The highest numbered one is used to encode; any of them can be used to decode, looked up by its checksum.
+    Dictionary files are never modified nor removed, because archived messages depend on them.
+    """
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.dictionaries = None
+        self.latest = None
+        self.next_number = 1
+
+    def load(self):
+        if self.dictionaries is not None:
+            return
+
+        self.dictionaries = {}
+        numbers = []
+
+        for file_name in listdir(self.archive_dir):
+            matched = dictionary_name_expr.match(file_name)
+            if matched:
+                numbers.append(int(matched.group(1)))
+
+        for number in sorted(numbers):
+            with open(self.get_path(number), 'rb') as f:
+                zdict = f.read()
+            self.dictionaries[zlib.adler32(zdict)] = zdict
+            self.latest = zdict
+            self.next_number = number + 1
+
+    def get_path(self, number):
+        return path_join(self.archive_dir, 'zdict-%05d.bin' % number)
+
+    def get(self, dictionary_id):
+        self.load()
+
+        # trained by another process since they were loaded.
+        if dictionary_id not in self.dictionaries:
+            self.dictionaries = None
+            self.load()
+
+        if dictionary_id not in self.dictionaries:
+            raise Exception('Preset dictionary %08x is not found in %s.' % (dictionary_id, self.archive_dir))
+
+        return self.dictionaries[dictionary_id]
+
+    def get_latest(self):
+        """
+        :return: the dictionary to encode with, or None if there is no dictionary yet.
+        """
+        self.load()
+        return self.latest
+
+    def add(self, zdict):
+        """
+        Save a new dictionary, to encode with from now on.
+
+        :return: checksum of the dictionary.
+        """
+        self.load()
+
+        dictionary_id = zlib.adler32(zdict)
+        if self.latest == zdict:
+            return dictionary_id
+
+        path = self.get_path(self.next_number)
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(zdict)
+        os_replace(path + '.tmp', path)
+
+        self.dictionaries[dictionary_id] = zdict
+        self.latest = zdict
+        self.next_number += 1
+
+        logger.info('Preset dictionary %08x saved to %s. %d bytes.' % (dictionary_id, path, len(zdict)))
+
+        return dictionary_id
+
+
+class Codec(object):
+    """
+    Encodes messages with one codec, and decodes messages of any codec.
+
+    gzip: the default, compatible with archives of older versions.
+    zlib: compressed with the preset dictionary of the archive, which shares boilerplate among small messages.
+    lzma: slow, but compresses the best. For cold data.
+    """
+
+    def __init__(self, name, archive_dir):
+        if name not in CODECS:
+            raise Exception('Invalid archive codec: %s' % name)
+
+        self.name = name
+        self.dictionaries = Dictionaries(archive_dir)
+
+    def get_extension(self):
+        return CODEC_EXTENSIONS[self.name]
+
+    def encode(self, mime):
+        with metrics.timer('compress_seconds', codec=self.name):
+            return self._encode(mime)
+
+    def _encode(self, mime):
+        if self.name == 'gzip':
+            return gzip_compress(mime)
+
+        elif self.name == 'zlib':
+            compressor = self.get_compressor()
+            return compressor.compress(mime) + compressor.flush()
+
+        else:
+            return lzma_compress(mime)
+
+    def get_compressor(self):
+        """
+        :return: incremental compressor object, with compress() and flush(). It makes the same format encode() does.
+        """
+        if self.name == 'gzip':
+            # wbits 16 + MAX_WBITS makes a gzip member, which gzip.decompress() and GzipFile read.
+            return zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        elif self.name == 'zlib':
+            zdict = self.dictionaries.get_latest()
+            if zdict:
+                return zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+            return zlib.compressobj(9)
+
+        else:
+            return LZMACompressor()
+
+    def encode_stream(self, chunks, f):
+        """
+        Encode a message a chunk at a time, writing to a file as it goes, so that the whole message is never in memory.
+
+        :param chunks: iterable of bytes, the message.
+        :param f: binary file object to write to.
+        :return: number of bytes written.
+        """
+        size = 0
+
+        with metrics.timer('compress_seconds', codec=self.name):
+            compressor = self.get_compressor()
+
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                f.write(data)
+                size += len(data)
+
+            data = compressor.flush()
+            f.write(data)
+            size += len(data)
+
+        return size
+
+    def decode(self, data):
+        codec = detect_codec(data)
+
+        if codec == 'gzip':
+            return gzip_decompress(data)
+
+        elif codec == 'zlib':
+            dictionary_id = get_dictionary_id(data)
+            if dictionary_id is None:
+                return zlib.decompress(data)
+            decompressor = zlib.decompressobj(zdict=self.dictionaries.get(dictionary_id))
+            return decompressor.decompress(data) + decompressor.flush()
+
+        else:
+            return lzma_decompress(data)
+
+    def open(self, data):
+        """
+        :return: binary file object of the decoded message, which can seek.
+        """
+        codec = detect_codec(data)
+
+        if codec == 'gzip':
+            return GzipFile(fileobj=BytesIO(data), mode='rb')
+        elif codec == 'lzma':
+            return LZMAFile(BytesIO(data), mode='rb')
+        else:
+            return BytesIO(self.decode(data))
+
+    def is_current(self, data):
+        """
+        :return: True if data is already encoded as this codec would encode it now.
+        """
+        codec = detect_codec(data)
+
+        if codec != self.name:
+            return False
+
+        if codec == 'zlib':
+            zdict = self.dictionaries.get_latest()
+            return get_dictionary_id(data) == (zlib.adler32(zdict) if zdict else None)
+
+        return True
+
+
+def train_dictionary(samples, size=ZDICT_SIZE):
+    """
+    Build a preset dictionary from sample messages.
+
+    Lines found in many messages, like common headers, MIME boilerplate and HTML templates, are picked by
+    how many bytes they would save, and the most common ones are put at the end, where zlib finds them the nearest.
+
+    :param samples: iterable of message bytes.
+    :return: bytes.
+    """
+    document_frequency = Counter()
+    count = 0
+
+    for mime in samples:
+        count += 1
+        document_frequency.update(set(line for line in mime.splitlines(True) if len(line) > 4))
+
+    min_frequency = max(2, count // 20)
+
+    candidates = [(frequency, line) for line, frequency in document_frequency.items() if frequency >= min_frequency]
+    candidates.sort(key=lambda item: item[0] * len(item[1]), reverse=True)
+
+    picked = []
+    total = 0
+
+    for frequency, line in candidates:
+        if total + len(line) > size:
+            continue
+        picked.append((frequency, line))
+        total += len(line)
+
+    picked.sort(key=lambda item: item[0])
+
+    return b''.join(line for frequency, line in picked)
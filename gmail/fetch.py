@@ -1,14 +1,18 @@
 from base64 import urlsafe_b64decode
+from collections import deque
 from datetime import datetime
 from email.utils import mktime_tz, parsedate_tz
-from gzip import open as gzip_open
-from pytz import timezone
-from os import getcwd
-from os.path import isabs as path_isabs
-from os.path import expanduser, realpath, join as path_join
 from logging import getLogger
+from mmap import mmap, ACCESS_READ
+from tempfile import TemporaryFile
+from threading import local
 
-from googleapiclient.errors import HttpError
+from . import archive
+from .archive import open_store, DEFAULT_ARCHIVE_FORMAT
+from .codec import DEFAULT_CODEC
+from .metrics import metrics
+from .scheduler import get_scheduler, classify_error, NotFoundError, THROTTLED
+from .stream import iter_slices, spool_base64
 
 import re
 
@@ -18,6 +22,25 @@ logger = getLogger(__name__)
 
 TIMEZONE = 'Asia/Seoul'
 
+# Gmail API accepts up to 100 sub-requests in a single batch request.
+MAX_BATCH_SIZE = 100
+
+# Where extract_diary_dates reads the date of an alarm mail, and the message format requested for it.
+#   raw:           'Date' header, searched in the whole raw message.
+#   metadata:      'Date' header only. A few hundred bytes per message.
+#   internal-date: Gmail's internalDate, the time the message was received.
+DATE_SOURCES = {
+    'raw': 'raw',
+    'metadata': 'metadata',
+    'internal-date': 'minimal',
+}
+
+DEFAULT_DATE_SOURCE = 'raw'
+
+# raw messages of this many characters or more, mostly diaries with photos, are archived as a stream.
+# See fetch_and_archive().
+STREAM_MIN_SIZE = 1024 * 1024
+
 
 def fetch_structure(service, email, label_id, latest_mid):
     """
@@ -29,9 +52,28 @@ def fetch_structure(service, email, label_id, latest_mid):
     :param latest_mid:
     :return: list of tuples: (message_id, thread_id)
     """
+    output = []
+
+    for page in iter_structure(service, email, label_id, latest_mid):
+        output.extend(page)
+
+    return output
+
+
+def iter_structure(service, email, label_id, latest_mid):
+    """
+    Fetch message_id, thread_id of message box, page by page.
+    Messages are listed from the newest one, and listing stops when latest_mid is reached.
+
+    :param service:
+    :param email:
+    :param label_id:
+    :param latest_mid:
+    :return: generator of lists of tuples: (message_id, thread_id)
+    """
     page_token = ''
     first_loop = True
-    output = []
+    total = 0
 
     logger.info(
         'fetch_structure started. email: %s, label_id: %s, latest_mid: %d (0x%x)' % (
@@ -43,26 +85,11 @@ def fetch_structure(service, email, label_id, latest_mid):
 
         first_loop = False
 
-        # Expected keys
-        #   messages[]
-        #   nextPageToken
-        #   resultSizeEstimate
-        response = service.users().messages().list(
-            userId=email,
-            labelIds=label_id,
-            includeSpamTrash=False,
-            pageToken=page_token
-        ).execute()
-
-        messages = response['messages'] if 'messages' in response else []
-        page_token = response['nextPageToken'] if 'nextPageToken' in response else ''
-
-        for message in messages:
-            message_id = int(message['id'], 16)
-            thread_id = int(message['threadId'], 16)
+        messages, page_token = list_messages_page(service, email, label_id, page_token)
 
-            logger.debug('message id: %s, thread id: %s' % (message['id'], message['threadId']))
+        output = []
 
+        for message_id, thread_id in messages:
             if message_id <= latest_mid:
                 logger.debug('latest_mid reached.')
                 page_token = ''
@@ -70,16 +97,162 @@ def fetch_structure(service, email, label_id, latest_mid):
 
             output.append((message_id, thread_id))
 
-    logger.info('fetch_structure completed. Total %s items' % len(output))
+        if output:
+            total += len(output)
+            yield output
 
-    return output
+    logger.info('fetch_structure completed. Total %s items' % total)
+
+
+def list_messages_page(service, email, label_id, page_token=''):
+    """
+    List one page of message box.
+
+    :param service:
+    :param email:
+    :param label_id:
+    :param page_token: '' for the first page.
+    :return: tuple of (list of tuples: (message_id, thread_id), next page token). The next page token is ''
+             at the last page.
+    """
+
+    # Expected keys
+    #   messages[]
+    #   nextPageToken
+    #   resultSizeEstimate
+    request = service.users().messages().list(
+        userId=email,
+        labelIds=label_id,
+        includeSpamTrash=False,
+        pageToken=page_token
+    )
+    response = get_scheduler(email).execute(request, 'messages.list')
+
+    messages = response['messages'] if 'messages' in response else []
+    next_page_token = response['nextPageToken'] if 'nextPageToken' in response else ''
+
+    output = []
+
+    for message in messages:
+        logger.debug('message id: %s, thread id: %s' % (message['id'], message['threadId']))
+        output.append((int(message['id'], 16), int(message['threadId'], 16)))
+
+    return output, next_page_token
+
+
+class HistoryExpiredError(Exception):
+    """
+    Raised when the start history id is too old, or invalid, to list history records from.
+    """
+    pass
+
+
+def get_history_id(service, email):
+    """
+    Get the current history id of the mailbox.
+    """
+    profile = get_scheduler(email).execute(service.users().getProfile(userId=email), 'getProfile')
+
+    return int(profile['historyId'])
+
+
+def iter_history(service, email, label_id, start_history_id, sync_state):
+    """
+    Fetch message_id, thread_id of messages added to the label since start_history_id, page by page.
+    A message is included if it is added to the mailbox with the label, or the label is added to it later.
+
+    The current history id of the mailbox is stored in sync_state['history_id'],
+    so that the next sync can start from it.
+
+    :param service:
+    :param email:
+    :param label_id:
+    :param start_history_id:
+    :param sync_state: dict
+    :return: generator of lists of tuples: (message_id, thread_id)
+    :raise HistoryExpiredError: when start_history_id is expired. Sync with iter_structure instead.
+    """
+    page_token = ''
+    first_loop = True
+    total = 0
+    seen = set()
+
+    logger.info(
+        'iter_history started. email: %s, label_id: %s, start_history_id: %d' % (email, label_id, start_history_id)
+    )
+
+    while page_token or first_loop:
+
+        first_loop = False
+
+        try:
+            # Expected keys
+            #   history[]
+            #   nextPageToken
+            #   historyId
+            request = service.users().history().list(
+                userId=email,
+                labelId=label_id,
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded', 'labelAdded'],
+                pageToken=page_token
+            )
+            response = get_scheduler(email).execute(request, 'history.list')
+
+        except NotFoundError:
+            raise HistoryExpiredError('History id %d is expired.' % start_history_id)
+
+        page_token = response['nextPageToken'] if 'nextPageToken' in response else ''
+        sync_state['history_id'] = int(response['historyId'])
+
+        output = []
+
+        for history in response.get('history', []):
+            added_messages = [
+                item['message'] for item in history.get('messagesAdded', [])
+                if label_id in item['message'].get('labelIds', [])
+            ] + [
+                item['message'] for item in history.get('labelsAdded', [])
+                if label_id in item.get('labelIds', [])
+            ]
+
+            for message in added_messages:
+                message_id = int(message['id'], 16)
+                thread_id = int(message['threadId'], 16)
+
+                if message_id in seen:
+                    continue
+
+                logger.debug('message id: %s, thread id: %s' % (message['id'], message['threadId']))
+
+                seen.add(message_id)
+                output.append((message_id, thread_id))
+
+        if output:
+            total += len(output)
+            yield output
+
+    logger.info('iter_history completed. Total %s items, history_id: %d' % (total, sync_state['history_id']))
 
 
 def get_default_timezone():
+    from pytz import timezone
     return timezone(TIMEZONE)
 
 
-def fetch_mail(service, email, message_id):
+def get_mail_request(service, email, message_id, message_format='raw'):
+    if message_format == 'metadata':
+        return service.users().messages().get(
+            id='%x' % message_id,
+            userId=email,
+            format=message_format,
+            metadataHeaders=['Date']
+        )
+    else:
+        return service.users().messages().get(id='%x' % message_id, userId=email, format=message_format)
+
+
+def fetch_mail(service, email, message_id, message_format='raw'):
     """
     response has below keys:
         id
@@ -89,29 +262,35 @@ def fetch_mail(service, email, message_id):
         historyId
         internalDate
         sizeEstimate
-        raw
+        raw         (only in 'raw' format)
+        payload     (only in 'metadata' format. Only 'Date' header is requested)
+
+    Throttled and transient errors are retried by the scheduler of email, and raised if they persist,
+    so that a message is never taken for a missing one under load.
 
     :param service:
     :param email:
     :param message_id:
-    :return:
+    :param message_format: 'raw', 'metadata', or 'minimal'
+    :return: response, or None if the message does not exist.
     """
     try:
-        response = service.users().messages().get(id='%x' % message_id, userId=email, format='raw').execute()
-        logger.debug('fetch_mail: %s, mid %d (0x%x)' % (email, message_id, message_id))
+        request = get_mail_request(service, email, message_id, message_format)
+        response = get_scheduler(email).execute(request, 'messages.get')
+        logger.debug('fetch_mail: %s, mid %d (0x%x), format %s' % (email, message_id, message_id, message_format))
 
-    except HttpError:
+    except NotFoundError:
         logger.error('Email address \'%s\', message id: %d (0x%x) not found.' % (email, message_id, message_id))
         response = None
 
     return response
 
 
-def extract_diary_dates(service, email, structure):
+def extract_diary_dates(service, email, structure, batch_size=1, date_source=DEFAULT_DATE_SOURCE):
 
     logger.info(
-        'extract_diary_dates started. email: %s, structure: %d item(s).' %
-        (email, len(structure))
+        'extract_diary_dates started. email: %s, structure: %d item(s), date_source: %s.' %
+        (email, len(structure), date_source)
     )
 
     # Please be patient!
@@ -120,25 +299,29 @@ def extract_diary_dates(service, email, structure):
 
     output = {}
 
-    for message_id, thread_id in structure:
+    alarm_mids = [message_id for message_id, thread_id in structure if message_id == thread_id]
 
-        if message_id != thread_id:
-            continue
+    # you have to fetch every single message to get date header field.
+    mails = iter_mails(
+        service=service,
+        email=email,
+        mid_list=alarm_mids,
+        batch_size=batch_size,
+        message_format=DATE_SOURCES[date_source]
+    )
 
-        # you have to fetch every single message to get date header field.
-        message = fetch_mail(service, email, message_id)
-        raw_message = urlsafe_b64decode(message['raw']).decode('ascii')
+    for message_id, message in mails:
 
-        date = None
+        if not message:
+            # deleted after it was listed. Its replies are indexed without a diary date.
+            logger.warning('Alarm mail %d (0x%x) does not exist. Its date is skipped.' % (message_id, message_id))
+            continue
 
-        searched = date_expr.search(raw_message)
-        if searched:
-            date_text = searched.group(1)
-            date = parsedate_tz(date_text)
-            timestamp = mktime_tz(date)
-            date = datetime.fromtimestamp(timestamp, get_default_timezone()).date()
+        date = get_message_date(message, date_source)
 
-        assert date is not None
+        if date is None:
+            logger.warning('Alarm mail %d (0x%x) has no Date header. internalDate is used.' % (message_id, message_id))
+            date = get_message_date(message, 'internal-date')
 
         logger.debug('Message id %x, diary date %s extracted.' % (message_id, date))
 
@@ -149,51 +332,265 @@ def extract_diary_dates(service, email, structure):
     return output
 
 
-def fetch_and_archive(service, email, archive_path, mid_list):
+def get_message_date(message, date_source):
+    """
+    Extract the date of message, in the default timezone.
 
-    logger.info(
-        'fetch_and_archive started. email: %s, archive_path: %s, mid_list: %d message(s)' %
-        (email, archive_path, len(mid_list))
-    )
+    :param message: response of fetch_mail, fetched in the message format of date_source.
+    :param date_source: one of DATE_SOURCES.
+    :return: datetime.date, or None if no date is found.
+    """
+    timestamp = None
+
+    if date_source == 'raw':
+        searched = date_expr.search(urlsafe_b64decode(message['raw']).decode('ascii'))
+        if searched:
+            timestamp = mktime_tz(parsedate_tz(searched.group(1)))
+
+    elif date_source == 'metadata':
+        for header in message['payload'].get('headers', []):
+            if header['name'].lower() == 'date':
+                timestamp = mktime_tz(parsedate_tz(header['value']))
+                break
+
+    elif date_source == 'internal-date':
+        # internalDate is milliseconds since the epoch.
+        timestamp = int(message['internalDate']) / 1000
 
-    if path_isabs(archive_path):
-        output_dir = realpath(archive_path)
     else:
-        output_dir = realpath(expanduser(path_join(getcwd(), archive_path)))
+        raise Exception('Invalid date source: %s' % date_source)
+
+    if timestamp is None:
+        return None
+
+    return datetime.fromtimestamp(timestamp, get_default_timezone()).date()
+
+
+def fetch_mails_in_batch(service, email, mid_list, http=None, message_format='raw'):
+    """
+    Fetch messages of mid_list in a single batch HTTP request.
+
+    :param service:
+    :param email:
+    :param mid_list: at most MAX_BATCH_SIZE message ids.
+    :param http: httplib2.Http compatible object for executing the batch request.
+                 If None, the service's own http object is used.
+    :param message_format: 'raw', 'metadata', or 'minimal'
+    :return: tuple of (responses, failed). responses is a dict of message id --> response,
+             and failed is a list of message ids whose sub-requests failed.
+    """
+    from googleapiclient.errors import HttpError
+    from httplib2 import HttpLib2Error
+
+    if len(mid_list) > MAX_BATCH_SIZE:
+        raise Exception('Too many messages for a batch request: %d' % len(mid_list))
+
+    responses = {}
+
+    scheduler = get_scheduler(email)
+
+    def _callback(request_id, response, exception):
+        message_id = int(request_id, 16)
+        if exception:
+            logger.error('Batch sub-request of message id %d (0x%x) failed: %s' % (message_id, message_id, exception))
+            if classify_error(exception) == THROTTLED:
+                scheduler.on_throttled()
+        else:
+            responses[message_id] = response
+
+    batch = service.new_batch_http_request(callback=_callback)
+
+    for mid in mid_list:
+        batch.add(get_mail_request(service, email, mid, message_format), request_id='%x' % mid)
+
+    try:
+        # every sub-request is charged against the quota.
+        scheduler.execute(batch, 'messages.get', len(mid_list), http=http)
+
+    except (HttpError, HttpLib2Error, OSError, NotFoundError) as e:
+        logger.error('Batch request of %d message(s) failed: %s' % (len(mid_list), e))
+
+    failed = [mid for mid in mid_list if mid not in responses]
+    logger.debug('fetch_mails_in_batch: %s, %d message(s), %d failed' % (email, len(mid_list), len(failed)))
+
+    return responses, failed
+
+
+def fetch_mail_chunk(service, email, chunk, batch_size=1, message_format='raw'):
+    """
+    Fetch a chunk of messages, in a batch request if batch_size is greater than 1.
+    Failed sub-requests of a batch are retried as single requests, with the retry policy of fetch_mail().
+
+    :return: list of (message_id, response) tuples in chunk order. response is None if the message does not exist.
+    """
+    if batch_size <= 1:
+        return [(mid, fetch_mail(service, email, mid, message_format)) for mid in chunk]
+
+    responses, failed = fetch_mails_in_batch(service, email, chunk, message_format=message_format)
+
+    for mid in failed:
+        responses[mid] = fetch_mail(service, email, mid, message_format)
+
+    return [(mid, responses[mid]) for mid in chunk]
+
+
+def iter_mails(service, email, mid_list, workers=1, service_builder=None, batch_size=1, message_format='raw'):
+    """
+    Fetch mails of mid_list, and yield (mid, response) tuples in the same order of mid_list.
+    response is None if the message does not exist.
+
+    If batch_size is greater than 1, mid_list is grouped into batch requests of batch_size messages.
+
+    If workers is greater than 1, messages are downloaded concurrently by a bounded thread pool.
+    httplib2.Http is not thread-safe, so every worker builds its own service by calling service_builder.
+    workers is the upper bound of concurrent requests: the scheduler of email lowers it while requests are throttled,
+    and raises it back while they succeed.
+
+    :param service:
+    :param email:
+    :param mid_list:
+    :param workers: number of concurrent download workers.
+    :param service_builder: callable which returns a new authorized service. Required if workers > 1.
+    :param batch_size: number of messages in a batch request. 1 disables batch requests.
+    :param message_format: 'raw', 'metadata', or 'minimal'
+    :return: generator of tuples: (message_id, response)
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    chunks = (mid_list[i:i + batch_size] for i in range(0, len(mid_list), batch_size))
+
+    if workers <= 1:
+        for chunk in chunks:
+            for item in fetch_mail_chunk(service, email, chunk, batch_size, message_format):
+                yield item
+        return
+
+    if not service_builder:
+        raise Exception('service_builder is required for %d workers.' % workers)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    get_scheduler(email).set_max_concurrency(workers)
+
+    thread_data = local()
+
+    def _fetch(chunk):
+        if not hasattr(thread_data, 'service'):
+            thread_data.service = service_builder()
+        return fetch_mail_chunk(thread_data.service, email, chunk, batch_size, message_format)
+
+    # keep at most 'workers * 2' chunks in flight, so that memory stays bounded for long mid lists.
+    max_pending = workers * 2
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunks:
+            pending.append(executor.submit(_fetch, chunk))
+            if len(pending) >= max_pending:
+                for item in pending.popleft().result():
+                    yield item
+
+        while pending:
+            for item in pending.popleft().result():
+                yield item
+
+
+def fetch_and_archive(service, email, archive_path, mid_list, workers=1, service_builder=None, batch_size=1,
+                      archive_format=DEFAULT_ARCHIVE_FORMAT, on_archived=None, archive_codec=DEFAULT_CODEC, splitter=None,
+                      stream_min_size=STREAM_MIN_SIZE, mails=None):
+    """
+    Fetch reply mails of mid_list, and store them in the archive.
+
+    A message whose raw is stream_min_size characters or more is streamed: its base64 is decoded a buffer at a time
+    into a temporary file in the archive directory, and it is compressed from there a buffer at a time,
+    so that neither the decoded message nor the compressed one is ever in memory as a whole.
+    See gmail.stream.spool_base64().
+    Only decoding and compressing are bounded. The response is still parsed as a whole, so its raw, one base64 copy
+    of the message, about 4/3 of its size, is in memory until the message is decoded.
+
+    :param service:
+    :param email:
+    :param archive_path:
+    :param mid_list:
+    :param workers: number of concurrent download workers. See iter_mails().
+    :param service_builder: callable which returns a new authorized service. Required if workers > 1.
+    :param batch_size: number of messages in a batch request. 1 disables batch requests.
+    :param archive_format: 'loose', or 'pack'.
+    :param on_archived: callable, called as on_archived(mid, mime, compressed_size) after each message is stored,
+                        in the calling thread. mime of a streamed message is a read-only mmap,
+                        valid only during the call.
+    :param archive_codec: 'gzip', 'zlib', or 'lzma'. See gmail.codec.Codec.
+    :param splitter: callable, splitter(mime) returns the message to store, with attachments split out of it.
+                     If given, on_archived receives the message as stored.
+    :param stream_min_size: size of raw, in characters, from which a message is streamed. None never streams.
+    :param mails: iterable of (mid, response) tuples in raw format, to archive instead of the ones iter_mails()
+                  downloads with service, e.g. gmail.aio.AsyncFetcher.iter_mails().
+    :return: tuple of (count, error)
+    """
+
+    logger.info(
+        'fetch_and_archive started. email: %s, archive_path: %s, mid_list: %d message(s), workers: %d, batch_size: %d' %
+        (email, archive_path, len(mid_list), workers, batch_size)
+    )
 
     count = 0
     error = 0
 
-    for mid in mid_list:
+    # downloads may run concurrently, but every write to the store happens here, in mid_list order.
+    with open_store(archive_path, archive_format, archive_codec) as store:
+        if mails is None:
+            mails = iter_mails(service, email, mid_list, workers, service_builder, batch_size)
 
-        file_name = path_join(output_dir, ('%x.gz' % mid))
-        message = fetch_mail(service, email, mid)
+        for mid, message in mails:
 
-        if not message:
-            error += 1
-            continue
+            if not message:
+                metrics.increment('archive_errors_total')
+                error += 1
+                continue
+
+            # the message no longer holds raw, so raw is freed as soon as it is decoded.
+            raw = message.pop('raw')
+            metrics.increment('downloaded_bytes_total', len(raw))
+
+            if stream_min_size is not None and len(raw) >= stream_min_size:
+                with TemporaryFile(dir=store.archive_dir) as spool:
+                    with metrics.timer('decode_seconds'):
+                        spool_base64(raw, spool)
+                    del raw
+
+                    with mmap(spool.fileno(), 0, access=ACCESS_READ) as mime:
+                        _archive_message(store, mid, mime, on_archived, splitter, streaming=True)
+
+                metrics.increment('streamed_messages_total')
 
-        with gzip_open(file_name, 'wb') as f:
-            f.write(urlsafe_b64decode(message['raw']))
-            logger.debug('Message id %x gzipped to %s.' % (mid, file_name))
+            else:
+                with metrics.timer('decode_seconds'):
+                    mime = urlsafe_b64decode(raw)
+                del raw
 
-        count += 1
+                _archive_message(store, mid, mime, on_archived, splitter)
+
+            count += 1
 
     logger.info('fetch_and_archive completed. Total %d item(s) saved. Error %d item(s).' % (count, error))
 
+    return count, error
 
-def get_archive(mid, archive_path):
 
-    if path_isabs(archive_path):
-        archive_dir = realpath(archive_path)
-    else:
-        archive_dir = realpath(expanduser(path_join(getcwd(), archive_path)))
+def _archive_message(store, mid, mime, on_archived, splitter, streaming=False):
+    if splitter:
+        mime = splitter(mime)
 
-    path = path_join(archive_dir, '%x.gz' % mid)
+    with metrics.timer('archive_write_seconds'):
+        if streaming:
+            compressed_size = store.put_stream(mid, iter_slices(mime))
+        else:
+            compressed_size = store.put(mid, mime)
 
-    with gzip_open(path, 'rb') as f:
-        mime = f.read()
+    metrics.increment('archived_messages_total')
 
-    logger.debug('Archive \'%s\' extracted successfully. %d bytes' % (path, len(mime)))
+    if on_archived:
+        on_archived(mid, mime, compressed_size)
 
-    return mime
+
+def get_archive(mid, archive_path):
+    return archive.get_archive(mid, archive_path)
@@ -0,0 +1,211 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import replace as os_replace
+from threading import Lock
+from time import perf_counter, time
+
+# upper bounds of latency histogram buckets, in seconds. The last bucket, +Inf, is implicit.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRIC_PREFIX = 'diem_'
+
+# help texts of the metrics recorded by diem and gmail.
+METRIC_HELP = {
+    'gmail_requests_total': 'Gmail API HTTP requests, by method.',
+    'gmail_request_seconds': 'Gmail API HTTP request latency, by method.',
+    'gmail_messages_total': 'Messages requested from the Gmail API, by method. A batch request counts its messages.',
+    'gmail_errors_total': 'Failed Gmail API requests, by error class.',
+    'gmail_retries_total': 'Retried Gmail API requests.',
+    'gmail_connections_total': 'HTTP connections opened to the Gmail API by the asyncio engine.',
+    'gmail_response_bytes_total': 'Bytes of Gmail API responses read by the asyncio engine, decompressed.',
+    'downloaded_bytes_total': 'Bytes of raw messages downloaded, base64 encoded.',
+    'archived_messages_total': 'Messages stored in the archive.',
+    'streamed_messages_total': 'Large messages archived as a stream, a buffer at a time.',
+    'archive_errors_total': 'Messages not archived because they do not exist.',
+    'decode_seconds': 'Time to decode the base64 raw message.',
+    'compress_seconds': 'Time to compress a message.',
+    'archive_write_seconds': 'Time to store a message in the archive, compression included.',
+    'db_write_seconds': 'Time of database writes, by operation.',
+    'http_requests_total': 'HTTP API requests, by endpoint and status.',
+    'http_request_seconds': 'HTTP API response latency, by endpoint.',
+    'cache_hits_total': 'HTTP API cache hits, by kind of value.',
+    'cache_misses_total': 'HTTP API cache misses, by kind of value.',
+    'errors_total': 'Failed runs, by subcommand.',
+    'run_seconds': 'Duration of the last run.',
+    'run_success': '1 if the last run succeeded, 0 if it failed.',
+    'last_run_timestamp_seconds': 'Unix time the last run finished.',
+}
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def get_quantile(self, q):
+        """
+        :return: upper bound of the bucket which the q-quantile falls in. An estimate, like Prometheus does.
+        """
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics(object):
+    """
+    Counters, gauges and latency histograms of a run, shared by threads.
+
+    A metric is identified by its name and labels. Constant labels, like the subcommand, are added to every metric
+    when they are written out.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.constant_labels = {}
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def set_constant_label(self, name, value):
+        self.constant_labels[name] = value
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the seconds the context takes.
+        """
+        begin = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - begin, **labels)
+
+    def is_empty(self):
+        return not (self.counters or self.histograms)
+
+    def get_summary(self):
+        """
+        :return: list of lines, a human readable summary of the run.
+        """
+        lines = []
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('%-52s %14s' % (format_name(name, labels), format_number(value)))
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                lines.append('%-52s %8d times, total %9.3f s, mean %8.2f ms, p95 %8.2f ms, max %8.2f ms' % (
+                    format_name(name, labels),
+                    histogram.count,
+                    histogram.sum,
+                    histogram.sum / histogram.count * 1000,
+                    histogram.get_quantile(0.95) * 1000,
+                    histogram.max * 1000
+                ))
+
+        return lines
+
+    def get_exposition(self):
+        """
+        :return: str, metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        constant = tuple(sorted(self.constant_labels.items()))
+
+        def _header(name, metric_type):
+            if METRIC_HELP.get(name):
+                lines.append('# HELP %s%s %s' % (METRIC_PREFIX, name, METRIC_HELP[name]))
+            lines.append('# TYPE %s%s %s' % (METRIC_PREFIX, name, metric_type))
+
+        with self.lock:
+            for metrics, metric_type in ((self.counters, 'counter'), (self.gauges, 'gauge')):
+                for name in sorted(set(name for name, labels in metrics)):
+                    _header(name, metric_type)
+                    for (n, labels), value in sorted(metrics.items()):
+                        if n == name:
+                            lines.append('%s%s %s' % (METRIC_PREFIX, format_name(name, constant + labels), value))
+
+            for name in sorted(set(name for name, labels in self.histograms)):
+                _header(name, 'histogram')
+                for (n, labels), histogram in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf', ), histogram.counts):
+                        cumulative += count
+                        bucket_labels = constant + labels + (('le', str(bound)), )
+                        lines.append('%s%s %d' % (METRIC_PREFIX, format_name(name + '_bucket', bucket_labels), cumulative))
+                    lines.append('%s%s %r' % (METRIC_PREFIX, format_name(name + '_sum', constant + labels), histogram.sum))
+                    lines.append('%s%s %d' % (METRIC_PREFIX, format_name(name + '_count', constant + labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+        Write the metrics for the textfile collector of node-exporter.
+        The file is replaced atomically, so that the collector never reads a partial file.
+        """
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.get_exposition())
+        os_replace(path + '.tmp', path)
+
+    def finish_run(self, seconds, success):
+        self.set_gauge('run_seconds', round(seconds, 6))
+        self.set_gauge('run_success', 1 if success else 0)
+        self.set_gauge('last_run_timestamp_seconds', int(time()))
+
+
+def format_name(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (key, escape_label(value)) for key, value in labels))
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_number(value):
+    if isinstance(value, float):
+        return '%.3f' % value
+    return '{:,}'.format(value)
+
+
+# metrics of this process.
+metrics = Metrics()
@@ -0,0 +1,336 @@
+from json import loads
+from logging import getLogger
+from random import uniform
+from threading import Condition, Lock
+from time import monotonic, sleep
+
+from .metrics import metrics
+
+logger = getLogger(__name__)
+
+# Gmail API usage limit: 250 quota units per user per second, and a moving average may burst above it a little.
+QUOTA_UNITS_PER_SECOND = 250
+
+# quota units of each method
+QUOTA_COSTS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'history.list': 2,
+    'getProfile': 1,
+    'labels.list': 1,
+}
+
+MAX_RETRIES = 7
+
+# seconds. The n-th retry waits a random time up to min(BACKOFF_CAP, BACKOFF_BASE * 2 ** n).
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 32.0
+
+# seconds. Concurrency is cut at most once in this period, so that a burst of 429s is one signal.
+DECREASE_COOLDOWN = 1.0
+
+# error classes
+RETRY = 'retry'
+THROTTLED = 'throttled'
+NOT_FOUND = 'not-found'
+FATAL = 'fatal'
+
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+
+
+class NotFoundError(Exception):
+    """
+    Raised when a requested resource does not exist. It is never retried.
+    """
+    pass
+
+
+def classify_error(error):
+    """
+    :return: one of
+             THROTTLED: over the quota. Retried, and concurrency is cut.
+             RETRY: a transient server or network error. Retried.
+             NOT_FOUND: 404 or 410.
+             FATAL: any other error, like a bad request or an authorization failure.
+    """
+    # imported here, as errors are rare, to keep the import of this module light.
+    from googleapiclient.errors import HttpError
+    from httplib2 import HttpLib2Error
+
+    if isinstance(error, HttpError):
+        return classify_status(error.resp.status, error)
+
+    elif isinstance(error, (HttpLib2Error, OSError)):
+        # connection reset, timeout, name resolution failure, ...
+        return RETRY
+
+    return FATAL
+
+
+def classify_status(status, error):
+    """
+    :param status: HTTP status code of a failed response.
+    :param error: exception with the response body in its content attribute.
+    :return: error class of the response. See classify_error().
+    """
+    if status == 429:
+        return THROTTLED
+    elif status == 403 and get_error_reason(error) in RATE_LIMIT_REASONS:
+        return THROTTLED
+    elif status in (404, 410):
+        return NOT_FOUND
+    elif status == 408 or status >= 500:
+        return RETRY
+    else:
+        return FATAL
+
+
+def get_error_reason(error):
+    try:
+        content = loads(error.content.decode('utf-8'))
+        return content['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+
+def get_retry_after(error):
+    """
+    :return: seconds of the Retry-After header of an HttpError, or None.
+    """
+    try:
+        return float(error.resp['retry-after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+    """
+    Token bucket of quota units. It holds up to capacity units, and is refilled at rate units per second.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self, units):
+        """
+        Take units from the bucket, waiting until there are enough.
+        """
+        while True:
+            wait = self.try_acquire(units)
+            if not wait:
+                return
+
+            sleep(wait)
+
+    def try_acquire(self, units):
+        """
+        Take units from the bucket if there are enough, without waiting.
+
+        :return: 0 if units are taken, or else seconds until there will be enough.
+        """
+        units = min(units, self.capacity)
+
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= units:
+                self.tokens -= units
+                return 0
+
+            return (units - self.tokens) / self.rate
+
+    def drain(self):
+        """
+        Empty the bucket, after the server said the quota is used up.
+        """
+        with self.lock:
+            self.tokens = 0.0
+            self.updated = monotonic()
+
+
+class AdaptiveLimit(object):
+    """
+    Limit of concurrent requests, adjusted in AIMD fashion:
+    it grows by one after a full window of successful requests, and is halved when requests are throttled.
+    """
+
+    def __init__(self, initial, maximum, minimum=1):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = max(self.minimum, min(initial, self.maximum))
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+        self.condition = Condition()
+
+    def set_maximum(self, maximum):
+        with self.condition:
+            self.maximum = max(maximum, self.minimum)
+            self.limit = self.maximum
+            self.successes = 0
+            self.condition.notify_all()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        """
+        Take a slot if one is free, without waiting.
+
+        :return: True if a slot is taken. It is given back with release().
+        """
+        with self.condition:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def on_success(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                logger.debug('Concurrency limit increased to %d.' % self.limit)
+                self.condition.notify()
+
+    def on_throttled(self):
+        with self.condition:
+            now = monotonic()
+            if now - self.last_decrease < DECREASE_COOLDOWN:
+                return
+            self.last_decrease = now
+            self.successes = 0
+            self.limit = max(self.minimum, self.limit // 2)
+            logger.info('Requests throttled. Concurrency limit decreased to %d.' % self.limit)
+
+
+class Scheduler(object):
+    """
+    Runs Gmail API requests of one user within the quota.
+
+    Every request takes its quota units from a token bucket first, and runs within an adaptive concurrency limit,
+    and within the budget of requests in flight it may share with schedulers of other users. See set_budget().
+    Throttled and transient errors are retried with jittered exponential backoff, and a missing resource
+    raises NotFoundError. Other errors are raised as they are.
+    A Scheduler is shared by threads.
+    """
+
+    def __init__(self, units_per_second=QUOTA_UNITS_PER_SECOND, max_concurrency=64, max_retries=MAX_RETRIES):
+        self.bucket = TokenBucket(units_per_second)
+        self.limit = AdaptiveLimit(max_concurrency, max_concurrency)
+        self.max_retries = max_retries
+        # threading.BoundedSemaphore of requests in flight, shared by schedulers of several users, or None.
+        self.budget = None
+
+    def execute(self, request, method, count=1, **kwargs):
+        """
+        :param request: object with execute() method. A HttpRequest, or a BatchHttpRequest.
+        :param method: one of QUOTA_COSTS.
+        :param count: number of sub-requests of method, for a batch request.
+        :param kwargs: passed to request.execute().
+        :return: response of the request.
+        :raise NotFoundError: on 404 or 410.
+        """
+        attempt = 0
+        cost = QUOTA_COSTS[method] * count
+        label = method if count == 1 else 'batch'
+
+        while True:
+            self.bucket.acquire(cost)
+            self.limit.acquire()
+
+            budget = self.budget
+            if budget:
+                budget.acquire()
+
+            metrics.increment('gmail_requests_total', method=label)
+            metrics.increment('gmail_messages_total', count, method=method)
+
+            try:
+                with metrics.timer('gmail_request_seconds', method=label):
+                    response = request.execute(**kwargs)
+
+            except Exception as e:
+                error_class = classify_error(e)
+                metrics.increment('gmail_errors_total', error_class=error_class)
+
+                if error_class == NOT_FOUND:
+                    raise NotFoundError(str(e))
+
+                if error_class == FATAL or attempt >= self.max_retries:
+                    raise
+
+                if error_class == THROTTLED:
+                    self.on_throttled()
+
+                wait = get_retry_after(e)
+                if wait is None:
+                    wait = uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+                logger.warning('Request failed (%s): %s. Retrying in %.2f sec.' % (error_class, e, wait))
+
+            else:
+                self.limit.on_success()
+                return response
+
+            finally:
+                if budget:
+                    budget.release()
+                self.limit.release()
+
+            attempt += 1
+            metrics.increment('gmail_retries_total')
+            sleep(wait)
+
+    def set_max_concurrency(self, max_concurrency):
+        self.limit.set_maximum(max_concurrency)
+
+    def on_throttled(self):
+        self.bucket.drain()
+        self.limit.on_throttled()
+
+
+_schedulers = {}
+_schedulers_lock = Lock()
+
+
+def get_scheduler(email):
+    """
+    :return: the Scheduler of email. Quota is per user, so all requests for a user in this process share one.
+    """
+    with _schedulers_lock:
+        if email not in _schedulers:
+            _schedulers[email] = Scheduler()
+        return _schedulers[email]
+
+
+def set_budget(email, budget):
+    """
+    Make every request for email take a slot of budget while it is in flight.
+
+    :param budget: threading.BoundedSemaphore shared with the schedulers of other users, to bound their requests
+                   in flight together. None for no budget.
+    """
+    get_scheduler(email).budget = budget
+
+
+def configure_scheduler(email, units_per_second=QUOTA_UNITS_PER_SECOND, max_concurrency=64,
+                        max_retries=MAX_RETRIES):
+    with _schedulers_lock:
+        _schedulers[email] = Scheduler(units_per_second, max_concurrency, max_retries)
+        return _schedulers[email]
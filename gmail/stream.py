@@ -0,0 +1,55 @@
+from base64 import urlsafe_b64decode
+
+# Characters of base64 decoded at a time. A multiple of 4, so that every chunk but the last one decodes on its own.
+STREAM_BUFFER_SIZE = 256 * 1024
+
+
+def iter_base64_chunks(raw, buffer_size=STREAM_BUFFER_SIZE):
+    """
+    Decode URL-safe base64, like the 'raw' field of a Gmail message, buffer_size characters at a time.
+
+    :param raw: str or bytes.
+    :return: generator of bytes.
+    """
+    if buffer_size % 4:
+        raise Exception('Invalid buffer size for base64: %d' % buffer_size)
+
+    for start in range(0, len(raw), buffer_size):
+        chunk = raw[start:start + buffer_size]
+
+        # Gmail may leave the padding out.
+        if len(chunk) % 4:
+            chunk += ('=' if isinstance(chunk, str) else b'=') * (4 - len(chunk) % 4)
+
+        yield urlsafe_b64decode(chunk)
+
+
+def iter_slices(data, buffer_size=STREAM_BUFFER_SIZE):
+    """
+    :param data: bytes-like object which can be sliced, like bytes or mmap.
+    :return: generator of bytes, buffer_size bytes at a time.
+    """
+    for start in range(0, len(data), buffer_size):
+        yield data[start:start + buffer_size]
+
+
+def spool_base64(raw, f, buffer_size=STREAM_BUFFER_SIZE):
+    """
+    Decode URL-safe base64 into a file, a chunk at a time.
+
+    Mapped into memory afterwards, the decoded message is read from the page cache of the file, not from the heap,
+    so a large message costs only a buffer of memory, however large it is.
+
+    :param raw: str or bytes.
+    :param f: binary file object to write to.
+    :return: number of bytes written.
+    """
+    size = 0
+
+    for chunk in iter_base64_chunks(raw, buffer_size):
+        f.write(chunk)
+        size += len(chunk)
+
+    f.flush()
+
+    return size
@@ -0,0 +1,213 @@
+"""
+gmail.aio against bench.fakeserver: mids fetched a window at a time, throttled and failed requests retried
+with Retry-After, broken chunked bodies retried, and archives the same as the blocking engine makes.
+"""
+from asyncio import StreamReader, run
+from os import listdir, makedirs
+from os.path import join as path_join
+from threading import BoundedSemaphore
+from time import perf_counter
+
+import pytest
+
+from httplib2 import Http
+
+from bench.corpus import Corpus
+from bench.fakegmail import FakeGmailService, LABEL_ID, installed
+from bench.fakeserver import FakeGmailServer
+from diem import db as diem_db
+from diem import diem
+from gmail import aio
+from gmail import archive as gmail_archive
+from gmail import fetch as gmail_fetch
+from gmail.aio import AsyncFetcher
+from gmail.api import build_service
+from gmail.scheduler import configure_scheduler, get_scheduler, RETRY
+
+EMAIL = 'test@example.com'
+
+corpus = Corpus(40, attachment_ratio=0.5)
+
+MIDS = [corpus.get_mid(i) for i in range(1, 40, 2)]
+
+
+class FixedToken(object):
+    async def get(self):
+        return 'test-token'
+
+    async def refresh(self, rejected=None):
+        pass
+
+
+def setup_function():
+    configure_scheduler(EMAIL, 10 ** 9, max_retries=0)
+
+
+@pytest.fixture
+def server():
+    server = FakeGmailServer(FakeGmailService(corpus))
+    server.root_url = server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(aio, 'BACKOFF_BASE', 0.01)
+
+
+def test_iter_mails_fetches_windows_in_order(server):
+    missing = corpus.get_mid(len(corpus))
+    mids = MIDS[:6] + [missing]
+    chunks = []
+
+    with AsyncFetcher(EMAIL, FixedToken(), root_url=server.root_url, max_connections=4) as fetcher:
+        fetch_mails = fetcher.client.fetch_mails
+
+        async def _fetch_mails(mid_list, message_format='raw'):
+            chunks.append(mid_list)
+            return await fetch_mails(mid_list, message_format)
+
+        fetcher.client.fetch_mails = _fetch_mails
+        items = list(fetcher.iter_mails(mids, window=3))
+
+    assert chunks == [mids[0:3], mids[3:6], mids[6:7]]
+    assert [mid for mid, response in items] == mids
+    assert [int(response['id'], 16) for mid, response in items[:6]] == mids[:6]
+    assert items[6][1] is None
+
+
+def test_throttled_request_is_retried_after_retry_after(server, fast_backoff):
+    mid = MIDS[0]
+    server.faults[mid] = [(429, {'Retry-After': '0.3'}), (503, {})]
+
+    begin = perf_counter()
+    with AsyncFetcher(EMAIL, FixedToken(), root_url=server.root_url, max_connections=4, max_retries=3) as fetcher:
+        items = list(fetcher.iter_mails([mid]))
+
+    assert perf_counter() - begin >= 0.3
+    assert int(items[0][1]['id'], 16) == mid
+    assert server.faults[mid] == []
+    # throttling cuts the concurrency limit the blocking engine runs within as well.
+    assert get_scheduler(EMAIL).limit.limit == 2
+
+
+def test_budget_bounds_requests_in_flight(server):
+    server.latency = 0.02
+    get_scheduler(EMAIL).budget = BoundedSemaphore(2)
+
+    with AsyncFetcher(EMAIL, FixedToken(), root_url=server.root_url, max_connections=8) as fetcher:
+        items = list(fetcher.iter_mails(MIDS[:12]))
+
+    assert all(response for mid, response in items)
+    assert server.peak_active == 2
+
+
+def test_failed_mid_raises_after_the_others(server, fast_backoff):
+    server.faults[MIDS[1]] = [(500, {})] * 3
+
+    with AsyncFetcher(EMAIL, FixedToken(), root_url=server.root_url, max_connections=4, max_retries=1) as fetcher:
+        with pytest.raises(aio.HttpError):
+            list(fetcher.iter_mails(MIDS[:3]))
+
+    # the other requests are not left running.
+    assert server.service.calls['messages.get'] == 2
+    assert server.faults[MIDS[1]] == [(500, {})]
+
+
+def test_failed_mid_stops_sync_before_history_id(server, tmp_path, monkeypatch, fast_backoff):
+    conn = diem_db.open_db(str(tmp_path / 'diem.db'))
+    diem_db.create_tables(conn)
+    mid = MIDS[-1]
+    server.faults[mid] = [(500, {})] * 3
+
+    def _get_async_fetcher(storage, email, connections):
+        return AsyncFetcher(email, FixedToken(), root_url=server.root_url, max_connections=connections,
+                            max_retries=1)
+
+    monkeypatch.setattr(diem, 'get_async_fetcher', _get_async_fetcher)
+
+    with installed(build_service(Http(), server.root_url)):
+        with pytest.raises(aio.HttpError):
+            diem.fetch_incrementally(conn, None, EMAIL, LABEL_ID, str(tmp_path), workers=4, engine='asyncio')
+
+        assert diem_db.get_history_id(conn) is None
+        assert not diem_db.is_valid_mid(conn, mid)
+
+        diem.fetch_incrementally(conn, None, EMAIL, LABEL_ID, str(tmp_path), workers=4, engine='asyncio')
+
+    assert diem_db.get_history_id(conn)
+    assert gmail_archive.get_archive(mid, str(tmp_path)) == corpus.get_message(mid)
+    conn.close()
+
+
+def test_broken_chunked_body_is_retried(server, fast_backoff):
+    mid = MIDS[0]
+    server.faults[mid] = [
+        b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n',
+        b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n100\r\n{"id"',
+    ]
+
+    with AsyncFetcher(EMAIL, FixedToken(), root_url=server.root_url, max_connections=4, max_retries=3) as fetcher:
+        items = list(fetcher.iter_mails([mid]))
+
+    assert int(items[0][1]['id'], 16) == mid
+    assert server.faults[mid] == []
+
+
+@pytest.mark.parametrize('data, error', [
+    (b'zz\r\n', ConnectionError),
+    (b'10\r\nshort', aio.IncompleteReadError),
+    (b'', aio.IncompleteReadError),
+])
+def test_read_chunked_errors_are_retryable(data, error):
+    async def _read():
+        reader = StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await aio.read_chunked(reader)
+
+    with pytest.raises(error) as raised:
+        run(_read())
+
+    assert aio.classify_error(raised.value) == aio.RETRY == RETRY
+
+
+def test_read_chunked():
+    async def _read():
+        reader = StreamReader()
+        reader.feed_data(b'3;ext=1\r\nabc\r\n2\r\nde\r\n0\r\nTrailer: x\r\n\r\n')
+        reader.feed_eof()
+        return await aio.read_chunked(reader)
+
+    assert run(_read()) == b'abcde'
+
+
+def test_archives_match_blocking_engine(server, tmp_path):
+    threads_path = str(tmp_path / 'threads')
+    asyncio_path = str(tmp_path / 'asyncio')
+
+    for path in (threads_path, asyncio_path):
+        makedirs(path)
+
+    # a gzip file has the time it is written in its header, and a zlib stream does not.
+    service = build_service(Http(), server.root_url)
+    assert gmail_fetch.fetch_and_archive(
+        service, EMAIL, threads_path, MIDS, archive_codec='zlib'
+    ) == (len(MIDS), 0)
+
+    with AsyncFetcher(EMAIL, FixedToken(), root_url=server.root_url, max_connections=4) as fetcher:
+        assert gmail_fetch.fetch_and_archive(
+            None, EMAIL, asyncio_path, MIDS, archive_codec='zlib', mails=fetcher.iter_mails(MIDS)
+        ) == (len(MIDS), 0)
+
+    names = sorted(listdir(threads_path))
+    assert len(names) == len(MIDS)
+    assert names == sorted(listdir(asyncio_path))
+
+    for name in names:
+        with open(path_join(threads_path, name), 'rb') as f, open(path_join(asyncio_path, name), 'rb') as g:
+            assert f.read() == g.read()
+
+    for mid in MIDS:
+        assert gmail_archive.get_archive(mid, asyncio_path) == corpus.get_message(mid)
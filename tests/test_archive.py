@@ -0,0 +1,63 @@
+"""
+gmail.archive.PackStore: readers never write to the index, and compaction removes what an interrupted one left behind.
+"""
+from os import listdir
+from os.path import join as path_join
+
+import sqlite3
+
+from gmail.archive import PackStore, PACK_INDEX_NAME
+
+
+def test_reader_does_not_create_index(tmp_path):
+    archive_dir = str(tmp_path)
+
+    with PackStore(archive_dir) as store:
+        assert store.mids() == set()
+        assert store.get(1) is None
+        assert list(store.iter_locations()) == []
+
+    conn = sqlite3.connect(path_join(archive_dir, PACK_INDEX_NAME))
+    assert conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall() == []
+    conn.close()
+
+
+def test_reader_works_while_writer_holds_lock(tmp_path):
+    archive_dir = str(tmp_path)
+
+    with PackStore(archive_dir) as store:
+        store.put(1, b'first message')
+
+    writer = sqlite3.connect(path_join(archive_dir, PACK_INDEX_NAME), timeout=0)
+    writer.execute('BEGIN IMMEDIATE')
+
+    try:
+        with PackStore(archive_dir) as store:
+            assert store.get(1) == b'first message'
+    finally:
+        writer.rollback()
+        writer.close()
+
+
+def test_compact_removes_orphans(tmp_path):
+    archive_dir = str(tmp_path)
+
+    with PackStore(archive_dir) as store:
+        store.put(1, b'first message')
+        store.put(2, b'second message')
+        store.put(1, b'first message, again')
+
+    # left by a compaction interrupted before or after renaming its new segments.
+    with open(path_join(archive_dir, 'pack-00009.seg'), 'wb') as f:
+        f.write(b'unreferenced')
+    with open(path_join(archive_dir, 'pack-00010.seg.tmp'), 'wb') as f:
+        f.write(b'temporary')
+
+    with PackStore(archive_dir) as store:
+        store.compact()
+
+    assert sorted(name for name in listdir(archive_dir) if '.seg' in name) == ['pack-00001.seg']
+
+    with PackStore(archive_dir) as store:
+        assert store.get(1) == b'first message, again'
+        assert store.get(2) == b'second message'
@@ -0,0 +1,52 @@
+"""
+diem.extractor: a message which fails to extract is reported, and the other messages are still extracted.
+"""
+from os import listdir
+from os.path import join as path_join
+
+from diem import extractor
+from gmail import archive as gmail_archive
+
+MESSAGE = b'''MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="b"
+
+--b
+Content-Type: text/plain
+
+Hello.
+--b
+Content-Type: application/octet-stream; name="%s"
+Content-Disposition: attachment; filename="%s"
+Content-Transfer-Encoding: %s
+
+aGVsbG8=
+--b--
+'''
+
+
+def test_failed_message_does_not_stop_extraction(tmp_path, monkeypatch):
+    archive_path = str(tmp_path)
+
+    with gmail_archive.open_store(archive_path, 'loose') as store:
+        store.put(1, MESSAGE % (b'a.txt', b'a.txt', b'base64'))
+        store.put(2, MESSAGE % (b'b.txt', b'b.txt', b'x-unknown'))
+        store.put(3, MESSAGE % (b'c.txt', b'c.txt', b'base64'))
+
+    get_decoder = extractor.get_decoder
+
+    def _get_decoder(encoding):
+        if encoding == 'x-unknown':
+            raise LookupError('unknown encoding: %s' % encoding)
+        return get_decoder(encoding)
+
+    monkeypatch.setattr(extractor, 'get_decoder', _get_decoder)
+    dest_dir = str(tmp_path / 'dest')
+
+    count, failed = extractor.extract_attachments([1, 2, 3], archive_path, 'all', dest_dir)
+
+    assert count == 2
+    assert failed == [2]
+
+    with open(path_join(dest_dir, '3', 'c.txt'), 'rb') as f:
+        assert f.read() == b'hello'
+    assert listdir(path_join(dest_dir, '1')) == ['a.txt']
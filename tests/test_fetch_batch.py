@@ -0,0 +1,114 @@
+"""
+Batch requests of gmail.fetch, against canned HTTP responses: which messages of a batch succeed, which fail,
+and that only the failed ones are requested again, one by one.
+"""
+from json import dumps
+from urllib.parse import urlsplit
+
+import re
+
+from httplib2 import Response
+
+from gmail import fetch as gmail_fetch
+from gmail.api import build_service
+from gmail.scheduler import configure_scheduler
+
+EMAIL = 'test@example.com'
+
+content_id_expr = re.compile(r'^Content-ID: <([^>]+)>', re.MULTILINE)
+
+REASONS = {200: 'OK', 404: 'Not Found', 429: 'Too Many Requests', 500: 'Internal Server Error'}
+
+
+def make_message(mid):
+    return {'id': '%x' % mid, 'threadId': '%x' % mid, 'raw': 'cmF3'}
+
+
+def make_body(status, mid):
+    if status == 200:
+        return dumps(make_message(mid))
+    return dumps({'error': {'code': status, 'message': REASONS[status]}})
+
+
+class CannedHttp(object):
+    """
+    httplib2.Http stand-in. A batch request is answered with the canned status of each message of it,
+    and a single request of a message with its canned single status, 200 by default.
+
+    :param batch_statuses: dict of mid --> status of its part in a batch response.
+    :param single_statuses: dict of mid --> status of a single request.
+    """
+
+    def __init__(self, batch_statuses, single_statuses=None):
+        self.batch_statuses = batch_statuses
+        self.single_statuses = single_statuses or {}
+        self.batches = []
+        self.singles = []
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if method == 'POST':
+            return self.respond_batch(body)
+
+        mid = int(urlsplit(uri).path.rsplit('/', 1)[1], 16)
+        self.singles.append(mid)
+        status = self.single_statuses.get(mid, 200)
+
+        return Response({'status': str(status), 'content-type': 'application/json'}), \
+            make_body(status, mid).encode('utf-8')
+
+    def respond_batch(self, body):
+        content_ids = content_id_expr.findall(body)
+        mids = [int(content_id.rsplit('+', 1)[1], 16) for content_id in content_ids]
+        self.batches.append(mids)
+
+        parts = []
+        for content_id, mid in zip(content_ids, mids):
+            status = self.batch_statuses[mid]
+            parts.append(
+                '--BOUNDARY\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n'
+                'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n\r\n%s\r\n' % (
+                    content_id, status, REASONS[status], make_body(status, mid)
+                )
+            )
+
+        content = ''.join(parts) + '--BOUNDARY--\r\n'
+
+        return Response({'status': '200', 'content-type': 'multipart/mixed; boundary=BOUNDARY'}), \
+            content.encode('utf-8')
+
+
+def setup_function(function):
+    # no retries of single requests, and no quota waits.
+    configure_scheduler(EMAIL, 10 ** 9, max_retries=0)
+
+
+def test_batch_splits_successes_and_failures():
+    http = CannedHttp({1: 200, 2: 404, 3: 500, 4: 429, 5: 200})
+
+    responses, failed = gmail_fetch.fetch_mails_in_batch(build_service(http), EMAIL, [1, 2, 3, 4, 5])
+
+    assert http.batches == [[1, 2, 3, 4, 5]]
+    assert sorted(responses) == [1, 5]
+    assert responses[5] == make_message(5)
+    assert failed == [2, 3, 4]
+
+
+def test_chunk_retries_failed_mids_alone():
+    http = CannedHttp({1: 200, 2: 500, 3: 404, 4: 200}, single_statuses={3: 404})
+
+    items = gmail_fetch.fetch_mail_chunk(build_service(http), EMAIL, [1, 2, 3, 4], batch_size=4)
+
+    assert http.batches == [[1, 2, 3, 4]]
+    assert http.singles == [2, 3]
+    assert items == [(1, make_message(1)), (2, make_message(2)), (3, None), (4, make_message(4))]
+
+
+def test_iter_mails_groups_mids_into_batches():
+    mids = list(range(1, 8))
+    http = CannedHttp(dict((mid, 200) for mid in mids))
+
+    items = list(gmail_fetch.iter_mails(build_service(http), EMAIL, mids, batch_size=3))
+
+    assert http.batches == [[1, 2, 3], [4, 5, 6], [7]]
+    assert http.singles == []
+    assert items == [(mid, make_message(mid)) for mid in mids]
@@ -0,0 +1,55 @@
+"""
+Cancelling a pipeline of diem.pipeline.Stage: no stage is left blocked on a full queue.
+"""
+from threading import Event
+
+import pytest
+
+from diem.pipeline import Stage
+
+
+def test_cancel_stops_blocked_stages():
+    closed = []
+
+    def _produce():
+        try:
+            for i in range(1000):
+                yield i
+        finally:
+            closed.append('produce')
+
+    def _double(items):
+        try:
+            for item in items:
+                yield item * 2
+        finally:
+            closed.append('double')
+
+    cancel = Event()
+    first = Stage('first', _produce(), 1, cancel)
+    second = Stage('second', _double(first), 1, cancel)
+
+    with pytest.raises(RuntimeError):
+        try:
+            for item in second:
+                if item == 4:
+                    raise RuntimeError('consumer failed')
+        finally:
+            cancel.set()
+            first.join()
+            second.join()
+
+    assert not first.thread.is_alive()
+    assert not second.thread.is_alive()
+    assert sorted(closed) == ['double', 'produce']
+
+
+def test_error_reaches_consumer():
+    def _produce():
+        yield 1
+        raise ValueError('listing failed')
+
+    stage = Stage('first', _produce(), 1)
+
+    with pytest.raises(ValueError):
+        list(Stage('second', (item for item in stage), 1))
@@ -0,0 +1,108 @@
+"""
+diem.server: database reads run off the event loop, concurrent requests of the same diary share one load,
+a stalled request is dropped, and limits are bounded.
+"""
+from asyncio import gather, open_connection, run, wait_for
+from json import loads
+from threading import current_thread
+
+from pytz import utc
+
+from diem import db as diem_db
+from diem import diem
+from diem import server as diem_server
+from diem.server import DiemServer
+from gmail import archive as gmail_archive
+
+MESSAGE = b'''MIME-Version: 1.0
+Date: Thu, 2 Jan 2020 09:00:00 +0000
+Subject: Re: diary
+Content-Type: text/plain; charset=utf-8
+
+Hello.
+'''
+
+
+def open_db(tmp_path):
+    conn = diem_db.open_db(str(tmp_path / 'diem.db'))
+    diem_db.create_tables(conn)
+    return conn
+
+
+def test_concurrent_exports_share_one_load(tmp_path, monkeypatch):
+    conn = open_db(tmp_path)
+    diem_db.update_id_index(conn, [(2, 1)])
+    diem_db.update_date_index(conn, {1: '2020-01-02'})
+
+    with gmail_archive.open_store(str(tmp_path), 'loose') as store:
+        store.put(2, MESSAGE)
+
+    threads = []
+    get_mime_layout = diem.get_mime_layout
+
+    def _get_mime_layout(conn, mid):
+        threads.append(current_thread().name)
+        return get_mime_layout(conn, mid)
+
+    monkeypatch.setattr(diem, 'get_mime_layout', _get_mime_layout)
+
+    server = DiemServer(conn, str(tmp_path), utc, workers=2)
+    reads = []
+    read_archive = server.read_archive
+
+    def _read_archive(mid):
+        reads.append(mid)
+        return read_archive(mid)
+
+    server.read_archive = _read_archive
+
+    async def _main():
+        try:
+            return await gather(*[server.respond('GET', '/export/2') for i in range(8)])
+        finally:
+            await server.close()
+
+    responses = run(_main())
+    conn.close()
+
+    assert [status for status, content_type, body, headers in responses] == [200] * 8
+    assert len(set(body for status, content_type, body, headers in responses)) == 1
+    assert loads(responses[0][2])['mid'] == '2'
+    assert reads == [2]
+    assert threads and all(name.startswith('diem-db') for name in threads)
+
+
+def test_stalled_request_is_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(diem_server, 'REQUEST_TIMEOUT', 0.2)
+    conn = open_db(tmp_path)
+    server = DiemServer(conn, str(tmp_path), utc, workers=1)
+
+    async def _main():
+        host, port = await server.start('127.0.0.1', 0)
+        try:
+            reader, writer = await open_connection(host, port)
+            writer.write(b'GET /status HTTP/1.1\r\nHost: test\r\n')
+            closed = await wait_for(reader.read(), 5)
+            writer.close()
+            return closed
+        finally:
+            await server.close()
+
+    assert run(_main()) == b''
+    conn.close()
+
+
+def test_limit_is_bounded(tmp_path):
+    conn = open_db(tmp_path)
+    server = DiemServer(conn, str(tmp_path), utc, workers=1)
+
+    async def _main():
+        try:
+            return [(await server.respond('GET', target))[0] for target in (
+                '/query?q=all&limit=-1', '/query?q=all&limit=1001', '/search?q=x&offset=-1', '/query?q=all&limit=1000'
+            )]
+        finally:
+            await server.close()
+
+    assert run(_main()) == [400, 400, 400, 200]
+    conn.close()
@@ -0,0 +1,79 @@
+"""
+diem.sync_all: requests in flight across profiles, of every pipeline stage, stay within max_requests.
+"""
+from os import makedirs
+from threading import Lock
+from time import sleep
+
+import pytest
+
+from bench.corpus import Corpus
+from bench.fakegmail import FakeGmailService, installed
+from diem import db as diem_db
+from diem import diem
+from gmail.scheduler import configure_scheduler
+
+corpus = Corpus(200)
+
+
+class CountingService(FakeGmailService):
+    """
+    FakeGmailService which counts the requests in flight at once, across every profile using it.
+    """
+
+    def __init__(self, corpus, latency):
+        super(CountingService, self).__init__(corpus, latency=latency, page_size=50)
+        self.in_flight = 0
+        self.peak = 0
+        self.flight_lock = Lock()
+
+    def wait(self):
+        with self.flight_lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            sleep(self.latency)
+        finally:
+            with self.flight_lock:
+                self.in_flight -= 1
+
+
+def make_profiles(tmp_path, count):
+    profiles = []
+
+    for i in range(count):
+        email = 'user%d@example.com' % i
+        configure_scheduler(email, 10 ** 9, max_retries=0)
+
+        archive_path = str(tmp_path / ('archive-%d' % i))
+        makedirs(archive_path)
+
+        conn = diem_db.open_db(str(tmp_path / ('%d.db' % i)))
+        diem_db.create_tables(conn)
+        conn.close()
+
+        profiles.append(('p%d' % i, {
+            'database': str(tmp_path / ('%d.db' % i)),
+            'archive-path': archive_path,
+            'storage': None,
+            'email': email,
+            'label-id': 'Label_1',
+        }))
+
+    return profiles
+
+
+@pytest.mark.parametrize('jobs, workers, max_requests', [
+    (4, 8, 4),
+    (2, 8, 4),
+])
+def test_requests_in_flight_are_capped(tmp_path, jobs, workers, max_requests):
+    service = CountingService(corpus, latency=0.005)
+    profiles = make_profiles(tmp_path, 4)
+
+    with installed(service):
+        results = diem.sync_all(profiles, jobs=jobs, workers=workers, max_requests=max_requests, sync_mode='list')
+
+    assert all(result['success'] for result in results), results
+    assert all(result['archived'] == len(corpus) // 2 for result in results)
+    assert 1 < service.peak <= max_requests